@@ -0,0 +1,65 @@
+import argparse
+import multiprocessing
+import multiprocessing.pool
+import time
+
+from modules import cli
+from modules import cmd
+from modules import platform
+from modules.ffmpeg import Ffmpeg
+from modules.formats import VideoCodec
+
+def gen_encodes(args, cores):
+    ffmpeg = Ffmpeg()
+    result = []
+    for i in xrange(args.n):
+        dst_options = ['-an', '-sn', '-dn', '-frames:v {}'.format(args.fr),
+                       '-c:v {}'.format(ffmpeg.build_video_encoding_library_argument(args.vc)),
+                       '-preset {}'.format(args.pr)]
+        x265_params = ['log-level=error']
+        if cores is not None:
+            threads_options, x265_threads_params = ffmpeg.build_video_threads_arguments(args.vc, cores)
+            dst_options.extend(threads_options)
+            x265_params.extend(x265_threads_params)
+        if args.vc == VideoCodec.H265:
+            dst_options.append('-x265-params "{}"'.format(':'.join(x265_params)))
+        dst_options.append('-f null')
+        command = cmd.gen_ffmpeg_convert(args.src, ['-nostats'], '-', dst_options)[0]
+        pinned_cores = None
+        if cores is not None and args.ca:
+            pinned_cores = [(i * cores + j) % multiprocessing.cpu_count() for j in xrange(cores)]
+        result.append((command, pinned_cores))
+    return result
+
+def run_encodes(encodes):
+    pool = multiprocessing.pool.ThreadPool(len(encodes))
+    start = time.time()
+    exit_codes = pool.map(lambda encode: encode[0].execute(encode[1]), encodes)
+    elapsed = time.time() - start
+    pool.close()
+    if any(exit_codes):
+        raise cli.Error(u'Encoding failed: {}'.format(encodes[0][0].render()))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare aggregate fps of concurrent encodes with and without core budget')
+    parser.add_argument('src', type=cli.argparse_path, help='path to source video')
+    parser.add_argument('-vc', choices=VideoCodec.get_names([VideoCodec.H264, VideoCodec.H265]), default=VideoCodec.H264.name, help='set video encoding codec')
+    parser.add_argument('-n', type=int, default=2, metavar='N', help='number of concurrent encodes')
+    parser.add_argument('-fr', type=int, default=500, metavar='N', help='number of frames per encode')
+    parser.add_argument('-pr', default='medium', metavar='preset', help='encoder preset')
+    parser.add_argument('-ca', default=False, action='store_true', help='pin partitioned encodes to their cores')
+    args = parser.parse_args()
+    args.vc = VideoCodec.get_definition(args.vc)
+
+    cores = max(1, multiprocessing.cpu_count() // args.n)
+    platform.print_string(u'{} cpu cores, {} {} encodes, preset {}'.format(
+        multiprocessing.cpu_count(), args.n, args.vc.name, args.pr))
+    for name, budget in ((u'unpartitioned', None), (u'{} cores each'.format(cores), cores)):
+        elapsed = run_encodes(gen_encodes(args, budget))
+        platform.print_string(u'{}: {} x {} frames in {:.1f}s, {:.1f} fps aggregate'.format(
+            name, args.n, args.fr, elapsed, args.n * args.fr / elapsed))
+    return 0
+
+if __name__ == '__main__':
+    cli.run(main)
@@ -1,8 +1,11 @@
 # coding: utf-8
 
 import argparse
+import bisect
 import codecs
 import collections
+import itertools
+import multiprocessing
 import os
 import re
 import shutil
@@ -10,12 +13,15 @@ import sys
 
 import tvdb_api
 
+from modules import cache
 from modules import cli
 from modules import cmd
+from modules import jobs
 from modules import lang
 from modules import media
 from modules import misc
 from modules import platform
+from modules import scanner
 from modules.ffmpeg import Ffmpeg
 from modules.formats import VideoCodec, PictureFormat, AudioCodec, SubtitleCodec, FieldOrder, VideoCodecProfile, \
     VideoCodecLevel, FileFormat, TrackType
@@ -127,35 +133,64 @@ def is_movie_satellite(movie_path, candidate_path):
     cd, cn = platform.split_path(candidate_path)
     return md.lower() == cd.lower() and cn.lower().startswith(os.path.splitext(mn)[0].lower())
 
-def find_movies(search_path, ignore_languages, detect_satellites):
+def group_media_files(media_paths, detect_satellites):
+    media_by_folder = {}
+    for path in media_paths:
+        media_by_folder.setdefault(os.path.dirname(path), set()).add(path)
+
+    media_groups = []
+    for remaining_media in media_by_folder.itervalues():
+        video_paths = [fp for fp in remaining_media if TrackType.VID in media.File.possible_track_types(fp)]
+        remaining_names = sorted((os.path.basename(fp).lower(), fp) for fp in remaining_media)
+        for video in sorted(video_paths, key=lambda fp: (len(fp), fp)):
+            if video in remaining_media:
+                video_name = os.path.basename(video).lower()
+                if detect_satellites:
+                    prefix = os.path.splitext(video_name)[0]
+                    start = end = bisect.bisect_left(remaining_names, (prefix,))
+                    while end < len(remaining_names) and remaining_names[end][0].startswith(prefix):
+                        end += 1
+                else:
+                    start = bisect.bisect_left(remaining_names, (video_name, video))
+                    end = start + 1
+                group = [path for _, path in remaining_names[start:end] if path != video]
+                media_groups.append([video] + group)
+                remaining_media.difference_update(path for _, path in remaining_names[start:end])
+                del remaining_names[start:end]
+    return sorted(media_groups, key=lambda g: [os.path.dirname(g[0]).lower(), os.path.basename(g[0]).lower(), os.path.splitext(g[0])[1].lower()])
+
+def find_movies(search_path, ignore_languages, detect_satellites, probe_cache, library_scanner=None, seen_sources=None):
     found_files = []
+    added_files = updated_files = None
     if os.path.isfile(search_path):
         search_dir = os.path.dirname(search_path)
         for name in os.listdir(search_dir):
             if detect_satellites and is_movie_satellite(search_path, os.path.join(search_dir, name)):
                 found_files.append(os.path.join(search_dir, name))
+    elif os.path.isdir(search_path) and library_scanner is not None:
+        scan = library_scanner.scan(search_path)
+        found_files = scan.files
+        added_files = set(scan.added)
+        updated_files = added_files.union(scan.changed)
+        for group in group_media_files(scan.removed, detect_satellites):
+            platform.print_string(u'Removed: {}'.format(group[0]))
     elif os.path.isdir(search_path):
         for search_dir, _, files in os.walk(search_path):
             found_files.extend(os.path.join(search_dir, name) for name in files)
 
-    media_by_folder = {}
-    for path in (os.path.abspath(fp) for fp in found_files):
-        if is_media_file_path(path):
-            media_by_folder.setdefault(os.path.dirname(path), set()).add(path)
-
-    media_groups = []
-    for remaining_media in media_by_folder.itervalues():
-        video_paths = [fp for fp in remaining_media if TrackType.VID in media.File.possible_track_types(fp)]
-        for video in sorted(video_paths, key=len):
-            group = []
-            if video in remaining_media:
-                remaining_media.remove(video)
-                group = [path for path in remaining_media if detect_satellites and is_movie_satellite(video, path)]
-                media_groups.append([video] + group)
-            remaining_media -= set(group)
-
-    for group in sorted(media_groups, key=lambda g: [os.path.dirname(g[0]).lower(), os.path.basename(g[0]).lower(), os.path.splitext(g[0])[1].lower()]):
-        yield media.Movie(group, ignore_languages)
+    media_paths = [path for path in (os.path.abspath(fp) for fp in found_files) if is_media_file_path(path)]
+    for group in group_media_files(media_paths, detect_satellites):
+        if updated_files is not None:
+            if not updated_files.intersection(group):
+                continue
+            platform.print_string(u'{}: {}'.format(u'Added' if added_files.issuperset(group) else u'Changed', group[0]))
+        if seen_sources is not None:
+            source_fingerprint = probe_cache.fingerprint(group[0])
+            if source_fingerprint in seen_sources:
+                platform.print_string(u'Duplicate: {}, same as {}'.format(group[0], seen_sources[source_fingerprint]))
+                continue
+            seen_sources[source_fingerprint] = group[0]
+        yield media.Movie(group, ignore_languages, probe_cache)
 
 def read_map_file(path, handle_key, handle_value):
     result = None
@@ -196,6 +231,7 @@ def main():
     parser.add_argument('-ar', default=False, action='store_true', help='recode audio')
     parser.add_argument('-ad', default='5.1', choices=CHANNEL_SCHEMES.keys(), help='downmix to N channels')
     parser.add_argument('-aw', default=False, action='store_true', help='convert audio to wavfile before encoding')
+    parser.add_argument('-ag', default=False, action='store_true', help='transcode audio of each source with one ffmpeg filter graph instead of eac3to and qaac')
 
     parser.add_argument('-sl', nargs='*', type=cli.argparse_lang, default=[], metavar='lang', help='ordered list of full subtitle 3-letter language codes to keep')
     parser.add_argument('-fl', nargs='*', type=cli.argparse_lang, default=[], metavar='lang', help='ordered list of forced subtitle  3-letter language codes to keep')
@@ -207,7 +243,18 @@ def main():
     parser.add_argument('-xx', default=False, action='store_true', help='Remove original files after processing')
     parser.add_argument('-ma', default=False, action='store_true', help='Append mux file instead of overwrite')
     parser.add_argument('-ds', default=False, action='store_true', help='Disable movie sattelites detection')
+    parser.add_argument('-dp', default=False, action='store_true', help='Process duplicate sources instead of skipping them')
     parser.add_argument('-sd', default=False, action='store_true', help='Securely delete files using sdelete utility')
+    parser.add_argument('-nc', default=False, action='store_true', help='Disable persistent probe cache')
+    parser.add_argument('-cs', type=int, default=0, metavar='GB', help='Size of transcoded artifacts cache, 0 disables it')
+    parser.add_argument('-pj', type=int, default=4, metavar='N', help='Number of files probed concurrently')
+    parser.add_argument('-ix', default=False, action='store_true', help='Scan sources incrementally, process only added or changed movies')
+    parser.add_argument('-st', default=False, action='store_true', help='Process movies in discovery order without collecting them first')
+    parser.add_argument('-ex', default=False, action='store_true', help='Execute commands directly instead of writing mux file')
+    parser.add_argument('-ep', nargs=3, type=int, default=[2, 2, 1], metavar=('CPU', 'READ', 'WRITE'),
+                        help='Number of concurrently executed CPU, disk read and disk write heavy commands')
+    parser.add_argument('-vj', type=int, default=None, metavar='N', help='Number of CPU cores per video encode')
+    parser.add_argument('-ca', default=False, action='store_true', help='Pin executed CPU heavy commands to their cores')
 
     args = parser.parse_args()
     if args.cf and args.sc:
@@ -218,6 +265,10 @@ def main():
         parser.error(u'Use -vk or -vr/-vt, not both')
     if not args.vk and (not args.vt or not args.vq):
         parser.error(u'Set -vt and -vq')
+    if args.ex and args.vj is None and args.ep[0] > 1:
+        args.vj = max(1, multiprocessing.cpu_count() // args.ep[0])
+    if args.ca and (not args.ex or args.vj is None):
+        parser.error(u'Use -ca with -ex and -vj')
 
     args.vc = VideoCodec.get_definition(args.vc)
     if args.vt:
@@ -244,304 +295,402 @@ def main():
     if args.tv:
         tvdb = tvdb_api.Tvdb()
 
-    movies = {}
+    probe_cache = cache.ProbeCache(None if args.nc else os.path.join(platform.get_cache_dir(), u'probe.sqlite'))
+    artifact_cache = cache.ArtifactCache()
+    if args.cs > 0:
+        artifact_cache = cache.ArtifactCache(
+            os.path.join(platform.get_cache_dir(), u'artifacts'), args.cs * 1024 ** 3, probe_cache.fingerprint)
+        artifact_cache.evict()
+    library_db_path = os.path.join(platform.get_cache_dir(), u'library.sqlite')
+    library_scanner = None
+    if args.ix:
+        library_scanner = scanner.LibraryScanner(library_db_path, is_media_file_path)
+
     crop_args_map = None if raw_crops_map is None else {}
-    for argspath in args.sources:
-        for movie_object in find_movies(argspath, args.il, not args.ds):
-            cur_path = os.path.normpath(os.path.relpath(movie_object.main_path(), platform.getcwd()))
-            if raw_crops_map is not None:
-                crop_args_map[movie_object.main_path()] = raw_crops_map[os.path.splitext(cur_path)[0]]
-            if args.tv:
-                movie_name = os.path.basename(movie_object.main_path())
-                src_season = int(re.match(r'.*s(\d+)', movie_name, re.IGNORECASE).group(1))
-                src_episodes = [int(x) for x in re.findall(r'e(\d+)', movie_name, re.IGNORECASE)]
-                ep_numbers = []
-                ep_names = set()
-                for src_episode in src_episodes:
-                    ep_info = tvdb[args.tv][src_season][src_episode]
-                    epn_dvd = ep_info['dvdEpisodeNumber']
-                    epn_air = ep_info['airedEpisodeNumber']
-                    if epn_dvd is not None and epn_dvd != epn_air:
-                        epn_dvd_int = int(float(epn_dvd))
-                        epn_dvd_frc = float(epn_dvd) - epn_dvd_int
-                        assert int(epn_air) == int(round(epn_dvd_int + (epn_dvd_frc - 0.1) * 10)), 'd{} a{}'.format(epn_dvd, epn_air)
-                    ep_numbers.append(int(epn_air))
-                    ep_names.add(re.sub(r'\(\d\)$', '', ep_info['episodename']).strip())
-                assert len(ep_numbers) > 0 and len(ep_names) == 1, ep_names
-                cur_path = u'{} {}.mkv'.format('-'.join(u'{:02d}'.format(epn) for epn in sorted(ep_numbers)), list(ep_names)[0])
-            elif filenames_map is not None:
-                raw_new_name_string = filenames_map[os.path.splitext(cur_path)[0]]
-                cur_path = None
-                if raw_new_name_string == 'NO': continue
-                elif raw_new_name_string == 'KEEP': cur_path = cur_path
-                else: cur_path = raw_new_name_string
-            if is_media_file_path(cur_path):
-                cur_path = os.path.splitext(cur_path)[0]
-            new_name = u'{}.mkv'.format(platform.clean_filename(os.path.basename(cur_path)))
-            new_path = os.path.join(os.path.abspath(args.dst), os.path.dirname(cur_path), new_name)
-            assert new_path not in movies, new_path
-            movies[new_path] = movie_object
-
-    output_track_specs = collections.OrderedDict([
-        ((TrackType.VID, False), ['und']),
-        ((TrackType.AUD, False), args.al),
-        ((TrackType.SUB, False), args.sl),
-        ((TrackType.SUB, True), args.fl),
-    ])
-
-    if not (args.ma and os.path.isfile(MUX_BODY)):
-        try:
-            os.remove(MUX_BODY)
-        except:
-            pass
-        shutil.copyfile(MUX_HEAD, MUX_BODY)
-
-    created_directories = set()
-    # TODO catch some of my exceptions, report skipped file, ask for action, log skipped file
-    common_crop_args = None
-    for target_path, movie in sorted(movies.iteritems(), key=lambda m: m[1].main_path()):
-        platform.print_string(u'=== {} ==='.format(movie.main_path()))
-        output_tracks = {}
-        for (track_type, _) in output_track_specs.iterkeys():
-            output_tracks[track_type] = []
-        used_tracks = set()
-        reference_duration = movie.reference_duration() or 0
-        duration_threshold = reference_duration / 100.0 * 20.0
-        for (track_type, search_forced), lang_list in output_track_specs.iteritems():
-            forced_string = 'Forced' if search_forced else 'Full'
-            for target_lang in lang_list:
-                candidates = {}
-                for track in movie.tracks(track_type):
-                    if track.qualified_id() in used_tracks: continue
-                    if track.language() not in (target_lang, 'und') and target_lang != 'und': continue
-                    if any(s in track.name().lower() for s in [u'comment', u'коммент']): continue
-                    if track.is_forced() is not None:
-                        if track.is_forced() != search_forced: continue
-                        if not track.is_forced() and track.duration() is not None:
-                            if reference_duration - track.duration() > duration_threshold: continue
-                    candidates[track.qualified_id()] = track
-                if not candidates:
-                    if search_forced and args.fo: continue
-                    raise cli.Error(u'{} {} {} not found'.format(forced_string, track_type, target_lang))
-
-                chosen_track_id = None
-                if len(candidates) == 1: chosen_track_id = list(candidates.keys())[0]
-
-                sorted_candidates = sorted(candidates.itervalues(), key=lambda t: t.qualified_id())
-                if chosen_track_id not in candidates:
-                    candidates_by_index = {}
-                    for track in sorted_candidates:
-                        candidates_by_index[movie.track_index_in_type(track)] = track.qualified_id()
-                    header = u'--- {}, {}, {} ---'.format(
-                        track_type, target_lang.upper(), forced_string)
-                    # TODO if tv AND if tracks ids, names and codecs same as before then choose track automatically
-                    chosen_track_index = ask_to_select_tracks(movie, track_type, sorted_candidates, header)
-                    chosen_track_id = candidates_by_index[chosen_track_index]
-
-                used_tracks.add(chosen_track_id)
-                chosen_track = candidates[chosen_track_id]
-                chosen_track.set_language(target_lang)
-                chosen_track.set_forced(search_forced)
-                output_tracks[track_type].append(chosen_track)
-
-        assert len(output_tracks[TrackType.VID]) == 1
-        video_track = output_tracks[TrackType.VID][0]
-
-        def track_sort_key(t):
-            lng_idx = output_track_specs[(t.type(), t.is_forced())].index(t.language())
-            return lng_idx + 1000 * int(t.is_forced())
-
-        track_sources = {}
-        for track_type, track_list in output_tracks.iteritems():
-            track_list.sort(key=track_sort_key)
-            for track in track_list:
-                track_sources[track.qualified_id()] = [track.source_file(), track.id()]
-
-        result_commands = [u'echo {}'.format(cmd.quote(movie.main_path()))]
-        mux_temporary_files = []
-
-        target_directory = os.path.dirname(target_path)
-        if not os.path.isdir(target_directory) and target_directory not in created_directories:
-            result_commands.extend(cmd.gen_create_dir(target_directory))
-            created_directories.add(target_directory)
-
-        def make_single_track_file(track, stream_id, file_ext=None, ffmpeg_opts=None, prefer_ffmpeg=True):
-            if file_ext is None:
-                file_ext = track.get_single_track_file_extension()
-            if ffmpeg_opts is None:
-                ffmpeg_opts = ['-c:{} copy'.format(stream_id)]
-            if file_ext == platform.file_ext(track.source_file()) and track.is_single():
-                return track.source_file(), False
-            tmp_path = platform.make_temporary_file(file_ext)
-            if not prefer_ffmpeg and platform.file_ext(track.source_file()) == '.mkv':
-                command = cmd.gen_mkvtoolnix_extract_track(track.source_file(), tmp_path, track.id())
-            else:
-                command = cmd.gen_ffmpeg_extract_track(track.source_file(), tmp_path, track.id(), [], ffmpeg_opts)
-            result_commands.extend(command)
-            return tmp_path, True
-
-        # TODO move to software abstraction
-        source_container_supported_by_mkvmerge = video_track.container_format() not in {FileFormat.x3GP, FileFormat.SMK, FileFormat.WMV}
-
-        source_video_codec = video_track.codec()
-        source_video_crf = video_track.crf()
-        source_video_profile = video_track.profile()
-        source_video_level = video_track.level()
-
-        target_video_codec = args.vc
-        target_video_profile, target_video_level = CODEC_FFMPEG_PARAMETERS[target_video_codec]
-
-        encoded_ok = source_video_codec == target_video_codec and \
-            source_video_crf is not None and \
-            source_video_profile == target_video_profile and \
-            source_video_level == target_video_level
-        if args.vr or args.vs or not encoded_ok and not args.vk:
-            ffmpeg = Ffmpeg()
-            target_crf, target_tune = CODEC_TUNES[target_video_codec][args.vt][args.vq]
-
-            # TODO check out rutracker manuals for dvd rip filters and stuff
-            ffmpeg_filters = []
-
-            assert video_track.field_order() is not None
-            if video_track.field_order() in (FieldOrder.INTERLACED_BOT, FieldOrder.INTERLACED_TOP):
-                # TODO consider bwdif
-                ffmpeg_filters.append('yadif=1:-1:1')
-
-            if args.va:
-                ffmpeg_filters.append('setdar=dar={}'.format(args.va))
-
-            crop_args = None
-            if args.cr or args.cf:
-                if common_crop_args is not None:
-                    crop_args = common_crop_args
-                if crop_args_map is not None:
-                    crop_args = crop_args_map[video_track.source_file()]
-                if crop_args is None:
-                    os.system('ffmpegyag')
-                    while crop_args is None:
-                        try:
-                            crop_args = [int(x) for x in
-                                raw_input('Enter crop parameters (w:h:x:y): ').strip().split(':')]
-                        except:
-                            pass
-                    if args.sc:
-                        common_crop_args = crop_args
-            if crop_args is None or not crop_args:
-                crop_args = [video_track.width(), video_track.height(), 0, 0]
-            dw, dh, dx, dy = crop_args
-            if not VideoTrack.dimensions_correct(dw, dh):
-                platform.print_string(u'Adjusting crop by {}x{}'.format(dw % 16, dh % 8))
-                dw, dh, dx, dy = VideoTrack.correct_dimensions(dw, dh, dx, dy)
-            assert VideoTrack.dimensions_correct(dw, dh)
-            if dx > 0 or dy > 0 or dw != video_track.width() or dh != video_track.height():
-                ffmpeg_filters.append('crop={w}:{h}:{x}:{y}'.format(w=dw, h=dh, x=dx, y=dy))
-
-            # TODO support different resolutions
-            # TODO forbid upscale
-            if args.vs == '720p':
-                ffmpeg_filters.append('scale=1280:-8')
-            elif args.vs == '1080p':
-                ffmpeg_filters.append('scale=1920:-8')
-            elif args.vs == '1440p':  # TODO !!!!!!!!!!
-                ffmpeg_filters.append('scale=-16:1440')
-
-            src_colors = video_track.colors()
-            dst_color_space = src_colors.correct_space()
-            if args.ks:
-                dst_color_space = src_colors.space()
-            if src_colors.space() != dst_color_space:
-                raise cli.Error(u'Colorspace conversion from {} to {} not implemented'.format(src_colors.space(), dst_color_space))
-                # TODO specify input/output color_range
-                # TODO specify each input component separately
-                # TODO The input transfer characteristics, color space, color primaries and color range should be set on the input data
-                # TODO clarify iall=all= format string
-                # ffmpeg_filters.append('colorspace=iall={}:all={}'.format(src_color_space, dst_color_space))
-
-            ffmpeg_src_options = []
-
-            src_colors_range = src_colors.range()
-            if src_colors_range is not None:
-                ffmpeg_src_options.append('-color_range {}'.format(ffmpeg.build_color_range_argument(src_colors_range)))
-
-            ffmpeg_dst_options = ['-an', '-sn', '-dn']
-            if ffmpeg_filters:
-                ffmpeg_dst_options.append('-filter:v {}'.format(','.join(ffmpeg_filters)))
-            ffmpeg_dst_options.extend([
-                '-c:v {}'.format(ffmpeg.build_video_encoding_library_argument(target_video_codec)),
-                '-preset veryslow',
-                '-pix_fmt {}'.format(ffmpeg.build_picture_format_argument(PictureFormat.YUV420P)),
-                '-crf {}'.format(target_crf),
-                '-map_metadata -1', '-map_chapters -1',
-            ])
-
-            arg_profile = ffmpeg.build_video_codec_profile_argument(target_video_codec, target_video_profile)
-            arg_level = ffmpeg.build_video_codec_level_argument(target_video_codec, target_video_level)
-            if target_video_codec == VideoCodec.H264:
-                ffmpeg_dst_options.extend(['-profile:v {}'.format(arg_profile), '-level:v {}'.format(arg_level)])
-            elif target_video_codec == VideoCodec.H265:
-                ffmpeg_dst_options.append('-x265-params "profile={}:level={}"'.format(arg_profile, arg_level))
-
-            if target_tune is not None:
-                ffmpeg_dst_options.append('-tune {}'.format(target_tune))
-
-            if dst_color_space is not None and (video_track.is_hd() or src_colors.space() is not None):
+    def find_movie_targets():
+        target_paths = set()
+        seen_sources = None if args.dp else {}
+        for argspath in args.sources:
+            for movie_object in find_movies(argspath, args.il, not args.ds, probe_cache, library_scanner, seen_sources):
+                cur_path = os.path.normpath(os.path.relpath(movie_object.main_path(), platform.getcwd()))
+                if raw_crops_map is not None:
+                    crop_args_map[movie_object.main_path()] = raw_crops_map[os.path.splitext(cur_path)[0]]
+                if args.tv:
+                    movie_name = os.path.basename(movie_object.main_path())
+                    src_season = int(re.match(r'.*s(\d+)', movie_name, re.IGNORECASE).group(1))
+                    src_episodes = [int(x) for x in re.findall(r'e(\d+)', movie_name, re.IGNORECASE)]
+                    ep_numbers = []
+                    ep_names = set()
+                    for src_episode in src_episodes:
+                        ep_info = tvdb[args.tv][src_season][src_episode]
+                        epn_dvd = ep_info['dvdEpisodeNumber']
+                        epn_air = ep_info['airedEpisodeNumber']
+                        if epn_dvd is not None and epn_dvd != epn_air:
+                            epn_dvd_int = int(float(epn_dvd))
+                            epn_dvd_frc = float(epn_dvd) - epn_dvd_int
+                            assert int(epn_air) == int(round(epn_dvd_int + (epn_dvd_frc - 0.1) * 10)), 'd{} a{}'.format(epn_dvd, epn_air)
+                        ep_numbers.append(int(epn_air))
+                        ep_names.add(re.sub(r'\(\d\)$', '', ep_info['episodename']).strip())
+                    assert len(ep_numbers) > 0 and len(ep_names) == 1, ep_names
+                    cur_path = u'{} {}.mkv'.format('-'.join(u'{:02d}'.format(epn) for epn in sorted(ep_numbers)), list(ep_names)[0])
+                elif filenames_map is not None:
+                    raw_new_name_string = filenames_map[os.path.splitext(cur_path)[0]]
+                    cur_path = None
+                    if raw_new_name_string == 'NO': continue
+                    elif raw_new_name_string == 'KEEP': cur_path = cur_path
+                    else: cur_path = raw_new_name_string
+                if is_media_file_path(cur_path):
+                    cur_path = os.path.splitext(cur_path)[0]
+                new_name = u'{}.mkv'.format(platform.clean_filename(os.path.basename(cur_path)))
+                new_path = os.path.join(os.path.abspath(args.dst), os.path.dirname(cur_path), new_name)
+                assert new_path not in target_paths, new_path
+                target_paths.add(new_path)
+                yield new_path, movie_object
+
+    # the probe cache is trimmed and closed on errors and interrupts too
+    try:
+        movie_targets = find_movie_targets()
+        if not args.st:
+            movie_targets = sorted(movie_targets, key=lambda m: m[1].main_path())
+
+        output_track_specs = collections.OrderedDict([
+            ((TrackType.VID, False), ['und']),
+            ((TrackType.AUD, False), args.al),
+            ((TrackType.SUB, False), args.sl),
+            ((TrackType.SUB, True), args.fl),
+        ])
+
+        executor = None
+        if args.ex:
+            executor = jobs.JobExecutor(
+                dict(zip([cmd.Resource.CPU, cmd.Resource.DISK_READ, cmd.Resource.DISK_WRITE], args.ep)),
+                args.vj if args.ca else None)
+        if executor is None and not (args.ma and os.path.isfile(MUX_BODY)):
+            try:
+                os.remove(MUX_BODY)
+            except:
+                pass
+            shutil.copyfile(MUX_HEAD, MUX_BODY)
+
+        def write_script_commands(commands):
+            with codecs.open(MUX_BODY, 'a', 'utf-8') as body_file:
+                for command in commands:
+                    stop_statement = u'call :stop {}'.format(misc.random_printable(8))
+                    if command.max_exit_code == 0: prepared_commands = [u'{} || {}'.format(command.render(), stop_statement)]
+                    else: prepared_commands = [command.render(), u'if errorlevel {} {}'.format(command.max_exit_code + 1, stop_statement)]
+                    for prep_command in prepared_commands:
+                        body_file.write(u'{}\r\n'.format(prep_command))
+                body_file.write(u'\r\n')
+
+        executed_movies = []
+        created_directories = {}
+        # TODO catch some of my exceptions, report skipped file, ask for action, log skipped file
+        common_crop_args = None
+        movie_targets, prefetch_targets = itertools.tee(movie_targets)
+        prefetched_movies = media.prefetch_movies((movie for _, movie in prefetch_targets), args.pj)
+        for (target_path, _), movie in itertools.izip(movie_targets, prefetched_movies):
+            platform.print_string(u'=== {} ==='.format(movie.main_path()))
+            output_tracks = {}
+            for (track_type, _) in output_track_specs.iterkeys():
+                output_tracks[track_type] = []
+            used_tracks = set()
+            reference_duration = movie.reference_duration() or 0
+            duration_threshold = reference_duration / 100.0 * 20.0
+            for (track_type, search_forced), lang_list in output_track_specs.iteritems():
+                forced_string = 'Forced' if search_forced else 'Full'
+                for target_lang in lang_list:
+                    candidates = {}
+                    for track in movie.tracks(track_type):
+                        if track.qualified_id() in used_tracks: continue
+                        if track.language() not in (target_lang, 'und') and target_lang != 'und': continue
+                        if any(s in track.name().lower() for s in [u'comment', u'коммент']): continue
+                        if track.is_forced() is not None:
+                            if track.is_forced() != search_forced: continue
+                            if not track.is_forced() and track.duration() is not None:
+                                if reference_duration - track.duration() > duration_threshold: continue
+                        candidates[track.qualified_id()] = track
+                    if not candidates:
+                        if search_forced and args.fo: continue
+                        raise cli.Error(u'{} {} {} not found'.format(forced_string, track_type, target_lang))
+
+                    chosen_track_id = None
+                    if len(candidates) == 1: chosen_track_id = list(candidates.keys())[0]
+
+                    sorted_candidates = sorted(candidates.itervalues(), key=lambda t: t.qualified_id())
+                    if chosen_track_id not in candidates:
+                        candidates_by_index = {}
+                        for track in sorted_candidates:
+                            candidates_by_index[movie.track_index_in_type(track)] = track.qualified_id()
+                        header = u'--- {}, {}, {} ---'.format(
+                            track_type, target_lang.upper(), forced_string)
+                        # TODO if tv AND if tracks ids, names and codecs same as before then choose track automatically
+                        chosen_track_index = ask_to_select_tracks(movie, track_type, sorted_candidates, header)
+                        chosen_track_id = candidates_by_index[chosen_track_index]
+
+                    used_tracks.add(chosen_track_id)
+                    chosen_track = candidates[chosen_track_id]
+                    chosen_track.set_language(target_lang)
+                    chosen_track.set_forced(search_forced)
+                    output_tracks[track_type].append(chosen_track)
+
+            assert len(output_tracks[TrackType.VID]) == 1
+            video_track = output_tracks[TrackType.VID][0]
+
+            def track_sort_key(t):
+                lng_idx = output_track_specs[(t.type(), t.is_forced())].index(t.language())
+                return lng_idx + 1000 * int(t.is_forced())
+
+            track_sources = {}
+            for track_type, track_list in output_tracks.iteritems():
+                track_list.sort(key=track_sort_key)
+                for track in track_list:
+                    track_sources[track.qualified_id()] = [track.source_file(), track.id()]
+
+            movie_stages = []
+
+            def add_stage(name, dependencies=()):
+                stage = jobs.Job(u'{} [{}]'.format(movie.main_path(), name), [], dependencies)
+                movie_stages.append(stage)
+                return stage.commands
+
+            extract_commands = add_stage(u'extract')
+            extract_commands.append(cmd.Echo(movie.main_path()))
+            video_commands = add_stage(u'video')
+            mux_temporary_files = []
+
+            mux_dependencies = []
+            target_directory = os.path.dirname(target_path)
+            if not os.path.isdir(target_directory) and target_directory not in created_directories:
+                if executor is None:
+                    extract_commands.extend(cmd.gen_create_dir(target_directory))
+                    created_directories[target_directory] = None
+                else:
+                    created_directories[target_directory] = executor.submit(
+                        jobs.Job(target_directory, cmd.gen_create_dir(target_directory)))
+            if created_directories.get(target_directory) is not None:
+                mux_dependencies.append(created_directories[target_directory])
+
+            # extractions are collected per source file and tool, so each source is read once for all its tracks
+            track_extractions = collections.OrderedDict()
+
+            def make_single_track_file(track, stream_id, file_ext=None, ffmpeg_opts=None, prefer_ffmpeg=True):
+                if file_ext is None:
+                    file_ext = track.get_single_track_file_extension()
+                if ffmpeg_opts is None:
+                    ffmpeg_opts = ['-c:{} copy'.format(stream_id)]
+                if file_ext == platform.file_ext(track.source_file()) and track.is_single():
+                    return track.source_file(), False
+                tmp_path = platform.make_temporary_file(file_ext)
+                use_mkvextract = not prefer_ffmpeg and platform.file_ext(track.source_file()) == '.mkv'
+                track_extractions.setdefault((track.source_file(), use_mkvextract), []).append((track.id(), tmp_path, ffmpeg_opts))
+                return tmp_path, True
+
+            # copies a cached stage result into fresh temporary files, files of one artifact share the base name
+            def restore_artifact(stage_name, key):
+                cached_files = artifact_cache.get(key)
+                if cached_files is None:
+                    return None
+                commands = add_stage(stage_name)
+                base_path = os.path.splitext(platform.make_temporary_file(platform.file_ext(cached_files[0])))[0]
+                result = []
+                for cached_file in cached_files:
+                    result.append(base_path + platform.file_ext(cached_file))
+                    commands.extend(cmd.gen_copy_file(cached_file, result[-1]))
+                mux_temporary_files.extend(result)
+                return result
+
+            # TODO move to software abstraction
+            source_container_supported_by_mkvmerge = video_track.container_format() not in {FileFormat.x3GP, FileFormat.SMK, FileFormat.WMV}
+
+            source_video_codec = video_track.codec()
+            source_video_crf = video_track.crf()
+            source_video_profile = video_track.profile()
+            source_video_level = video_track.level()
+
+            target_video_codec = args.vc
+            target_video_profile, target_video_level = CODEC_FFMPEG_PARAMETERS[target_video_codec]
+
+            encoded_ok = source_video_codec == target_video_codec and \
+                source_video_crf is not None and \
+                source_video_profile == target_video_profile and \
+                source_video_level == target_video_level
+            if args.vr or args.vs or not encoded_ok and not args.vk:
+                ffmpeg = Ffmpeg()
+                target_crf, target_tune = CODEC_TUNES[target_video_codec][args.vt][args.vq]
+
+                # TODO check out rutracker manuals for dvd rip filters and stuff
+                ffmpeg_filters = []
+
+                assert video_track.field_order() is not None
+                if video_track.field_order() in (FieldOrder.INTERLACED_BOT, FieldOrder.INTERLACED_TOP):
+                    # TODO consider bwdif
+                    ffmpeg_filters.append('yadif=1:-1:1')
+
+                if args.va:
+                    ffmpeg_filters.append('setdar=dar={}'.format(args.va))
+
+                crop_args = None
+                if args.cr or args.cf:
+                    if common_crop_args is not None:
+                        crop_args = common_crop_args
+                    if crop_args_map is not None:
+                        crop_args = crop_args_map[video_track.source_file()]
+                    if crop_args is None:
+                        os.system('ffmpegyag')
+                        while crop_args is None:
+                            try:
+                                crop_args = [int(x) for x in
+                                    raw_input('Enter crop parameters (w:h:x:y): ').strip().split(':')]
+                            except:
+                                pass
+                        if args.sc:
+                            common_crop_args = crop_args
+                if crop_args is None or not crop_args:
+                    crop_args = [video_track.width(), video_track.height(), 0, 0]
+                dw, dh, dx, dy = crop_args
+                if not VideoTrack.dimensions_correct(dw, dh):
+                    platform.print_string(u'Adjusting crop by {}x{}'.format(dw % 16, dh % 8))
+                    dw, dh, dx, dy = VideoTrack.correct_dimensions(dw, dh, dx, dy)
+                assert VideoTrack.dimensions_correct(dw, dh)
+                if dx > 0 or dy > 0 or dw != video_track.width() or dh != video_track.height():
+                    ffmpeg_filters.append('crop={w}:{h}:{x}:{y}'.format(w=dw, h=dh, x=dx, y=dy))
+
+                # TODO support different resolutions
+                # TODO forbid upscale
+                if args.vs == '720p':
+                    ffmpeg_filters.append('scale=1280:-8')
+                elif args.vs == '1080p':
+                    ffmpeg_filters.append('scale=1920:-8')
+                elif args.vs == '1440p':  # TODO !!!!!!!!!!
+                    ffmpeg_filters.append('scale=-16:1440')
+
+                src_colors = video_track.colors()
+                dst_color_space = src_colors.correct_space()
+                if args.ks:
+                    dst_color_space = src_colors.space()
+                if src_colors.space() != dst_color_space:
+                    raise cli.Error(u'Colorspace conversion from {} to {} not implemented'.format(src_colors.space(), dst_color_space))
+                    # TODO specify input/output color_range
+                    # TODO specify each input component separately
+                    # TODO The input transfer characteristics, color space, color primaries and color range should be set on the input data
+                    # TODO clarify iall=all= format string
+                    # ffmpeg_filters.append('colorspace=iall={}:all={}'.format(src_color_space, dst_color_space))
+
+                ffmpeg_src_options = []
+
+                src_colors_range = src_colors.range()
+                if src_colors_range is not None:
+                    ffmpeg_src_options.append('-color_range {}'.format(ffmpeg.build_color_range_argument(src_colors_range)))
+
+                ffmpeg_dst_options = ['-an', '-sn', '-dn']
+                if ffmpeg_filters:
+                    ffmpeg_dst_options.append('-filter:v {}'.format(','.join(ffmpeg_filters)))
                 ffmpeg_dst_options.extend([
-                    # TODO "16-235 is a typical NTSC luma range. PAL always uses 0-255 luma range."
-                    '-color_range {}'.format(ffmpeg.build_color_range_argument(src_colors.range())),
-                    '-color_primaries {}'.format(ffmpeg.build_color_primaries_argument(dst_color_space)),
-                    '-color_trc {}'.format(ffmpeg.build_color_trc_argument(dst_color_space)),
-                    '-colorspace {}'.format(ffmpeg.build_color_space_argument(dst_color_space)),
+                    '-c:v {}'.format(ffmpeg.build_video_encoding_library_argument(target_video_codec)),
+                    '-preset veryslow',
+                    '-pix_fmt {}'.format(ffmpeg.build_picture_format_argument(PictureFormat.YUV420P)),
+                    '-crf {}'.format(target_crf),
+                    '-map_metadata -1', '-map_chapters -1',
                 ])
-            else:
-                assert not video_track.is_hd()
-
-            new_video_path = platform.make_temporary_file('.mkv')
-            result_commands.extend(
-                cmd.gen_ffmpeg_convert(video_track.source_file(), ffmpeg_src_options, new_video_path, ffmpeg_dst_options))
-            track_sources[video_track.qualified_id()] = [new_video_path, 0]
-            mux_temporary_files.append(new_video_path)
-        elif not source_container_supported_by_mkvmerge:
-            new_video_path, _ = make_single_track_file(video_track, Ffmpeg.STREAM_ARGUMENT_VID, '.mkv')
-            track_sources[video_track.qualified_id()] = [new_video_path, 0]
-            mux_temporary_files.append(new_video_path)
-
-        # TODO move to software abstraction
-        audio_codecs_to_denorm = {AudioCodec.AC3, AudioCodec.DTS}
-        audio_codecs_to_uncompress = {
-            AudioCodec.AAC_HE, AudioCodec.AAC_HE_V2, AudioCodec.AAC_LC,
-            AudioCodec.AMR, AudioCodec.OPUS, AudioCodec.SPEEX, AudioCodec.COOK, AudioCodec.ASAO,
-            AudioCodec.ADPCM_SWF, AudioCodec.PCM_MULAW, AudioCodec.PCM_S16B,
-            AudioCodec.VORBIS, AudioCodec.SMK,
-            AudioCodec.WMA_PRO, AudioCodec.WMA_V2,
-        }
-        audio_codecs_to_recode = {
-            AudioCodec.AMR, AudioCodec.ASAO, AudioCodec.OPUS, AudioCodec.SPEEX, AudioCodec.COOK,
-            AudioCodec.EAC3, AudioCodec.DTS_ES, AudioCodec.DTS_HRA, AudioCodec.DTS_MA, AudioCodec.TRUE_HD,
-            AudioCodec.ADPCM_IMA, AudioCodec.ADPCM_MS, AudioCodec.ADPCM_SWF, AudioCodec.PCM_MULAW, AudioCodec.PCM_S16B, AudioCodec.PCM_S16L, AudioCodec.PCM_S24L,
-            AudioCodec.FLAC, AudioCodec.MP2, AudioCodec.VORBIS, AudioCodec.SMK,
-            AudioCodec.WMA_PRO, AudioCodec.WMA_V2
-        }
 
-        max_audio_channels = CHANNEL_SCHEMES[args.ad]
-        for track in output_tracks[TrackType.AUD]:
-            need_extract = not source_container_supported_by_mkvmerge
-            need_denorm = track.codec() in audio_codecs_to_denorm
-            need_downmix = track.channels() > max_audio_channels
-            need_recode = need_downmix or track.codec() in audio_codecs_to_recode or args.ar and track.codec() != AudioCodec.AAC_LC
-            need_uncompress = track.codec() in audio_codecs_to_uncompress or args.aw
-
-            if need_extract or need_denorm or need_downmix or need_recode:
-
-                stf_ext = None
-                stf_ffmpeg_opts = None
-                if need_uncompress:
-                    stf_ext = '.wav'
-                    stf_ffmpeg_opts = ['-f wav', '-rf64 auto']
-                src_track_file, is_src_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_AUD, stf_ext, stf_ffmpeg_opts)
-
-                eac_track_file = src_track_file
-                if need_denorm or need_downmix or need_recode:
-                    eac_track_file = platform.make_temporary_file('.wav' if need_recode else platform.file_ext(src_track_file))
+                x265_params = []
+                arg_profile = ffmpeg.build_video_codec_profile_argument(target_video_codec, target_video_profile)
+                arg_level = ffmpeg.build_video_codec_level_argument(target_video_codec, target_video_level)
+                if target_video_codec == VideoCodec.H264:
+                    ffmpeg_dst_options.extend(['-profile:v {}'.format(arg_profile), '-level:v {}'.format(arg_level)])
+                elif target_video_codec == VideoCodec.H265:
+                    x265_params = ['profile={}'.format(arg_profile), 'level={}'.format(arg_level)]
+
+                if target_tune is not None:
+                    ffmpeg_dst_options.append('-tune {}'.format(target_tune))
+
+                if dst_color_space is not None and (video_track.is_hd() or src_colors.space() is not None):
+                    ffmpeg_dst_options.extend([
+                        # TODO "16-235 is a typical NTSC luma range. PAL always uses 0-255 luma range."
+                        '-color_range {}'.format(ffmpeg.build_color_range_argument(src_colors.range())),
+                        '-color_primaries {}'.format(ffmpeg.build_color_primaries_argument(dst_color_space)),
+                        '-color_trc {}'.format(ffmpeg.build_color_trc_argument(dst_color_space)),
+                        '-colorspace {}'.format(ffmpeg.build_color_space_argument(dst_color_space)),
+                    ])
+                else:
+                    assert not video_track.is_hd()
+
+                # thread options follow the schedule only, so they are kept out of the cache key
+                video_key = artifact_cache.key(
+                    video_track.source_file(), video_track.id(), ffmpeg_src_options + ffmpeg_dst_options + x265_params)
+                threads_options, x265_threads_params = [], []
+                if args.vj is not None:
+                    threads_options, x265_threads_params = ffmpeg.build_video_threads_arguments(target_video_codec, args.vj)
+                ffmpeg_dst_options.extend(threads_options)
+                if target_video_codec == VideoCodec.H265:
+                    ffmpeg_dst_options.append('-x265-params "{}"'.format(':'.join(x265_params + x265_threads_params)))
+                restored_files = restore_artifact(u'video', video_key)
+                if restored_files is not None:
+                    new_video_path = restored_files[0]
+                else:
+                    new_video_path = platform.make_temporary_file('.mkv')
+                    video_commands.extend(
+                        cmd.gen_ffmpeg_convert(video_track.source_file(), ffmpeg_src_options, new_video_path, ffmpeg_dst_options))
+                    video_commands.extend(artifact_cache.gen_store(video_key, [new_video_path]))
+                    mux_temporary_files.append(new_video_path)
+                track_sources[video_track.qualified_id()] = [new_video_path, 0]
+            elif not source_container_supported_by_mkvmerge:
+                new_video_path, _ = make_single_track_file(video_track, Ffmpeg.STREAM_ARGUMENT_VID, '.mkv')
+                track_sources[video_track.qualified_id()] = [new_video_path, 0]
+                mux_temporary_files.append(new_video_path)
+
+            # TODO move to software abstraction
+            audio_codecs_to_denorm = {AudioCodec.AC3, AudioCodec.DTS}
+            audio_codecs_to_uncompress = {
+                AudioCodec.AAC_HE, AudioCodec.AAC_HE_V2, AudioCodec.AAC_LC,
+                AudioCodec.AMR, AudioCodec.OPUS, AudioCodec.SPEEX, AudioCodec.COOK, AudioCodec.ASAO,
+                AudioCodec.ADPCM_SWF, AudioCodec.PCM_MULAW, AudioCodec.PCM_S16B,
+                AudioCodec.VORBIS, AudioCodec.SMK,
+                AudioCodec.WMA_PRO, AudioCodec.WMA_V2,
+            }
+            audio_codecs_to_recode = {
+                AudioCodec.AMR, AudioCodec.ASAO, AudioCodec.OPUS, AudioCodec.SPEEX, AudioCodec.COOK,
+                AudioCodec.EAC3, AudioCodec.DTS_ES, AudioCodec.DTS_HRA, AudioCodec.DTS_MA, AudioCodec.TRUE_HD,
+                AudioCodec.ADPCM_IMA, AudioCodec.ADPCM_MS, AudioCodec.ADPCM_SWF, AudioCodec.PCM_MULAW, AudioCodec.PCM_S16B, AudioCodec.PCM_S16L, AudioCodec.PCM_S24L,
+                AudioCodec.FLAC, AudioCodec.MP2, AudioCodec.VORBIS, AudioCodec.SMK,
+                AudioCodec.WMA_PRO, AudioCodec.WMA_V2
+            }
+
+            max_audio_channels = CHANNEL_SCHEMES[args.ad]
+            qaac_opts = ['--tvbr 91', '--quality 2', '--rate keep', '--no-delay']
+            # source file -> graph outputs, every transcoded track of a source comes out of a single decode
+            audio_graphs = collections.OrderedDict()
+            ffmpeg = Ffmpeg()
+            for track in output_tracks[TrackType.AUD]:
+                need_extract = not source_container_supported_by_mkvmerge
+                need_denorm = track.codec() in audio_codecs_to_denorm
+                need_downmix = track.channels() > max_audio_channels
+                need_recode = need_downmix or track.codec() in audio_codecs_to_recode or args.ar and track.codec() != AudioCodec.AAC_LC
+                need_uncompress = track.codec() in audio_codecs_to_uncompress or args.aw
+
+                # ffmpeg decoders leave dialnorm unapplied, so decoding and encoding replaces eac3to denormalization
+                if args.ag and (need_denorm or need_downmix or need_recode):
+                    filters = []
+                    if track.delay() > 0:
+                        filters.append('adelay=delays={}:all=1'.format(track.delay()))
+                    elif track.delay() < 0:
+                        filters.append('atrim=start={},asetpts=PTS-STARTPTS'.format(-track.delay() / 1000.0))
+                    channels = min(track.channels(), max_audio_channels)
+                    if need_downmix:
+                        filters.append('aresample=out_chlayout={}'.format(ffmpeg.build_audio_channel_layout_argument(channels)))
+                    aac_opts = ['-c:a aac', '-b:a {}'.format(ffmpeg.build_aac_bitrate_argument(channels))]
+                    audio_key = artifact_cache.key(track.source_file(), track.id(), [u'graph', filters, aac_opts])
+                    restored_files = restore_artifact(u'audio {}:{}'.format(os.path.basename(track.source_file()), track.id()), audio_key)
+                    if restored_files is not None:
+                        m4a_track_file = restored_files[0]
+                    else:
+                        m4a_track_file = platform.make_temporary_file('.m4a')
+                        audio_graphs.setdefault(track.source_file(), []).append((track.id(), filters, m4a_track_file, aac_opts, audio_key))
+                        mux_temporary_files.append(m4a_track_file)
+                    track_sources[track.qualified_id()] = [m4a_track_file, 0]
+                    continue
+
+                if need_extract or need_denorm or need_downmix or need_recode:
                     eac_opts = []
                     if need_downmix:
                         if max_audio_channels == 1:
@@ -554,135 +703,246 @@ def main():
                             raise cli.Error(u'Unhandled channels num {}'.format(max_audio_channels))
                     if track.delay() != 0:
                         eac_opts.append('{}{}ms'.format('+' if track.delay() > 0 else '-', abs(track.delay())))
-                    result_commands.append(u'call eac3to {} {} {}'.format(
-                        cmd.quote(src_track_file), cmd.quote(eac_track_file), ' '.join(eac_opts)))
-                    if is_src_track_file_temporary:
-                        result_commands.extend(cmd.gen_del_files(args.sd, src_track_file))
-
-                dst_track_file = eac_track_file
-                if need_downmix and max_audio_channels == 1:
-                    mono_track_file = platform.make_temporary_file('.wav')
-                    result_commands.extend(cmd.gen_ffmpeg_convert(eac_track_file, [], mono_track_file, ['-ac 1']))
-                    result_commands.extend(cmd.gen_del_files(args.sd, eac_track_file))
-                    dst_track_file = mono_track_file
-
-                if need_recode:
-                    m4a_track_file = platform.make_temporary_file('.m4a')
-                    qaac_opts = ['--tvbr 91', '--quality 2', '--rate keep', '--no-delay']
-                    qaac = u'qaac64 {} {} -o {}'.format(u' '.join(qaac_opts), cmd.quote(dst_track_file), cmd.quote(m4a_track_file))
-                    result_commands.append(qaac)
-                    result_commands.extend(cmd.gen_del_files(args.sd, dst_track_file))
-                    dst_track_file = m4a_track_file
-
-                mux_temporary_files.append(dst_track_file)
-                track_sources[track.qualified_id()] = [dst_track_file, 0]
-
-        for track in output_tracks[TrackType.SUB]:
-            if track.is_text():
-                ffmpeg_opts = None
-                if track.codec() == SubtitleCodec.MOV:
-                    ffmpeg_opts = []
-                track_file, is_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_SUB, ffmpeg_opts=ffmpeg_opts)
-                srt_file = platform.make_temporary_file('.srt')
-                result_commands.append(u'{python} {script} {src_path} {dst_path}'.format(
-                    python=sys.executable, script=cmd.quote(os.path.join(os.path.dirname(__file__), 'any2srt.py')),
-                    src_path=cmd.quote(track_file), dst_path=cmd.quote(srt_file)))
-                track_sources[track.qualified_id()] = [srt_file, 0]
-                track.set_encoding(lang.norm_encoding('utf-8'))
-                mux_temporary_files.append(srt_file)
-                if is_track_file_temporary:
-                    result_commands.extend(cmd.gen_del_files(args.sd, track_file))
-            elif track.codec() == SubtitleCodec.PGS:
-                track_file, is_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_SUB, prefer_ffmpeg=False)
-                idx_file = platform.make_temporary_file('.idx')
-                sub_file = u'{}.sub'.format(os.path.splitext(idx_file)[0])
-                result_commands.extend(cmd.gen_bdsup2sub(track_file, idx_file, lang.alpha2(track.language())))
-                track_sources[track.qualified_id()] = [idx_file, 0]
-                mux_temporary_files.extend([idx_file, sub_file])
-                if is_track_file_temporary:
-                    result_commands.extend(cmd.gen_del_files(args.sd, track_file))
-
-        mux_path = platform.make_temporary_file('.mkv')
-
-        # TODO add cover to files
-        mux = ['call', 'mkvmerge']
-        mux.extend(['--output', cmd.quote(mux_path)])
-        mux.extend(['--no-track-tags', '--no-global-tags', '--disable-track-statistics-tags'])
-
-        track_ids_by_files = {}
-        for qualified_id, (source_file, source_file_track_id) in track_sources.iteritems():
-            track_ids_by_files.setdefault(source_file, {})[qualified_id] = source_file_track_id
-        if source_container_supported_by_mkvmerge:
-            track_ids_by_files.setdefault(video_track.source_file(), {})
-
-        # TODO tracks need to be extracted from 3gp and wmv containers before passing to mkvmerge
-        source_file_ids = {}
-        for i, (source_file, track_ids_map) in enumerate(track_ids_by_files.iteritems()):
-            source_file_ids[source_file] = i
-            for track_type, (tracks_flags_yes, tracks_flag_no) in Track.TYPE_FLAGS.iteritems():
-                cur_file_tracks = [track for track in output_tracks[track_type] if track.qualified_id() in track_ids_map]
-                if cur_file_tracks:
-                    if tracks_flags_yes:
-                        mux.append('{} {}'.format(tracks_flags_yes, ','.join(str(track_ids_map[track.qualified_id()]) for track in cur_file_tracks)))
-                    for track in cur_file_tracks:
-                        default = track.qualified_id() == output_tracks[track_type][0].qualified_id()
-                        file_track_id = track_ids_map[track.qualified_id()]
-                        mux.append('--track-name {0}:""'.format(file_track_id))
-                        if track_type == TrackType.SUB and track.encoding() is not None:
-                            mux.append('--sub-charset {0}:{1}'.format(file_track_id, track.encoding()))
-                        mux.append('--language {0}:{1}'.format(file_track_id, track.language()))
-                        mux.append('--default-track {0}:{1}'.format(file_track_id, 'yes' if default else 'no'))
-                        if track.is_forced():
-                            mux.append('--forced-track {0}:yes'.format(file_track_id))
-                elif tracks_flag_no:
-                    mux.append(tracks_flag_no)
-            file_flags = ['--no-track-tags', '--no-attachments', '--no-buttons', '--no-global-tags']
-            if source_file != video_track.source_file():
-                file_flags.append('--no-chapters')
-            mux.append(u'{} {}'.format(u' '.join(file_flags), cmd.quote(source_file)))
-
-        mux.append('--title ""')
-
-        track_order = []
-        for track_type in [TrackType.VID, TrackType.AUD, TrackType.SUB]:
-            for track in output_tracks[track_type]:
-                source_file, source_file_track_id = track_sources[track.qualified_id()]
-                track_order.append('{}:{}'.format(source_file_ids[source_file], source_file_track_id))
-        mux.append('--track-order {}'.format(','.join(track_order)))
-
-        result_commands.append(u' '.join(mux))
-        if len(mux_temporary_files) > 0:
-            result_commands.extend(cmd.gen_del_files(args.sd, *sorted(set(mux_temporary_files))))
-
-        # TODO mark mkv file with mkvexport version
-        if movie.chapters_path() is not None:
-            result_commands.append(u'mkvpropedit --chapters {} {}'.format(
-                cmd.quote(movie.chapters_path()), cmd.quote(mux_path)))
-
-        clean_mux_path = platform.make_temporary_file('.mkv')
-        result_commands.append(u'call mkclean {} {}'.format(cmd.quote(mux_path), cmd.quote(clean_mux_path)))
-        result_commands.extend(cmd.gen_del_files(args.sd, mux_path))
-        result_commands.extend(cmd.gen_move_file(clean_mux_path, target_path, args.sd))
-
-        if args.xx:
-            result_commands.extend(cmd.gen_del_files(
-                args.sd,
-                *sorted(set(media_file.path() for media_file in movie.media_files()))))
-
-        allowed_exit_codes = {'robocopy': 1, 'mkvmerge': 1}
-        with codecs.open(MUX_BODY, 'a', 'utf-8') as body_file:
-            for command in result_commands:
-                fail_exit_code = 1
-                for program, code in allowed_exit_codes.iteritems():
-                    if program in command.lower():
-                        fail_exit_code = code + 1
-                stop_statement = u'call :stop {}'.format(misc.random_printable(8))
-                if fail_exit_code == 1: prepared_commands = [u'{} || {}'.format(command.strip(), stop_statement)]
-                else: prepared_commands = [command.strip(), u'if errorlevel {} {}'.format(fail_exit_code, stop_statement)]
-                for prep_command in prepared_commands:
-                    body_file.write(u'{}\r\n'.format(prep_command))
-            body_file.write(u'\r\n')
 
+                    # decoded audio only flows through pipes, the encoded m4a is the one file written;
+                    # batch only checks the exit code of the last pipeline stage, so scripts keep the wav files
+                    use_pipe = need_recode and not args.aw and executor is not None
+                    ffmpeg_opts = []
+                    if use_pipe and not need_denorm:
+                        if track.delay() > 0:
+                            ffmpeg_opts.append('-filter:a adelay=delays={}:all=1'.format(track.delay()))
+                        elif track.delay() < 0:
+                            ffmpeg_opts.append('-filter:a atrim=start={},asetpts=PTS-STARTPTS'.format(-track.delay() / 1000.0))
+                        if need_downmix:
+                            ffmpeg_opts.append('-ac {}'.format(max_audio_channels))
+
+                    audio_stage_name = u'audio {}:{}'.format(os.path.basename(track.source_file()), track.id())
+                    audio_key = None
+                    if need_denorm or need_downmix or need_recode:
+                        # the ffmpeg and eac3to chains produce different audio, so they never share an artifact
+                        backend = [u'pipe', ffmpeg_opts] if use_pipe and not need_denorm else [u'eac3to', eac_opts]
+                        audio_key = artifact_cache.key(track.source_file(), track.id(), [
+                            need_denorm, need_downmix, need_recode, need_uncompress, max_audio_channels, track.delay(), qaac_opts] + backend)
+                        restored_files = restore_artifact(audio_stage_name, audio_key)
+                        if restored_files is not None:
+                            track_sources[track.qualified_id()] = [restored_files[0], 0]
+                            continue
+                    audio_commands = add_stage(audio_stage_name)
+
+                    if use_pipe:
+                        m4a_track_file = platform.make_temporary_file('.m4a')
+                        wav_opts = ['-f wav', '-rf64 auto']
+                        # the source is read by the shared extract stage, decoding starts from the single track file
+                        src_track_file, is_src_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_AUD)
+                        if need_denorm:
+                            pipeline = [cmd.Command([u'eac3to', src_track_file, u'stdout.wav'] + eac_opts, inputs=[src_track_file])]
+                            if need_downmix and max_audio_channels == 1:
+                                pipeline.extend(cmd.gen_ffmpeg_convert(u'-', [], u'-', ['-ac 1'] + wav_opts))
+                        else:
+                            map_opts = ['-vn', '-sn', '-dn', '-map_metadata -1', '-map_chapters -1',
+                                        '-map 0:{}'.format(0 if is_src_track_file_temporary else track.id())]
+                            pipeline = cmd.gen_ffmpeg_convert(src_track_file, [], u'-', map_opts + ffmpeg_opts + wav_opts)
+                        pipeline.append(cmd.Command(
+                            [u'qaac64'] + cmd.split_options(qaac_opts + ['--ignorelength']) + [u'-', u'-o', m4a_track_file],
+                            outputs=[m4a_track_file]))
+                        audio_commands.append(cmd.Pipeline(pipeline, cmd.Resource.CPU))
+                        audio_commands.extend(artifact_cache.gen_store(audio_key, [m4a_track_file]))
+                        if is_src_track_file_temporary:
+                            audio_commands.extend(cmd.gen_del_files(args.sd, src_track_file))
+                        mux_temporary_files.append(m4a_track_file)
+                        track_sources[track.qualified_id()] = [m4a_track_file, 0]
+                        continue
+
+                    stf_ext = None
+                    stf_ffmpeg_opts = None
+                    if need_uncompress:
+                        stf_ext = '.wav'
+                        stf_ffmpeg_opts = ['-f wav', '-rf64 auto']
+                    src_track_file, is_src_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_AUD, stf_ext, stf_ffmpeg_opts)
+
+                    eac_track_file = src_track_file
+                    if need_denorm or need_downmix or need_recode:
+                        eac_track_file = platform.make_temporary_file('.wav' if need_recode else platform.file_ext(src_track_file))
+                        audio_commands.append(cmd.Command(
+                            [u'eac3to', src_track_file, eac_track_file] + eac_opts, cmd.Resource.CPU, [src_track_file], [eac_track_file]))
+                        if is_src_track_file_temporary:
+                            audio_commands.extend(cmd.gen_del_files(args.sd, src_track_file))
+                    dst_track_file = eac_track_file
+                    if need_downmix and max_audio_channels == 1:
+                        mono_track_file = platform.make_temporary_file('.wav')
+                        audio_commands.extend(cmd.gen_ffmpeg_convert(eac_track_file, [], mono_track_file, ['-ac 1']))
+                        audio_commands.extend(cmd.gen_del_files(args.sd, eac_track_file))
+                        dst_track_file = mono_track_file
+
+                    if need_recode:
+                        m4a_track_file = platform.make_temporary_file('.m4a')
+                        audio_commands.append(cmd.Command(
+                            [u'qaac64'] + cmd.split_options(qaac_opts) + [dst_track_file, u'-o', m4a_track_file],
+                            cmd.Resource.CPU, [dst_track_file], [m4a_track_file]))
+                        audio_commands.extend(cmd.gen_del_files(args.sd, dst_track_file))
+                        dst_track_file = m4a_track_file
+
+                    if audio_key is not None:
+                        audio_commands.extend(artifact_cache.gen_store(audio_key, [dst_track_file]))
+                    mux_temporary_files.append(dst_track_file)
+                    track_sources[track.qualified_id()] = [dst_track_file, 0]
+
+            for source_file, outputs in audio_graphs.iteritems():
+                graph_commands = add_stage(u'audio {}'.format(os.path.basename(source_file)))
+                graph_commands.extend(cmd.gen_ffmpeg_audio_graph(
+                    source_file, [(track_id, filters, dst_file, dst_opts) for track_id, filters, dst_file, dst_opts, _ in outputs]))
+                for _, _, dst_file, _, audio_key in outputs:
+                    graph_commands.extend(artifact_cache.gen_store(audio_key, [dst_file]))
+
+            for track in output_tracks[TrackType.SUB]:
+                subtitle_stage_name = u'subtitle {}:{}'.format(os.path.basename(track.source_file()), track.id())
+                if track.is_text():
+                    ffmpeg_opts = None
+                    if track.codec() == SubtitleCodec.MOV:
+                        ffmpeg_opts = []
+                    track.set_encoding(lang.norm_encoding('utf-8'))
+                    subtitle_key = artifact_cache.key(track.source_file(), track.id(), [u'srt', ffmpeg_opts])
+                    restored_files = restore_artifact(subtitle_stage_name, subtitle_key)
+                    if restored_files is not None:
+                        track_sources[track.qualified_id()] = [restored_files[0], 0]
+                        continue
+                    subtitle_commands = add_stage(subtitle_stage_name)
+                    track_file, is_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_SUB, ffmpeg_opts=ffmpeg_opts)
+                    srt_file = platform.make_temporary_file('.srt')
+                    subtitle_commands.append(cmd.Command(
+                        [sys.executable, os.path.join(os.path.dirname(__file__), 'any2srt.py'), track_file, srt_file],
+                        inputs=[track_file], outputs=[srt_file]))
+                    subtitle_commands.extend(artifact_cache.gen_store(subtitle_key, [srt_file]))
+                    track_sources[track.qualified_id()] = [srt_file, 0]
+                    mux_temporary_files.append(srt_file)
+                    if is_track_file_temporary:
+                        subtitle_commands.extend(cmd.gen_del_files(args.sd, track_file))
+                elif track.codec() == SubtitleCodec.PGS:
+                    subtitle_key = artifact_cache.key(track.source_file(), track.id(), [u'idx', lang.alpha2(track.language())])
+                    restored_files = restore_artifact(subtitle_stage_name, subtitle_key)
+                    if restored_files is not None:
+                        track_sources[track.qualified_id()] = [restored_files[0], 0]
+                        continue
+                    subtitle_commands = add_stage(subtitle_stage_name)
+                    track_file, is_track_file_temporary = make_single_track_file(track, Ffmpeg.STREAM_ARGUMENT_SUB, prefer_ffmpeg=False)
+                    idx_file = platform.make_temporary_file('.idx')
+                    sub_file = u'{}.sub'.format(os.path.splitext(idx_file)[0])
+                    subtitle_commands.extend(cmd.gen_bdsup2sub(track_file, idx_file, lang.alpha2(track.language())))
+                    subtitle_commands.extend(artifact_cache.gen_store(subtitle_key, [idx_file, sub_file]))
+                    track_sources[track.qualified_id()] = [idx_file, 0]
+                    mux_temporary_files.extend([idx_file, sub_file])
+                    if is_track_file_temporary:
+                        subtitle_commands.extend(cmd.gen_del_files(args.sd, track_file))
+
+            for (source_file, use_mkvextract), extractions in track_extractions.iteritems():
+                if use_mkvextract:
+                    extract_commands.extend(cmd.gen_mkvtoolnix_extract_tracks(
+                        source_file, [(track_id, tmp_path) for track_id, tmp_path, _ in extractions]))
+                else:
+                    extract_commands.extend(cmd.gen_ffmpeg_extract_tracks(source_file, extractions))
+            extract_stage = movie_stages[0]
+            for stage in movie_stages[1:]:
+                if stage.inputs().intersection(extract_stage.outputs()):
+                    stage.dependencies.append(extract_stage)
+
+            mux_path = platform.make_temporary_file('.mkv')
+
+            # TODO add cover to files
+            mux = ['mkvmerge']
+            mux.extend(['--output', mux_path])
+            mux.extend(['--no-track-tags', '--no-global-tags', '--disable-track-statistics-tags'])
+
+            track_ids_by_files = {}
+            for qualified_id, (source_file, source_file_track_id) in track_sources.iteritems():
+                track_ids_by_files.setdefault(source_file, {})[qualified_id] = source_file_track_id
+            if source_container_supported_by_mkvmerge:
+                track_ids_by_files.setdefault(video_track.source_file(), {})
+
+            # TODO tracks need to be extracted from 3gp and wmv containers before passing to mkvmerge
+            source_file_ids = {}
+            for i, (source_file, track_ids_map) in enumerate(track_ids_by_files.iteritems()):
+                source_file_ids[source_file] = i
+                for track_type, (tracks_flags_yes, tracks_flag_no) in Track.TYPE_FLAGS.iteritems():
+                    cur_file_tracks = [track for track in output_tracks[track_type] if track.qualified_id() in track_ids_map]
+                    if cur_file_tracks:
+                        if tracks_flags_yes:
+                            mux.extend([tracks_flags_yes, ','.join(str(track_ids_map[track.qualified_id()]) for track in cur_file_tracks)])
+                        for track in cur_file_tracks:
+                            default = track.qualified_id() == output_tracks[track_type][0].qualified_id()
+                            file_track_id = track_ids_map[track.qualified_id()]
+                            mux.extend(['--track-name', '{0}:'.format(file_track_id)])
+                            if track_type == TrackType.SUB and track.encoding() is not None:
+                                mux.extend(['--sub-charset', '{0}:{1}'.format(file_track_id, track.encoding())])
+                            mux.extend(['--language', '{0}:{1}'.format(file_track_id, track.language())])
+                            mux.extend(['--default-track', '{0}:{1}'.format(file_track_id, 'yes' if default else 'no')])
+                            if track.is_forced():
+                                mux.extend(['--forced-track', '{0}:yes'.format(file_track_id)])
+                    elif tracks_flag_no:
+                        mux.append(tracks_flag_no)
+                file_flags = ['--no-track-tags', '--no-attachments', '--no-buttons', '--no-global-tags']
+                if source_file != video_track.source_file():
+                    file_flags.append('--no-chapters')
+                mux.extend(file_flags + [source_file])
+
+            mux.extend(['--title', ''])
+
+            track_order = []
+            for track_type in [TrackType.VID, TrackType.AUD, TrackType.SUB]:
+                for track in output_tracks[track_type]:
+                    source_file, source_file_track_id = track_sources[track.qualified_id()]
+                    track_order.append('{}:{}'.format(source_file_ids[source_file], source_file_track_id))
+            mux.extend(['--track-order', ','.join(track_order)])
+
+            mux_command = cmd.Command(mux, cmd.Resource.DISK_WRITE, sorted(source_file_ids), [mux_path], max_exit_code=1)
+            mux_commands = add_stage(u'mux', mux_dependencies + [
+                stage for stage in movie_stages if stage.outputs().intersection(mux_command.inputs)])
+            mux_commands.append(mux_command)
+            if len(mux_temporary_files) > 0:
+                mux_commands.extend(cmd.gen_del_files(args.sd, *sorted(set(mux_temporary_files))))
+
+            # TODO mark mkv file with mkvexport version
+            if movie.chapters_path() is not None:
+                mux_commands.append(cmd.Command(
+                    [u'mkvpropedit', u'--chapters', movie.chapters_path(), mux_path], inputs=[movie.chapters_path(), mux_path],
+                    outputs=[mux_path]))
+
+            clean_mux_path = platform.make_temporary_file('.mkv')
+            mux_commands.append(cmd.Command(
+                [u'mkclean', mux_path, clean_mux_path], cmd.Resource.DISK_WRITE, [mux_path], [clean_mux_path]))
+            mux_commands.extend(cmd.gen_del_files(args.sd, mux_path))
+            mux_commands.extend(cmd.gen_move_file(clean_mux_path, target_path, args.sd))
+
+            if args.xx:
+                mux_commands.extend(cmd.gen_del_files(
+                    args.sd,
+                    *sorted(set(media_file.path() for media_file in movie.media_files()))))
+
+            if executor is not None:
+                for stage in movie_stages:
+                    executor.submit(stage)
+                executed_movies.append((movie_stages[-1], [media_file.path() for media_file in movie.media_files()]))
+            else:
+                write_script_commands(itertools.chain.from_iterable(stage.commands for stage in movie_stages))
+            movie.release()
+    finally:
+        probe_cache.close()
+    if executor is not None:
+        try:
+            executor.wait()
+        finally:
+            # files of failed movies stay out of the index, so the next incremental scan reports them again
+            if library_scanner is not None:
+                library_scanner.commit(itertools.chain.from_iterable(
+                    movie_files for mux_stage, movie_files in executed_movies if not executor.succeeded(mux_stage)))
+                library_scanner.close()
+        artifact_cache.evict()
+    elif library_scanner is not None:
+        # the index is updated by the script itself, after all of its movies went through
+        pending_path = platform.make_temporary_file('.pickle')
+        library_scanner.save_pending(pending_path)
+        library_scanner.close()
+        write_script_commands([cmd.Command([
+            sys.executable, os.path.join(os.path.dirname(__file__), 'modules', 'scanner.py'), library_db_path, pending_path])])
     return 0
 
 
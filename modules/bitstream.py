@@ -0,0 +1,330 @@
+import mmap
+import re
+
+_RE_EMULATION_PREVENTION = re.compile(b'\x00\x00\x03')
+_RE_ENCODER_SETTINGS = re.compile(br'(?:(x264) - core (\d+)|(x265) \(build (\d+)\))[\x20-\x7e]*? - options: ([\x20-\x7e]*)')
+
+ENCODER_SETTINGS_SCAN_SIZE = 4 * 1024 * 1024
+
+_AVC_HIGH_PROFILES = {44, 83, 86, 100, 110, 118, 122, 128, 134, 135, 138, 139, 144, 244}
+
+_AVC_PROFILE_NAMES = {
+    44: 'CAVLC 4:4:4',
+    66: 'Baseline',
+    77: 'Main',
+    88: 'Extended',
+    100: 'High',
+    110: 'High 10',
+    122: 'High 4:2:2',
+    244: 'High 4:4:4 Predictive',
+}
+
+_AVC_INTRA_PROFILE_NAMES = {
+    110: 'High 10 Intra',
+    122: 'High 4:2:2 Intra',
+    244: 'High 4:4:4 Intra',
+}
+
+_CHROMA_FORMAT_NAMES = {
+    0: 'gray',
+    1: 'yuv420p',
+    2: 'yuv422p',
+    3: 'yuv444p',
+}
+
+COLOR_PRIMARIES_NAMES = {
+    1: 'bt709',
+    4: 'bt470m',
+    5: 'bt470bg',
+    6: 'smpte170m',
+    7: 'smpte240m',
+    8: 'film',
+    9: 'bt2020',
+}
+
+COLOR_TRANSFER_NAMES = {
+    1: 'bt709',
+    4: 'gamma22',
+    5: 'gamma28',
+    6: 'smpte170m',
+    7: 'smpte240m',
+    8: 'linear',
+    13: 'iec61966-2-1',
+    14: 'bt2020-10',
+    15: 'bt2020-12',
+    16: 'smpte2084',
+    18: 'arib-std-b67',
+}
+
+COLOR_SPACE_NAMES = {
+    0: 'gbr',
+    1: 'bt709',
+    4: 'fcc',
+    5: 'bt470bg',
+    6: 'smpte170m',
+    7: 'smpte240m',
+    9: 'bt2020nc',
+    10: 'bt2020c',
+}
+
+_AAC_PROFILE_NAMES = {
+    1: 'Main',
+    2: 'LC',
+    3: 'SSR',
+    4: 'LTP',
+    5: 'HE-AAC',
+    23: 'LD',
+    29: 'HE-AACv2',
+    39: 'ELD',
+}
+
+_DTS_CORE_SYNC = b'\x7f\xfe\x80\x01'
+_DTS_SUBSTREAM_SYNC = b'\x64\x58\x20\x25'
+_DTS_XLL_SYNC = b'\x41\xa2\x95\x47'
+_DTS_XCH_SYNC = b'\x5a\x5a\x5a\x5a'
+_DTS_XXCH_SYNC = b'\x47\x00\x4a\x03'
+_DTS_X96_SYNC = b'\x1d\x95\xf2\x62'
+
+_AAC_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+
+class BitReader(object):
+    def __init__(self, data):
+        self._data = bytearray(data)
+        self._pos = 0
+
+    def bits_left(self):
+        return len(self._data) * 8 - self._pos
+
+    def read(self, n):
+        if n > self.bits_left():
+            raise ValueError('Unexpected end of bitstream')
+        result = 0
+        for _ in xrange(n):
+            byte = self._data[self._pos >> 3]
+            result = (result << 1) | ((byte >> (7 - (self._pos & 7))) & 1)
+            self._pos += 1
+        return result
+
+    def read_ue(self):
+        zeros = 0
+        while self.read(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError('Invalid exp-golomb code')
+        return (1 << zeros) - 1 + self.read(zeros)
+
+    def read_se(self):
+        value = self.read_ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+def unescape_nal(data):
+    return _RE_EMULATION_PREVENTION.sub(b'\x00\x00', data)
+
+def _skip_avc_scaling_list(reader, size):
+    last_scale = next_scale = 8
+    for _ in xrange(size):
+        if next_scale != 0:
+            next_scale = (last_scale + reader.read_se() + 256) % 256
+        if next_scale != 0:
+            last_scale = next_scale
+
+def _skip_avc_hrd_parameters(reader):
+    cpb_count = reader.read_ue() + 1
+    reader.read(8)
+    for _ in xrange(cpb_count):
+        reader.read_ue()
+        reader.read_ue()
+        reader.read(1)
+    reader.read(20)
+
+def parse_avc_sps(nal):
+    reader = BitReader(unescape_nal(nal[1:]))
+    profile_idc = reader.read(8)
+    constraint_flags = reader.read(8)
+    level_idc = reader.read(8)
+    reader.read_ue()
+
+    chroma_format_idc = 1
+    bit_depth = 8
+    if profile_idc in _AVC_HIGH_PROFILES:
+        chroma_format_idc = reader.read_ue()
+        if chroma_format_idc == 3:
+            reader.read(1)
+        bit_depth = reader.read_ue() + 8
+        reader.read_ue()
+        reader.read(1)
+        if reader.read(1):
+            for i in xrange(8 if chroma_format_idc != 3 else 12):
+                if reader.read(1):
+                    _skip_avc_scaling_list(reader, 16 if i < 6 else 64)
+
+    reader.read_ue()
+    pic_order_cnt_type = reader.read_ue()
+    if pic_order_cnt_type == 0:
+        reader.read_ue()
+    elif pic_order_cnt_type == 1:
+        reader.read(1)
+        reader.read_se()
+        reader.read_se()
+        for _ in xrange(reader.read_ue()):
+            reader.read_se()
+    reader.read_ue()
+    reader.read(1)
+    reader.read_ue()
+    reader.read_ue()
+    frame_mbs_only = reader.read(1)
+    if not frame_mbs_only:
+        reader.read(1)
+    reader.read(1)
+    if reader.read(1):
+        for _ in xrange(4):
+            reader.read_ue()
+
+    full_range = False
+    colors = {}
+    pic_struct_present = False
+    if reader.read(1):
+        if reader.read(1):
+            if reader.read(8) == 255:
+                reader.read(32)
+        if reader.read(1):
+            reader.read(1)
+        if reader.read(1):
+            reader.read(3)
+            full_range = bool(reader.read(1))
+            colors['color_range'] = 'pc' if full_range else 'tv'
+            if reader.read(1):
+                for key, names in (('color_primaries', COLOR_PRIMARIES_NAMES),
+                                   ('color_transfer', COLOR_TRANSFER_NAMES),
+                                   ('color_space', COLOR_SPACE_NAMES)):
+                    value = names.get(reader.read(8))
+                    if value is not None:
+                        colors[key] = value
+        if reader.read(1):
+            reader.read_ue()
+            reader.read_ue()
+        if reader.read(1):
+            reader.read(65)
+        nal_hrd = reader.read(1)
+        if nal_hrd:
+            _skip_avc_hrd_parameters(reader)
+        vcl_hrd = reader.read(1)
+        if vcl_hrd:
+            _skip_avc_hrd_parameters(reader)
+        if nal_hrd or vcl_hrd:
+            reader.read(1)
+        pic_struct_present = bool(reader.read(1))
+
+    profile = _AVC_PROFILE_NAMES.get(profile_idc)
+    if profile_idc == 66 and constraint_flags & 0x40:
+        profile = 'Constrained Baseline'
+    elif profile_idc in _AVC_INTRA_PROFILE_NAMES and constraint_flags & 0x10:
+        profile = _AVC_INTRA_PROFILE_NAMES[profile_idc]
+
+    pix_fmt = _CHROMA_FORMAT_NAMES.get(chroma_format_idc)
+    if pix_fmt is not None and chroma_format_idc != 0:
+        if bit_depth > 8:
+            pix_fmt = '{}{}le'.format(pix_fmt, bit_depth)
+        elif full_range:
+            pix_fmt = pix_fmt.replace('yuv', 'yuvj')
+
+    result = {'level': level_idc, 'pix_fmt': pix_fmt}
+    if profile is not None:
+        result['profile'] = profile
+    if frame_mbs_only and not pic_struct_present:
+        result['field_order'] = 'progressive'
+    result.update(colors)
+    return result
+
+def parse_avc_decoder_config(data):
+    data = bytearray(data)
+    if len(data) < 8 or data[0] != 1:
+        raise ValueError('Invalid AVC decoder configuration record')
+    sps_count = data[5] & 0x1f
+    if sps_count < 1:
+        raise ValueError('AVC decoder configuration record has no SPS')
+    sps_length = (data[6] << 8) | data[7]
+    return parse_avc_sps(bytes(data[8:8 + sps_length]))
+
+def parse_aac_config(data):
+    reader = BitReader(data)
+    object_type = reader.read(5)
+    if object_type == 31:
+        object_type = 32 + reader.read(6)
+    sample_rate_index = reader.read(4)
+    sample_rate = reader.read(24) if sample_rate_index == 15 else _AAC_SAMPLE_RATES[sample_rate_index]
+    channel_config = reader.read(4)
+    if object_type in (5, 29):
+        if reader.read(4) == 15:
+            reader.read(24)
+    elif object_type == 2 and channel_config != 0 and reader.bits_left() >= 3 + 11 + 5 + 1:
+        reader.read(1)
+        if reader.read(1):
+            reader.read(14)
+        reader.read(1)
+        if reader.bits_left() >= 11 + 5 + 1 and reader.read(11) == 0x2b7 and reader.read(5) == 5 and reader.read(1):
+            object_type = 5
+            if reader.read(4) == 15:
+                reader.read(24)
+            if reader.bits_left() >= 12 and reader.read(11) == 0x548 and reader.read(1):
+                object_type = 29
+    return {'profile': _AAC_PROFILE_NAMES.get(object_type), 'sample_rate': sample_rate, 'channel_config': channel_config}
+
+def parse_dts_profile(frame):
+    frame = bytes(frame)
+    if not frame.startswith(_DTS_CORE_SYNC) or len(frame) < 10:
+        return None
+    header = BitReader(frame[4:10])
+    header.read(14)
+    frame_size = header.read(14) + 1
+    core = frame[:frame_size]
+    substream = frame[frame_size:]
+    if substream.startswith(_DTS_SUBSTREAM_SYNC):
+        return 'DTS-HD MA' if _DTS_XLL_SYNC in substream else 'DTS-HD HRA'
+    if _DTS_XCH_SYNC in core[16:] or _DTS_XXCH_SYNC in core[16:]:
+        return 'DTS-ES'
+    if _DTS_X96_SYNC in core[16:]:
+        return 'DTS 96/24'
+    return 'DTS'
+
+def parse_encoder_settings(data, pos=0, endpos=None):
+    endpos = len(data) if endpos is None else endpos
+    match = _RE_ENCODER_SETTINGS.search(data, pos, endpos)
+    if match is None:
+        return None
+
+    options = {}
+    for option in match.group(5).split():
+        key, sep, value = option.partition('=')
+        options[key] = value if sep else True
+    rate_control = options.get('rc')
+    crf = options.get('crf') if rate_control == 'crf' else None
+    return {
+        'encoder': match.group(1) or match.group(3),
+        'build': int(match.group(2) or match.group(4)),
+        'rate_control': rate_control,
+        'crf': float(crf) if crf is not None else None,
+        'qp': float(options['qp']) if rate_control == 'cqp' and 'qp' in options else None,
+        'bitrate': int(options['bitrate']) if rate_control in ('abr', 'cbr') and 'bitrate' in options else None,
+        'options': options,
+    }
+
+# payload_offset(data) points at the first frame data of the container, the file start is scanned when nothing is found there
+def read_encoder_settings(media_path, scan_size=ENCODER_SETTINGS_SCAN_SIZE, payload_offset=None):
+    with open(media_path, 'rb') as fobj:
+        try:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            return None
+        try:
+            starts = [0]
+            offset = payload_offset(data) if payload_offset is not None else None
+            if offset:
+                starts.insert(0, offset)
+            for start in starts:
+                result = parse_encoder_settings(data, start, min(start + scan_size, len(data)))
+                if result is not None:
+                    return result
+            return None
+        finally:
+            data.close()
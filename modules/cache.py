@@ -0,0 +1,182 @@
+import cPickle as pickle
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import cmd
+import fingerprint
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return u'{}:{!r}:{}'.format(stat.st_size, stat.st_mtime, stat.st_ino)
+
+# probes are keyed by content fingerprint, so they survive renames and copies between shares;
+# fingerprints themselves are remembered per path and recomputed only when the file stat changes
+class ProbeCache(object):
+    DEFAULT_MAX_ENTRIES = 200000
+    SCHEMA_VERSION = 1
+
+    def __init__(self, db_path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self._memory = {}
+        self._fingerprints = {}
+        self._max_entries = max_entries
+        self._db = None
+        if db_path is not None:
+            db_dir = os.path.dirname(db_path)
+            if not os.path.isdir(db_dir):
+                os.makedirs(db_dir)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            if self._db.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+                for table in ('probes', 'content_probes', 'fingerprints'):
+                    self._db.execute('DROP TABLE IF EXISTS {}'.format(table))
+                self._db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS content_probes ('
+                'kind TEXT, fingerprint TEXT, value BLOB, atime REAL, PRIMARY KEY (kind, fingerprint))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS content_probes_atime ON content_probes (atime)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, stat TEXT, fingerprint TEXT, atime REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS fingerprints_atime ON fingerprints (atime)')
+            self._db.commit()
+
+    # tables are trimmed once per run, least recently used entries go first
+    def _trim(self, table):
+        excess = self._db.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0] - self._max_entries
+        if excess > 0:
+            self._db.execute(
+                'DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} ORDER BY atime LIMIT ?)'.format(table), (excess,))
+
+    def fingerprint(self, path):
+        stat = _file_stat(path)
+        with self._lock:
+            entry = self._fingerprints.get(path)
+            if entry is None and self._db is not None:
+                entry = self._db.execute('SELECT stat, fingerprint FROM fingerprints WHERE path = ?', (path,)).fetchone()
+                if entry is not None and entry[0] == stat:
+                    self._db.execute('UPDATE fingerprints SET atime = ? WHERE path = ?', (time.time(), path))
+            if entry is not None and entry[0] == stat:
+                self._fingerprints[path] = entry
+                return entry[1]
+
+        value = fingerprint.fingerprint(path)
+        with self._lock:
+            self._fingerprints[path] = (stat, value)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO fingerprints (path, stat, fingerprint, atime) VALUES (?, ?, ?, ?)',
+                    (path, stat, value, time.time()))
+                self._db.commit()
+        return value
+
+    def _load(self, kind, identity):
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            'SELECT value FROM content_probes WHERE kind = ? AND fingerprint = ?', (kind, identity)).fetchone()
+        if row is None:
+            return None
+        self._db.execute(
+            'UPDATE content_probes SET atime = ? WHERE kind = ? AND fingerprint = ?', (time.time(), kind, identity))
+        return identity, pickle.loads(str(row[0]))
+
+    def _store(self, kind, identity, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO content_probes (kind, fingerprint, value, atime) VALUES (?, ?, ?, ?)',
+            (kind, identity, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), time.time()))
+        self._db.commit()
+
+    def get(self, kind, path, compute):
+        identity = self.fingerprint(path)
+        with self._lock:
+            entry = self._memory.get(path, {}).get(kind)
+            if entry is None or entry[0] != identity:
+                entry = self._load(kind, identity)
+                if entry is not None:
+                    self._memory.setdefault(path, {})[kind] = entry
+            if entry is not None:
+                return entry[1]
+
+        value = compute(path)
+        with self._lock:
+            self._memory.setdefault(path, {})[kind] = (identity, value)
+            if self._db is not None:
+                self._store(kind, identity, value)
+        return value
+
+    def release(self, path, kind=None):
+        with self._lock:
+            if kind is not None:
+                self._memory.get(path, {}).pop(kind, None)
+                return
+            self._memory.pop(path, None)
+            self._fingerprints.pop(path, None)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._trim('content_probes')
+                self._trim('fingerprints')
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+# each artifact is a directory named by its key, its mtime is the last use time for LRU eviction
+class ArtifactCache(object):
+    _PARTIAL_SUFFIX = u'.part'
+
+    def __init__(self, cache_dir=None, max_size=0, fingerprint_file=fingerprint.fingerprint):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._fingerprint_file = fingerprint_file
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, source_file, track_id, params):
+        if self._cache_dir is None:
+            return None
+        data = json.dumps([self._fingerprint_file(source_file), track_id, params], sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self._cache_dir is None:
+            return None
+        artifact_dir = os.path.join(self._cache_dir, key)
+        if not os.path.isdir(artifact_dir):
+            return None
+        os.utime(artifact_dir, None)
+        return [os.path.join(artifact_dir, name) for name in sorted(os.listdir(artifact_dir))]
+
+    # files are copied into a partial directory renamed at the end, so an interrupted store never looks like a hit;
+    # every step is skipped once the artifact exists, another movie or run may have stored the same key meanwhile
+    def gen_store(self, key, files):
+        if self._cache_dir is None:
+            return []
+        artifact_dir = os.path.join(self._cache_dir, key)
+        if os.path.isdir(artifact_dir):
+            return []
+        partial_dir = artifact_dir + self._PARTIAL_SUFFIX
+        steps = [cmd.RemoveDir(partial_dir)] + cmd.gen_create_dir(partial_dir)
+        for i, path in enumerate(files):
+            steps.extend(cmd.gen_copy_file(path, os.path.join(partial_dir, u'{}{}'.format(i, os.path.splitext(path)[1]))))
+        steps.append(cmd.Rename(partial_dir, key))
+        return [cmd.IfNotExists(artifact_dir, step) for step in steps] + [cmd.RemoveDir(partial_dir)]
+
+    def evict(self):
+        if self._cache_dir is None:
+            return
+        entries = []
+        for name in os.listdir(self._cache_dir):
+            artifact_dir = os.path.join(self._cache_dir, name)
+            size = sum(os.path.getsize(os.path.join(artifact_dir, file_name)) for file_name in os.listdir(artifact_dir))
+            entries.append((os.path.getmtime(artifact_dir), size, artifact_dir))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, artifact_dir in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+            total_size -= size
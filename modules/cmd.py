@@ -1,10 +1,172 @@
+import distutils.spawn
 import json
 import os
-import re
+import shutil
 import xml.dom.minidom
 
+import misc
 import platform
 
+class Resource(misc.MyEnum):
+    CPU = misc.MyEnum.auto()
+    DISK_READ = misc.MyEnum.auto()
+    DISK_WRITE = misc.MyEnum.auto()
+
+# programs installed as batch wrappers have to be called from scripts
+_BATCH_CALL_PROGRAMS = {'eac3to', 'mkclean', 'mkvmerge'}
+
+# CreateProcess can not start batch files, so the wrappers are run through the command interpreter
+def _executable_argv(argv):
+    if argv[0] in _BATCH_CALL_PROGRAMS and platform.is_windows():
+        return [u'cmd', u'/c'] + argv
+    return argv
+
+class Command(object):
+    __slots__ = ('argv', 'env', 'max_exit_code', 'resource', 'inputs', 'outputs')
+
+    def __init__(self, argv, resource=None, inputs=(), outputs=(), max_exit_code=0, env=None):
+        self.argv = [unicode(arg) for arg in argv]
+        self.env = env or {}
+        self.max_exit_code = max_exit_code
+        self.resource = resource
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    # batch has no per command environment, variables stay set for the following commands
+    def render(self):
+        prefix = u''.join(u'set "{}={}" && '.format(name, value) for name, value in sorted(self.env.iteritems()))
+        if self.argv[0] in _BATCH_CALL_PROGRAMS:
+            prefix += u'call '
+        return prefix + u' '.join(quote(arg) if arg else u'""' for arg in self.argv)
+
+    def execute(self, cores=None):
+        return platform.call(_executable_argv(self.argv), self.env, cores)
+
+    def is_failed(self, exit_code):
+        return exit_code != 0 if self.max_exit_code == 0 else exit_code > self.max_exit_code
+
+class Pipeline(Command):
+    __slots__ = ('_commands',)
+
+    def __init__(self, commands, resource=None):
+        Command.__init__(self, commands[0].argv, resource,
+                         [path for command in commands for path in command.inputs if path != '-'],
+                         [path for command in commands for path in command.outputs if path != '-'])
+        self._commands = commands
+
+    def render(self):
+        return u' | '.join(command.render() for command in self._commands)
+
+    def execute(self, cores=None):
+        return platform.call_pipeline([(_executable_argv(command.argv), command.env) for command in self._commands], cores)
+
+class Echo(Command):
+    __slots__ = ()
+
+    def __init__(self, text):
+        Command.__init__(self, [u'echo', text])
+
+    def render(self):
+        return u'echo {}'.format(quote(self.argv[1]))
+
+    def execute(self, cores=None):
+        platform.print_string(self.argv[1])
+        return 0
+
+class DeleteFiles(Command):
+    __slots__ = ()
+
+    def __init__(self, paths):
+        Command.__init__(self, [u'del', u'/q'] + list(paths))
+
+    def execute(self, cores=None):
+        for path in self.argv[2:]:
+            if os.path.isfile(path):
+                os.remove(path)
+        return 0
+
+class IfExists(Command):
+    __slots__ = ('_path', '_command')
+
+    def __init__(self, path, command):
+        Command.__init__(self, command.argv, command.resource, command.inputs, command.outputs,
+                         command.max_exit_code, command.env)
+        self._path = path
+        self._command = command
+
+    def render(self):
+        return u'if exist {} {}'.format(quote(self._path), self._command.render())
+
+    def execute(self, cores=None):
+        return self._command.execute(cores) if os.path.exists(self._path) else 0
+
+# the command is skipped when the path exists, also when it appeared while the command failed
+class IfNotExists(IfExists):
+    __slots__ = ()
+
+    def render(self):
+        return u'if not exist {} {}'.format(quote(self._path), self._command.render())
+
+    def execute(self, cores=None):
+        if os.path.exists(self._path):
+            return 0
+        try:
+            return self._command.execute(cores)
+        except OSError:
+            if os.path.exists(self._path):
+                return 0
+            raise
+
+class CreateDir(Command):
+    __slots__ = ()
+
+    def __init__(self, path):
+        Command.__init__(self, [u'mkdir', path], outputs=[path])
+
+    def render(self):
+        return u'if not exist {path} mkdir {path}'.format(path=quote(self.argv[1]))
+
+    def execute(self, cores=None):
+        try:
+            os.makedirs(self.argv[1])
+        except OSError:
+            if not os.path.isdir(self.argv[1]):
+                raise
+        return 0
+
+class RemoveDir(Command):
+    __slots__ = ()
+
+    def __init__(self, path):
+        Command.__init__(self, [u'rmdir', u'/s', u'/q', path])
+
+    def render(self):
+        return u'if exist {path} rmdir /s /q {path}'.format(path=quote(self.argv[3]))
+
+    def execute(self, cores=None):
+        shutil.rmtree(self.argv[3], ignore_errors=True)
+        return 0
+
+class CopyFile(Command):
+    __slots__ = ()
+
+    def __init__(self, src_file, dst_file):
+        Command.__init__(self, [u'copy', u'/y', src_file, dst_file], Resource.DISK_WRITE, [src_file], [dst_file])
+
+    def execute(self, cores=None):
+        shutil.copyfile(self.argv[2], self.argv[3])
+        return 0
+
+class Rename(Command):
+    __slots__ = ()
+
+    def __init__(self, path, name):
+        Command.__init__(self, [u'ren', path, name], inputs=[path], outputs=[os.path.join(os.path.dirname(path), name)])
+
+    def execute(self, cores=None):
+        os.rename(self.argv[1], self.outputs[0])
+        return 0
+
 def quote(path):
     if path == '-':
         return path
@@ -17,76 +179,150 @@ def quote(path):
             q = u'"'
     return q + path + q
 
-def escape(path):
-    return re.sub(r'\^?&', u'^&', path)
+# ['-map 0:1', '-x265-params "a=1:b=2"'] -> ['-map', '0:1', '-x265-params', 'a=1:b=2']
+def split_options(options):
+    result = []
+    for option in options:
+        name, _, value = option.partition(u' ')
+        result.append(name)
+        if value:
+            result.append(value[1:-1] if len(value) > 1 and value[0] == value[-1] == '"' else value)
+    return result
 
 def gen_del_files(delete_securely=False, *args):
-    template = u'sdelete -r -nobanner {}' if delete_securely else u'del /q {}'
-    return [template.format(' '.join(quote(p) for p in args))]
+    if delete_securely:
+        return [Command([u'sdelete', u'-r', u'-nobanner'] + list(args), Resource.DISK_WRITE)]
+    return [DeleteFiles(args)]
 
 def gen_move_file(src_file, dst_file, delete_securely=False):
+    moved_file = os.path.join(os.path.dirname(dst_file), os.path.basename(src_file))
     return [
-        u'robocopy {src_folder} {dst_folder} {src_name} /Z /NS /NC /NDL /NJH /NJS'.format(
-            src_folder=quote(os.path.dirname(src_file)),
-            dst_folder=quote(os.path.dirname(dst_file)),
-            src_name=quote(os.path.basename(src_file))),
-        u'if exist {dst_file} {del_command}'.format(
-            dst_file=quote(dst_file),
-            del_command=gen_del_files(delete_securely, dst_file)[0]),
+        Command([u'robocopy', os.path.dirname(src_file), os.path.dirname(dst_file), os.path.basename(src_file),
+                 u'/Z', u'/NS', u'/NC', u'/NDL', u'/NJH', u'/NJS'],
+                Resource.DISK_WRITE, [src_file], [moved_file], max_exit_code=1),
+        IfExists(dst_file, gen_del_files(delete_securely, dst_file)[0]),
         gen_del_files(delete_securely, src_file)[0],
-        u'ren {src_file} {dst_name}'.format(
-            src_file=quote(os.path.join(os.path.dirname(dst_file), os.path.basename(src_file))),
-            dst_name=quote(os.path.basename(dst_file))),
+        Rename(moved_file, os.path.basename(dst_file)),
     ]
 
+def gen_copy_file(src_file, dst_file):
+    return [CopyFile(src_file, dst_file)]
+
 def gen_create_dir(dir_path):
-    return [u'if not exist {path} mkdir {path}'.format(path=quote(dir_path))]
+    return [CreateDir(dir_path)]
 
-def _make_whitespaced_args_string(args):
-    result = u' '
-    if args:
-        result = u' {} '.format(' '.join(args))
-    return result
+def gen_ffmpeg_convert(src_file, src_opts, dst_file, dst_opts, resource=Resource.CPU):
+    argv = [u'ffmpeg', u'-v', u'error', u'-stats', u'-y'] + split_options(src_opts) + [u'-i', src_file] + \
+        split_options(dst_opts) + [dst_file]
+    return [Command(argv, resource, [src_file], [dst_file])]
 
-def gen_ffmpeg_convert(src_file, src_opts, dst_file, dst_opts):
-    return [u'ffmpeg -v error -stats -y{src_opts}-i {src}{dst_opts}{dst}'.format(
-        src=quote(src_file), src_opts=_make_whitespaced_args_string(src_opts),
-        dst=quote(dst_file), dst_opts=_make_whitespaced_args_string(dst_opts))]
+def gen_mkvtoolnix_extract_tracks(src_file, tracks):
+    argv = [u'mkvextract', src_file, u'tracks'] + [u'{}:{}'.format(track_id, dst_file) for track_id, dst_file in tracks]
+    return [Command(argv, Resource.DISK_READ, [src_file], [dst_file for _, dst_file in tracks])]
 
-def gen_mkvtoolnix_extract_track(src_file, dst_file, track_id):
-    return [u'mkvextract {src_file} tracks {track_id}:{dst_file}'.format(
-        src_file=quote(src_file), track_id=track_id, dst_file=quote(dst_file))]
+# tracks are (track id, destination file, output options), all written by a single pass over the source
+def gen_ffmpeg_extract_tracks(src_file, tracks):
+    argv = [u'ffmpeg', u'-v', u'error', u'-stats', u'-y', u'-i', src_file]
+    for track_id, dst_file, dst_opts in tracks:
+        argv.extend(split_options(['-map_metadata -1', '-map_chapters -1', '-map 0:{}'.format(track_id)] + dst_opts))
+        argv.append(dst_file)
+    return [Command(argv, Resource.DISK_READ, [src_file], [dst_file for _, dst_file, _ in tracks])]
 
-def gen_ffmpeg_extract_track(src_file, dst_file, track_id, src_opts=None, dst_opts=None):
-    if src_opts is None: src_opts = []
-    if dst_opts is None: dst_opts = []
-    return gen_ffmpeg_convert(
-        src_file, [] + src_opts,
-        dst_file, ['-map_metadata -1', '-map_chapters -1', '-map 0:{}'.format(track_id)] + dst_opts)
+# outputs are (track id, filter chain, destination file, output options), the source is decoded once for all of them
+def gen_ffmpeg_audio_graph(src_file, outputs):
+    graph = u';'.join(u'[0:{}]{}[a{}]'.format(track_id, u','.join(filters) or u'anull', i)
+                      for i, (track_id, filters, _, _) in enumerate(outputs))
+    argv = [u'ffmpeg', u'-v', u'error', u'-stats', u'-y', u'-i', src_file, u'-filter_complex', graph]
+    for i, (_, _, dst_file, dst_opts) in enumerate(outputs):
+        argv.extend([u'-map', u'[a{}]'.format(i)] + split_options(['-map_metadata -1', '-map_chapters -1'] + dst_opts))
+        argv.append(dst_file)
+    return [Command(argv, Resource.CPU, [src_file], [dst_file for _, _, dst_file, _ in outputs])]
 
 def gen_bdsup2sub(src_file, dst_file, language):
-    return [u'java -jar {jar} -l {lng} -o {dst} {src}'.format(
-        jar=quote(platform.execute('where bdsup2sub.jar').strip()),
-        lng=language, dst=quote(dst_file), src=quote(src_file))]
+    jar = platform.execute([u'where', u'bdsup2sub.jar']).strip()
+    sub_file = u'{}.sub'.format(os.path.splitext(dst_file)[0])
+    return [Command([u'java', u'-jar', jar, u'-l', language, u'-o', dst_file, src_file],
+                    Resource.CPU, [src_file], [dst_file, sub_file])]
 
-def ffprobe(media_path, stream_ids):
-    tracks = {}
+_FFPROBE_WINDOWS = [
+    (2 * 1024 * 1024, int(2e+6)),
+    (50 * 1024 * 1024, int(3e+7)),
+]
+
+_FFPROBE_HEADERLESS_FORMATS = {'flv', 'mpeg', 'mpegts', 'mpegvideo'}
+_FFPROBE_HEADERLESS_EXTENSIONS = {'.flv', '.m2ts', '.mpeg', '.mpg', '.mts', '.ts', '.vob'}
+
+_FFPROBE_REQUIRED_FIELDS = {
+    'video': ['width', 'height', 'r_frame_rate', 'pix_fmt'],
+    'audio': ['channels', 'start_pts'],
+}
+
+_FFPROBE_REQUIRED_CODEC_FIELDS = {
+    'aac': ['profile'],
+    'dts': ['profile'],
+    'h264': ['profile', 'level', 'field_order'],
+    'hevc': ['profile', 'level', 'field_order'],
+    'mpeg1video': ['field_order'],
+    'mpeg2video': ['field_order'],
+    'vc1': ['field_order'],
+}
+
+_FFPROBE_MISSING_VALUES = {
+    'channels': [0],
+    'field_order': ['unknown'],
+    'level': [-99],
+    'height': [0],
+    'pix_fmt': ['none'],
+    'r_frame_rate': ['0/0'],
+    'width': [0],
+}
+
+def is_ffprobe_stream_complete(stream):
+    fields = _FFPROBE_REQUIRED_FIELDS.get(stream['codec_type'], []) + \
+        _FFPROBE_REQUIRED_CODEC_FIELDS.get(stream.get('codec_name'), [])
+    return all(field in stream and stream[field] not in _FFPROBE_MISSING_VALUES.get(field, []) for field in fields)
+
+def _run_ffprobe(media_path, probe_size, analyze_duration):
     ffprobe_opts = [
         u'-v quiet',
         u'-print_format json',
-        u'-probesize {}'.format(50 * 1024 * 1024),
-        u'-analyzeduration {}'.format(int(3e+7)),
+        u'-probesize {}'.format(probe_size),
+        u'-analyzeduration {}'.format(analyze_duration),
+        u'-show_format',
         u'-show_streams',
+        u'-show_chapters',
     ]
-    for stream_specifier in stream_ids:
-        command = u'ffprobe {opts} -select_streams {stream} {path}'.format(
-            opts=u' '.join(ffprobe_opts), stream=stream_specifier, path=quote(media_path))
-        for stream in json.loads(platform.execute(command))['streams']:
-            tracks[stream['index']] = stream
-    return tracks
+    result = json.loads(platform.execute([u'ffprobe'] + split_options(ffprobe_opts) + [media_path]))
+    for key, default in (('format', {}), ('streams', []), ('chapters', [])):
+        result.setdefault(key, default)
+    return result
+
+def ffprobe(media_path):
+    file_size = os.path.getsize(media_path)
+    windows = _FFPROBE_WINDOWS
+    # headerless formats never settle within the small window, go straight to the large one
+    if file_size > windows[0][0] and os.path.splitext(media_path)[1].lower() in _FFPROBE_HEADERLESS_EXTENSIONS:
+        windows = windows[1:]
+    result = None
+    for probe_size, analyze_duration in windows:
+        result = _run_ffprobe(media_path, probe_size, analyze_duration)
+        if file_size <= probe_size:
+            break
+        if result['format'].get('format_name') not in _FFPROBE_HEADERLESS_FORMATS and \
+                all(is_ffprobe_stream_complete(stream) for stream in result['streams']):
+            break
+    return result
+
+_has_mediainfo = None
+
+def has_mediainfo():
+    global _has_mediainfo
+    if _has_mediainfo is None:
+        _has_mediainfo = distutils.spawn.find_executable('mediainfo') is not None
+    return _has_mediainfo
 
 def mediainfo(media_path):
-    doc = xml.dom.minidom.parseString(platform.execute(u'mediainfo --Output=XML {}'.format(quote(media_path))))
+    doc = xml.dom.minidom.parseString(platform.execute([u'mediainfo', u'--Output=XML', media_path]))
     media_info = doc.getElementsByTagName('MediaInfo')[0]
     media = media_info.getElementsByTagName('media')[0]
     tracks = {}
@@ -113,10 +349,3 @@ def mediainfo(media_path):
             track_data['ID'] = int(track_data.get('ID', 1)) - 1
             tracks[track_data['ID']] = track_data
     return {'tracks': tracks, 'general': general}
-
-# TODO fix this
-def detect_crf(movie_path):
-    ffmpeg = u'ffmpeg -i {} -an -vframes 1 -f null - -v 48 2>&1'.format(quote(movie_path))
-    stdout = platform.execute(ffmpeg)
-    match = re.search(r'crf=(?P<crf>[\d.]+)', stdout)
-    return float(match.groupdict()['crf']) if match else None
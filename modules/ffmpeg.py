@@ -1,8 +1,16 @@
 from formats import PictureFormat, ColorSpace, ColorRange, VideoCodec, VideoCodecProfile, VideoCodecLevel, FieldOrder, \
-    TrackType
+    TrackType, FileFormat
 from misc import flip_dict
 
+def _flip_codec_levels(codec, levels):
+    result = flip_dict(levels)
+    if codec == VideoCodec.H265:
+        result = {level: int(argument / 3) for level, argument in result.iteritems()}
+    return result
+
 class Ffmpeg(object):
+    __slots__ = ()
+
     STREAM_ARGUMENT_AUD = 'a'
     STREAM_ARGUMENT_SUB = 's'
     STREAM_ARGUMENT_VID = 'V'
@@ -14,6 +22,51 @@ class Ffmpeg(object):
         'chapters': TrackType.CHA,
     }
 
+    _FILE_FORMAT_RAW_TO_ENUM = {
+        'ac3': FileFormat.AC3,
+        'amr': FileFormat.AMR,
+        'asf': FileFormat.WMV,
+        'ass': FileFormat.SSA,
+        'avi': FileFormat.AVI,
+        'dts': FileFormat.DTS,
+        'dtshd': FileFormat.DTS,
+        'eac3': FileFormat.EAC3,
+        'flac': FileFormat.FLAC,
+        'flv': FileFormat.FLV,
+        'matroska,webm': FileFormat.MKV,
+        'mp3': FileFormat.MP3,
+        'mpeg': FileFormat.MPG,
+        'mpegts': FileFormat.TS,
+        'rm': FileFormat.RM,
+        'smk': FileFormat.SMK,
+        'srt': FileFormat.SRT,
+        'sup': FileFormat.SUP,
+        'wav': FileFormat.WAV,
+    }
+
+    _ISOBMFF_FORMAT_RAW = 'mov,mp4,m4a,3gp,3g2,mj2'
+
+    _ISOBMFF_BRAND_RAW_TO_ENUM = {
+        '3gg6': FileFormat.x3GP,
+        '3gp4': FileFormat.x3GP,
+        '3gp5': FileFormat.x3GP,
+        '3gp6': FileFormat.x3GP,
+        'avc1': FileFormat.MP4,
+        'iso2': FileFormat.MP4,
+        'iso4': FileFormat.MP4,
+        'iso5': FileFormat.MP4,
+        'iso6': FileFormat.MP4,
+        'isom': FileFormat.MP4,
+        'm4a': FileFormat.M4A,
+        'm4v': FileFormat.M4V,
+        'm4vh': FileFormat.M4V,
+        'm4vp': FileFormat.M4V,
+        'mp41': FileFormat.MP4,
+        'mp42': FileFormat.MP4,
+        'msnv': FileFormat.MP4,
+        'qt': FileFormat.MOV,
+    }
+
     _VIDEO_ENCODING_LIBRARY_ENUM_TO_ARGUMENT = {
         VideoCodec.H264: 'libx264',
         VideoCodec.H265: 'libx265',
@@ -105,30 +158,65 @@ class Ffmpeg(object):
         'bb': FieldOrder.INTERLACED_BOT,
     }
 
-    def __init__(self):
-        self._video_codec_level_enum_to_argument = {}
-        for codec, levels in self._VIDEO_CODEC_LEVEL_RAW_TO_ENUM.iteritems():
-            self._video_codec_level_enum_to_argument[codec] = flip_dict(levels)
+    _VIDEO_CODEC_LEVEL_ENUM_TO_ARGUMENT = {codec: _flip_codec_levels(codec, levels)
+                                           for codec, levels in _VIDEO_CODEC_LEVEL_RAW_TO_ENUM.iteritems()}
+    _PICTURE_FORMAT_ENUM_TO_ARGUMENT = flip_dict(_PICTURE_FORMAT_RAW_TO_ENUM)
+    _COLOR_RANGE_ENUM_TO_ARGUMENT = flip_dict(_COLOR_RANGE_RAW_TO_ENUM)
+    _COLOR_SPACE_ENUM_TO_ARGUMENT = flip_dict(_COLOR_SPACE_RAW_TO_ENUM)
+    _COLOR_PRIMARIES_ENUM_TO_ARGUMENT = flip_dict(_COLOR_PRIMARIES_RAW_TO_ENUM)
+    _COLOR_TRC_ENUM_TO_ARGUMENT = flip_dict(_COLOR_TRC_RAW_TO_ENUM)
+    _COLOR_TRC_ENUM_TO_ARGUMENT[ColorSpace.BT_601_PAL] = 'gamma28'
+    _FIELD_ORDER_ENUM_TO_ARGUMENT = flip_dict(_FIELD_ORDER_RAW_TO_ENUM)
 
-        h265_levels = {}
-        for level, argument in self._video_codec_level_enum_to_argument[VideoCodec.H265].iteritems():
-            h265_levels[level] = int(argument / 3)
-        self._video_codec_level_enum_to_argument[VideoCodec.H265] = h265_levels
+    # same core count thresholds x265 uses for its own frame threads choice
+    _X265_FRAME_THREADS = [(32, 6), (16, 5), (8, 3), (4, 2), (0, 1)]
 
-        self._picture_format_enum_to_argument = flip_dict(self._PICTURE_FORMAT_RAW_TO_ENUM)
-        self._color_range_enum_to_argument = flip_dict(self._COLOR_RANGE_RAW_TO_ENUM)
-        self._color_space_enum_to_argument = flip_dict(self._COLOR_SPACE_RAW_TO_ENUM)
-        self._color_primaries_enum_to_argument = flip_dict(self._COLOR_PRIMARIES_RAW_TO_ENUM)
-        self._color_trc_enum_to_argument = flip_dict(self._COLOR_TRC_RAW_TO_ENUM)
-        self._color_trc_enum_to_argument[ColorSpace.BT_601_PAL] = 'gamma28'
-        self._field_order_enum_to_argument = flip_dict(self._FIELD_ORDER_RAW_TO_ENUM)
+    _AUDIO_CHANNEL_LAYOUT_ARGUMENTS = {
+        1: 'mono',
+        2: 'stereo',
+        6: '5.1',
+    }
+
+    # native aac encoder has no usable vbr mode, bitrate is picked per channel
+    _AAC_BITRATE_PER_CHANNEL = 80
 
     def parse_track_type(self, value):
         return self._TRACK_TYPE_RAW_TO_ENUM[value]
 
+    def parse_stream_track_type(self, stream):
+        if stream['codec_type'] == 'video' and stream.get('disposition', {}).get('attached_pic'):
+            return None
+        return self._TRACK_TYPE_RAW_TO_ENUM.get(stream['codec_type'])
+
+    def parse_file_format(self, value, tags):
+        if value != self._ISOBMFF_FORMAT_RAW:
+            return self._FILE_FORMAT_RAW_TO_ENUM.get(value)
+        major_brand = tags.get('major_brand')
+        if major_brand is None:
+            return FileFormat.MOV
+        compatible_brands = tags.get('compatible_brands', '')
+        brands = [major_brand] + [compatible_brands[i:i + 4] for i in xrange(0, len(compatible_brands), 4)]
+        for brand in brands:
+            result = self._ISOBMFF_BRAND_RAW_TO_ENUM.get(brand.strip().lower())
+            if result is not None:
+                return result
+        return None
+
     def build_video_encoding_library_argument(self, codec):
         return self._VIDEO_ENCODING_LIBRARY_ENUM_TO_ARGUMENT[codec]
 
+    def build_video_threads_arguments(self, codec, cores):
+        if codec == VideoCodec.H265:
+            frame_threads = next(threads for min_cores, threads in self._X265_FRAME_THREADS if cores >= min_cores)
+            return [], ['pools={}'.format(cores), 'frame-threads={}'.format(frame_threads)]
+        return ['-threads {}'.format(cores)], []
+
+    def build_audio_channel_layout_argument(self, channels):
+        return self._AUDIO_CHANNEL_LAYOUT_ARGUMENTS[channels]
+
+    def build_aac_bitrate_argument(self, channels):
+        return '{}k'.format(channels * self._AAC_BITRATE_PER_CHANNEL)
+
     def parse_video_codec_profile(self, value):
         return self._VIDEO_CODEC_PROFILE_RAW_TO_ENUM[value]
     def build_video_codec_profile_argument(self, codec, profile):
@@ -137,34 +225,34 @@ class Ffmpeg(object):
     def parse_video_codec_level(self, codec, value):
         return self._VIDEO_CODEC_LEVEL_RAW_TO_ENUM[codec][value]
     def build_video_codec_level_argument(self, codec, level):
-        return self._video_codec_level_enum_to_argument[codec][level]
+        return self._VIDEO_CODEC_LEVEL_ENUM_TO_ARGUMENT[codec][level]
 
     def parse_picture_format(self, value):
         return self._PICTURE_FORMAT_RAW_TO_ENUM[value]
     def build_picture_format_argument(self, value):
-        return self._picture_format_enum_to_argument[value]
+        return self._PICTURE_FORMAT_ENUM_TO_ARGUMENT[value]
 
     def parse_color_space(self, value):
         return self._COLOR_SPACE_RAW_TO_ENUM[value]
     def build_color_space_argument(self, value):
-        return self._color_space_enum_to_argument[value]
+        return self._COLOR_SPACE_ENUM_TO_ARGUMENT[value]
 
     def parse_color_trc(self, value):
         return self._COLOR_TRC_RAW_TO_ENUM[value]
     def build_color_trc_argument(self, value):
-        return self._color_trc_enum_to_argument[value]
+        return self._COLOR_TRC_ENUM_TO_ARGUMENT[value]
 
     def parse_color_primaries(self, value):
         return self._COLOR_PRIMARIES_RAW_TO_ENUM[value]
     def build_color_primaries_argument(self, value):
-        return self._color_primaries_enum_to_argument[value]
+        return self._COLOR_PRIMARIES_ENUM_TO_ARGUMENT[value]
 
     def parse_color_range(self, value):
         return self._COLOR_RANGE_RAW_TO_ENUM[value]
     def build_color_range_argument(self, value):
-        return self._color_range_enum_to_argument[value]
+        return self._COLOR_RANGE_ENUM_TO_ARGUMENT[value]
 
     def parse_field_order(self, value):
         return self._FIELD_ORDER_RAW_TO_ENUM[value]
     def build_field_order(self, value):
-        return self._field_order_enum_to_argument[value]
+        return self._FIELD_ORDER_ENUM_TO_ARGUMENT[value]
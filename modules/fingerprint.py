@@ -0,0 +1,24 @@
+import hashlib
+import mmap
+import os
+
+BLOCK_SIZE = 64 * 1024
+BLOCK_COUNT = 16
+
+# size plus head, tail and evenly spaced blocks, stays the same when a file is renamed or copied
+def fingerprint(path):
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size))
+    if size > 0:
+        with open(path, 'rb') as fobj:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if size <= BLOCK_SIZE * BLOCK_COUNT:
+                    digest.update(data[:])
+                else:
+                    for i in xrange(BLOCK_COUNT):
+                        offset = (size - BLOCK_SIZE) * i // (BLOCK_COUNT - 1)
+                        digest.update(data[offset:offset + BLOCK_SIZE])
+            finally:
+                data.close()
+    return u'{}:{}'.format(size, digest.hexdigest())
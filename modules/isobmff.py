@@ -0,0 +1,462 @@
+import fractions
+import mmap
+import struct
+
+import bitstream
+
+_FORMAT_NAME = 'mov,mp4,m4a,3gp,3g2,mj2'
+
+_HANDLER_TYPES = {
+    'soun': 'audio',
+    'sbtl': 'subtitle',
+    'subt': 'subtitle',
+    'text': 'subtitle',
+    'vide': 'video',
+}
+
+_CODECS = {
+    'Opus': 'opus',
+    'ac-3': 'ac3',
+    'alac': 'alac',
+    'avc1': 'h264',
+    'avc3': 'h264',
+    'ec-3': 'eac3',
+    'fLaC': 'flac',
+    'h263': 'h263',
+    'hev1': 'hevc',
+    'hvc1': 'hevc',
+    'jpeg': 'mjpeg',
+    's263': 'h263',
+    'samr': 'amr_nb',
+    'sowt': 'pcm_s16le',
+    'text': 'mov_text',
+    'twos': 'pcm_s16be',
+    'tx3g': 'mov_text',
+}
+
+_ESDS_OBJECT_TYPES = {
+    0x20: 'mpeg4',
+    0x40: 'aac',
+    0x66: 'aac',
+    0x67: 'aac',
+    0x68: 'aac',
+    0x69: 'mp3',
+    0x6B: 'mp3',
+    0xA5: 'ac3',
+    0xA6: 'eac3',
+}
+
+_AAC_CHANNELS = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 6, 7: 8}
+
+_FIELD_ORDERS = {
+    1: 'tt',
+    6: 'bb',
+    9: 'tb',
+    14: 'bt',
+}
+
+_CONTAINER_BOXES = {'moov', 'trak', 'mdia', 'minf', 'stbl', 'udta', 'edts'}
+
+class _Box(object):
+    def __init__(self, box_type, start, end):
+        self.type = box_type
+        self.start = start
+        self.end = end
+
+def _boxes(data, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError('Invalid box size')
+        yield _Box(box_type, pos + header, pos + size)
+        pos += size
+
+def _children(data, box, offset=0):
+    result = {}
+    for child in _boxes(data, box.start + offset, box.end):
+        result.setdefault(child.type, []).append(child)
+    return result
+
+def _child(data, boxes, *path):
+    box = None
+    for box_type in path:
+        entries = boxes.get(box_type)
+        if not entries:
+            return None
+        box = entries[0]
+        if box_type in _CONTAINER_BOXES:
+            boxes = _children(data, box)
+    return box
+
+def _full_box(data, box):
+    return ord(data[box.start]), box.start + 4
+
+def _parse_header(data, box):
+    version, pos = _full_box(data, box)
+    if version == 1:
+        timescale, duration = struct.unpack('>IQ', data[pos + 16:pos + 28])
+    else:
+        timescale, duration = struct.unpack('>II', data[pos + 8:pos + 16])
+    return version, pos, timescale, duration
+
+def _parse_language(code):
+    if code == 0x7fff:
+        return None
+    if code < 0x400:
+        raise ValueError('Macintosh language codes are not supported')
+    return u''.join(unichr(((code >> shift) & 0x1f) + 0x60) for shift in (10, 5, 0))
+
+def _read_descriptor(data, pos):
+    tag = ord(data[pos])
+    size = 0
+    pos += 1
+    for _ in xrange(4):
+        byte = ord(data[pos])
+        pos += 1
+        size = (size << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + size
+
+def _parse_esds(data, box):
+    _, pos = _full_box(data, box)
+    tag, pos, end = _read_descriptor(data, pos)
+    if tag != 0x03:
+        raise ValueError('ES descriptor not found')
+    flags = ord(data[pos + 2])
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + ord(data[pos])
+    if flags & 0x20:
+        pos += 2
+    tag, pos, end = _read_descriptor(data, pos)
+    if tag != 0x04:
+        raise ValueError('Decoder config descriptor not found')
+    object_type = ord(data[pos])
+    decoder_specific_info = None
+    if pos + 13 < end:
+        tag, info_start, info_end = _read_descriptor(data, pos + 13)
+        if tag == 0x05:
+            decoder_specific_info = data[info_start:info_end]
+    return object_type, decoder_specific_info
+
+def _parse_video_entry(data, stream, entry):
+    stream['width'], stream['height'] = struct.unpack('>HH', data[entry.start + 24:entry.start + 28])
+    boxes = _children(data, entry, 78)
+    avc_config = _child(data, boxes, 'avcC')
+    if stream['codec_name'] == 'h264' and avc_config is not None:
+        stream.update(bitstream.parse_avc_decoder_config(data[avc_config.start:avc_config.end]))
+
+    colr = _child(data, boxes, 'colr')
+    if colr is not None and data[colr.start:colr.start + 4] in ('nclx', 'nclc'):
+        primaries, transfer, matrix = struct.unpack('>HHH', data[colr.start + 4:colr.start + 10])
+        for key, names, value in (('color_primaries', bitstream.COLOR_PRIMARIES_NAMES, primaries),
+                                  ('color_transfer', bitstream.COLOR_TRANSFER_NAMES, transfer),
+                                  ('color_space', bitstream.COLOR_SPACE_NAMES, matrix)):
+            if value in names:
+                stream.setdefault(key, names[value])
+        if data[colr.start:colr.start + 4] == 'nclx':
+            stream.setdefault('color_range', 'pc' if ord(data[colr.start + 10]) & 0x80 else 'tv')
+
+    fiel = _child(data, boxes, 'fiel')
+    if fiel is not None:
+        fields, detail = ord(data[fiel.start]), ord(data[fiel.start + 1])
+        field_order = 'progressive' if fields == 1 else _FIELD_ORDERS.get(detail)
+        if field_order is not None:
+            stream['field_order'] = field_order
+        else:
+            stream.pop('field_order', None)
+
+def _parse_audio_entry(data, stream, entry):
+    version, = struct.unpack('>H', data[entry.start + 8:entry.start + 10])
+    if version > 1:
+        raise ValueError('Sound sample description version {} is not supported'.format(version))
+    channels, = struct.unpack('>H', data[entry.start + 16:entry.start + 18])
+    sample_rate, = struct.unpack('>I', data[entry.start + 24:entry.start + 28])
+    stream['channels'] = channels
+    stream['sample_rate'] = str(sample_rate >> 16)
+
+    boxes = _children(data, entry, 28 + 16 * version)
+    esds = _child(data, boxes, 'esds') or _child(data, boxes, 'wave', 'esds')
+    if stream['codec_name'] == 'mp4a':
+        if esds is None:
+            raise ValueError('mp4a sample entry without esds')
+        object_type, decoder_specific_info = _parse_esds(data, esds)
+        stream['codec_name'] = _ESDS_OBJECT_TYPES.get(object_type)
+        if stream['codec_name'] == 'aac' and decoder_specific_info:
+            config = bitstream.parse_aac_config(decoder_specific_info)
+            if config['profile'] is not None and (config['profile'] != 'LC' or config['sample_rate'] >= 32000):
+                stream['profile'] = config['profile']
+            stream['channels'] = _AAC_CHANNELS.get(config['channel_config'], channels)
+            if config['profile'] == 'HE-AACv2':
+                stream['channels'] = 2
+
+def _parse_frame_rate(data, stts, timescale):
+    _, pos = _full_box(data, stts)
+    count, = struct.unpack('>I', data[pos:pos + 4])
+    deltas = set()
+    for i in xrange(count):
+        sample_count, delta = struct.unpack('>II', data[pos + 4 + i * 8:pos + 12 + i * 8])
+        if i < count - 1 or count == 1:
+            deltas.add(delta)
+    if len(deltas) != 1 or not timescale:
+        return None
+    rate = fractions.Fraction(timescale, deltas.pop()).limit_denominator(1001)
+    return '{}/{}'.format(rate.numerator, rate.denominator)
+
+def _parse_start_pts(data, boxes, timescale, movie_timescale):
+    elst = _child(data, boxes, 'edts', 'elst')
+    if elst is None:
+        return 0
+    version, pos = _full_box(data, elst)
+    count, = struct.unpack('>I', data[pos:pos + 4])
+    entry_format, entry_size = ('>Qq', 20) if version == 1 else ('>Ii', 12)
+    edits = [struct.unpack(entry_format, data[pos + 4 + i * entry_size:pos + 4 + i * entry_size + entry_size - 4])
+             for i in xrange(count)]
+    empty_duration = 0
+    if len(edits) == 2 and edits[0][1] == -1:
+        empty_duration = edits.pop(0)[0]
+    if len(edits) != 1 or edits[0][1] < 0 or (empty_duration and edits[0][1] != 0) or not movie_timescale:
+        return None
+    return int(round(float(empty_duration) * timescale / movie_timescale))
+
+def _parse_track_id(data, tkhd):
+    version, pos = _full_box(data, tkhd)
+    return struct.unpack('>I', data[pos + (16 if version == 1 else 8):pos + (20 if version == 1 else 12)])[0]
+
+def _parse_chapter_references(data, boxes):
+    chap = _child(data, boxes, 'tref')
+    chap = _child(data, _children(data, chap), 'chap') if chap is not None else None
+    if chap is None:
+        return []
+    count = (chap.end - chap.start) // 4
+    return list(struct.unpack('>{}I'.format(count), data[chap.start:chap.start + count * 4]))
+
+def _parse_sample_times(data, stts):
+    _, pos = _full_box(data, stts)
+    count, = struct.unpack('>I', data[pos:pos + 4])
+    times = []
+    time = 0
+    for i in xrange(count):
+        sample_count, delta = struct.unpack('>II', data[pos + 4 + i * 8:pos + 12 + i * 8])
+        for _ in xrange(sample_count):
+            times.append(time)
+            time += delta
+    return times
+
+def _parse_sample_ranges(data, stbl):
+    stsz = _child(data, stbl, 'stsz')
+    stsc = _child(data, stbl, 'stsc')
+    stco = _child(data, stbl, 'stco') or _child(data, stbl, 'co64')
+    if stsz is None or stsc is None or stco is None:
+        raise ValueError('Incomplete sample table')
+    sample_size, sample_count = struct.unpack('>II', data[stsz.start + 4:stsz.start + 12])
+    sizes = [sample_size] * sample_count if sample_size else \
+        list(struct.unpack('>{}I'.format(sample_count), data[stsz.start + 12:stsz.start + 12 + sample_count * 4]))
+    _, pos = _full_box(data, stsc)
+    count, = struct.unpack('>I', data[pos:pos + 4])
+    chunk_runs = [struct.unpack('>II', data[pos + 4 + i * 12:pos + 12 + i * 12]) for i in xrange(count)]
+    _, pos = _full_box(data, stco)
+    count, = struct.unpack('>I', data[pos:pos + 4])
+    entry_format, entry_size = ('>Q', 8) if stco.type == 'co64' else ('>I', 4)
+    chunk_offsets = [struct.unpack(entry_format, data[pos + 4 + i * entry_size:pos + 4 + (i + 1) * entry_size])[0]
+                     for i in xrange(count)]
+
+    ranges = []
+    for chunk_index, offset in enumerate(chunk_offsets):
+        samples_per_chunk = [run_samples for first_chunk, run_samples in chunk_runs if first_chunk <= chunk_index + 1][-1]
+        for _ in xrange(samples_per_chunk):
+            if len(ranges) == len(sizes):
+                break
+            ranges.append((offset, sizes[len(ranges)]))
+            offset += ranges[-1][1]
+    if len(ranges) != len(sizes):
+        raise ValueError('Sample table does not cover all samples')
+    return ranges
+
+def _parse_chapter_title(sample):
+    length, = struct.unpack('>H', sample[:2])
+    text = sample[2:2 + length]
+    if text.startswith('\xfe\xff'):
+        return text.decode('utf-16', 'replace')
+    return text.decode('utf-8', 'replace')
+
+# quicktime chapters are text samples of a track referenced by the tref/chap box of another track
+def _parse_chapters(data, trak):
+    boxes = _children(data, trak)
+    _, _, timescale, duration = _parse_header(data, _child(data, boxes, 'mdia', 'mdhd'))
+    stbl_box = _child(data, boxes, 'mdia', 'minf', 'stbl')
+    stts = _child(data, boxes, 'mdia', 'minf', 'stbl', 'stts')
+    if stbl_box is None or stts is None or not timescale:
+        raise ValueError('Incomplete chapter track')
+    times = _parse_sample_times(data, stts)
+    ranges = _parse_sample_ranges(data, _children(data, stbl_box))
+    if len(times) != len(ranges):
+        raise ValueError('Chapter sample count mismatch')
+    result = []
+    for i, (start, (offset, size)) in enumerate(zip(times, ranges)):
+        end = times[i + 1] if i + 1 < len(times) else duration
+        chapter = {
+            'id': i,
+            'time_base': '1/{}'.format(timescale),
+            'start': start,
+            'start_time': '{:.6f}'.format(float(start) / timescale),
+            'end': end,
+            'end_time': '{:.6f}'.format(float(end) / timescale),
+            'tags': {},
+        }
+        title = _parse_chapter_title(data[offset:offset + size])
+        if title:
+            chapter['tags']['title'] = title
+        result.append(chapter)
+    return result
+
+def _parse_track(data, trak, index, movie_timescale, is_chapters=False):
+    boxes = _children(data, trak)
+    tkhd = _child(data, boxes, 'tkhd')
+    mdhd = _child(data, boxes, 'mdia', 'mdhd')
+    hdlr = _child(data, boxes, 'mdia', 'hdlr')
+    stsd = _child(data, boxes, 'mdia', 'minf', 'stbl', 'stsd')
+    if tkhd is None or mdhd is None or hdlr is None:
+        raise ValueError('Incomplete track header')
+
+    codec_type = 'data' if is_chapters else _HANDLER_TYPES.get(data[hdlr.start + 8:hdlr.start + 12], 'data')
+    version, pos, timescale, duration = _parse_header(data, mdhd)
+    language_code, = struct.unpack('>H', data[pos + (28 if version == 1 else 16):pos + (30 if version == 1 else 18)])
+    stream = {
+        'index': index,
+        'codec_type': codec_type,
+        'time_base': '1/{}'.format(timescale),
+        'duration_ts': duration,
+        'disposition': {'default': int(bool(ord(data[tkhd.start + 3]) & 0x01)), 'forced': 0},
+        'tags': {},
+    }
+    if timescale:
+        stream['duration'] = '{:.6f}'.format(float(duration) / timescale)
+    # muxers often give chapter tracks macintosh language codes, nothing reads their language anyway
+    language = None if is_chapters else _parse_language(language_code)
+    if language is not None:
+        stream['tags']['language'] = language
+    name = _child(data, boxes, 'udta', 'name')
+    if name is not None:
+        stream['tags']['title'] = data[name.start:name.end].rstrip('\x00').decode('utf-8', 'replace')
+    if codec_type == 'data' or stsd is None:
+        return stream
+
+    entries = list(_boxes(data, stsd.start + 8, stsd.end))
+    if not entries:
+        raise ValueError('Empty sample description')
+    entry = entries[0]
+    stream['codec_tag_string'] = entry.type
+    stream['codec_name'] = _CODECS.get(entry.type, entry.type if entry.type == 'mp4a' else None)
+    if stream['codec_name'] is None:
+        raise ValueError('Unsupported sample entry {}'.format(entry.type))
+
+    stsz = _child(data, boxes, 'mdia', 'minf', 'stbl', 'stsz')
+    if stsz is not None:
+        stream['nb_frames'] = str(struct.unpack('>I', data[stsz.start + 8:stsz.start + 12])[0])
+
+    if codec_type == 'video':
+        _parse_video_entry(data, stream, entry)
+        stts = _child(data, boxes, 'mdia', 'minf', 'stbl', 'stts')
+        frame_rate = _parse_frame_rate(data, stts, timescale) if stts is not None else None
+        if frame_rate is not None:
+            stream['r_frame_rate'] = frame_rate
+    elif codec_type == 'audio':
+        _parse_audio_entry(data, stream, entry)
+        if stream['codec_name'] is None:
+            raise ValueError('Unsupported audio object type')
+        start_pts = _parse_start_pts(data, boxes, timescale, movie_timescale)
+        if start_pts is not None:
+            stream['start_pts'] = start_pts
+    return stream
+
+def _probe(data):
+    top_level = {}
+    for box in _boxes(data, 0, len(data)):
+        if box.type in ('ftyp', 'moov'):
+            top_level.setdefault(box.type, box)
+    if 'moov' not in top_level:
+        raise ValueError('Movie box not found')
+
+    tags = {}
+    ftyp = top_level.get('ftyp')
+    if ftyp is not None:
+        major_brand, minor_version = struct.unpack('>4sI', data[ftyp.start:ftyp.start + 8])
+        tags['major_brand'] = major_brand
+        tags['minor_version'] = str(minor_version)
+        tags['compatible_brands'] = data[ftyp.start + 8:ftyp.end]
+
+    moov = _children(data, top_level['moov'])
+    mvhd = _child(data, moov, 'mvhd')
+    if mvhd is None:
+        raise ValueError('Movie header not found')
+    _, _, timescale, duration = _parse_header(data, mvhd)
+    traks = moov.get('trak', [])
+    chapter_track_ids = set()
+    track_ids = []
+    for trak in traks:
+        boxes = _children(data, trak)
+        tkhd = _child(data, boxes, 'tkhd')
+        if tkhd is None:
+            raise ValueError('Track header not found')
+        track_ids.append(_parse_track_id(data, tkhd))
+        chapter_track_ids.update(_parse_chapter_references(data, boxes))
+    chapters = []
+    for trak, track_id in zip(traks, track_ids):
+        if track_id in chapter_track_ids:
+            chapters = _parse_chapters(data, trak)
+            break
+    result = {
+        'format': {'format_name': _FORMAT_NAME, 'tags': tags},
+        'streams': [_parse_track(data, trak, index, timescale, track_id in chapter_track_ids)
+                    for index, (trak, track_id) in enumerate(zip(traks, track_ids))],
+        'chapters': chapters,
+    }
+    result['format']['nb_streams'] = len(result['streams'])
+    if timescale:
+        result['format']['duration'] = '{:.6f}'.format(float(duration) / timescale)
+    return result
+
+# fast start files put the whole moov before the media data, frames begin at the first chunk
+def payload_offset(data):
+    try:
+        top_level = {}
+        for box in _boxes(data, 0, len(data)):
+            top_level.setdefault(box.type, box)
+        if 'ftyp' not in top_level or 'moov' not in top_level:
+            return None
+        offsets = []
+        for trak in _children(data, top_level['moov']).get('trak', []):
+            boxes = _children(data, trak)
+            for box_type, entry_format in (('stco', '>I'), ('co64', '>Q')):
+                box = _child(data, boxes, 'mdia', 'minf', 'stbl', box_type)
+                if box is not None and struct.unpack('>I', data[box.start + 4:box.start + 8])[0] > 0:
+                    offsets.append(struct.unpack_from(entry_format, data, box.start + 8)[0])
+    except (ValueError, KeyError, IndexError, TypeError, struct.error):
+        return None
+    if offsets:
+        return min(offsets)
+    return top_level['mdat'].start if 'mdat' in top_level else None
+
+def probe(media_path):
+    with open(media_path, 'rb') as fobj:
+        try:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            return None
+        try:
+            return _probe(data)
+        except (ValueError, KeyError, IndexError, TypeError, struct.error):
+            return None
+        finally:
+            data.close()
@@ -0,0 +1,139 @@
+import bisect
+import multiprocessing
+import threading
+
+import cli
+import cmd
+import platform
+
+class Job(object):
+    def __init__(self, name, commands, dependencies=()):
+        self.name = name
+        self.commands = list(commands)
+        self.dependencies = list(dependencies)
+
+    def inputs(self):
+        return {path for command in self.commands for path in command.inputs}
+
+    def outputs(self):
+        return {path for command in self.commands for path in command.outputs}
+
+class JobExecutor(object):
+    def __init__(self, resource_limits, cpu_slot_cores=None):
+        self._free_slots = {resource: range(max(1, limit)) for resource, limit in resource_limits.iteritems()}
+        self._cpu_slot_cores = cpu_slot_cores
+        self._condition = threading.Condition()
+        self._output_lock = threading.Lock()
+        self._order = {}
+        self._pending = []
+        self._ready = []
+        self._running = 0
+        self._finished = set()
+        self._failed = []
+        self._failed_jobs = set()
+        self._messages = []
+
+    # messages are printed outside the condition, a failing print must not stall the scheduling
+    def _print_messages(self):
+        with self._output_lock:
+            with self._condition:
+                messages, self._messages = self._messages, []
+            for message in messages:
+                try:
+                    platform.print_string(message)
+                except Exception:
+                    pass
+
+    def submit(self, job):
+        with self._condition:
+            self._order[job] = len(self._order)
+            self._pending.append(job)
+            self._dispatch()
+        self._print_messages()
+        return job
+
+    def _make_ready(self, job, index):
+        bisect.insort(self._ready, (self._order[job], index, job))
+
+    # jobs can only depend on previously submitted ones, so one ordered pass resolves skip chains;
+    # earlier submitted jobs get free slots first, commands without resource class never wait for one
+    def _dispatch(self):
+        progress = True
+        while progress:
+            progress = False
+            for job in list(self._pending):
+                if any(dependency in self._failed_jobs for dependency in job.dependencies):
+                    self._pending.remove(job)
+                    self._fail(job, u'Skipped, dependency failed')
+                elif all(dependency in self._finished for dependency in job.dependencies):
+                    self._pending.remove(job)
+                    self._make_ready(job, 0)
+            for item in list(self._ready):
+                _, index, job = item
+                if index == len(job.commands):
+                    self._ready.remove(item)
+                    self._finished.add(job)
+                    progress = True
+                    continue
+                resource = job.commands[index].resource
+                slot = None
+                if resource is not None:
+                    if not self._free_slots[resource]:
+                        continue
+                    slot = self._free_slots[resource].pop(0)
+                self._ready.remove(item)
+                self._running += 1
+                thread = threading.Thread(target=self._run, args=(job, index, slot))
+                thread.daemon = True
+                thread.start()
+
+    def _fail(self, job, message):
+        self._failed.append((job, message))
+        self._failed_jobs.add(job)
+        self._messages.append(u'{}: {}'.format(job.name, message))
+
+    # each CPU slot owns its own range of cores, so concurrent encodes never share them
+    def _slot_cores(self, slot):
+        cpu_count = multiprocessing.cpu_count()
+        return [(slot * self._cpu_slot_cores + i) % cpu_count for i in xrange(self._cpu_slot_cores)]
+
+    def _run(self, job, index, slot):
+        command = job.commands[index]
+        cores = None
+        if command.resource == cmd.Resource.CPU and self._cpu_slot_cores is not None:
+            cores = self._slot_cores(slot)
+        # any failure has to reach the finally block, otherwise the slot leaks and wait never returns
+        error = u'Command "{}" failed'.format(command.render())
+        try:
+            exit_code = command.execute(cores)
+            if command.is_failed(exit_code):
+                error = u'Command "{}" failed with exit code {}'.format(command.render(), exit_code)
+            else:
+                error = None
+        except Exception as e:
+            error = u'Command "{}" failed: {}'.format(command.render(), e)
+        finally:
+            with self._condition:
+                self._running -= 1
+                if command.resource is not None:
+                    bisect.insort(self._free_slots[command.resource], slot)
+                if error is None:
+                    self._make_ready(job, index + 1)
+                else:
+                    self._fail(job, error)
+                self._dispatch()
+                self._condition.notify_all()
+            self._print_messages()
+
+    def succeeded(self, job):
+        with self._condition:
+            return job in self._finished
+
+    def wait(self):
+        with self._condition:
+            while self._pending or self._ready or self._running:
+                self._condition.wait(0.5)
+        self._print_messages()
+        if self._failed:
+            raise cli.Error(u'{} of {} jobs failed'.format(
+                len(self._failed), len(self._failed) + len(self._finished)))
@@ -0,0 +1,516 @@
+import fractions
+import mmap
+import struct
+
+import bitstream
+
+_ID_EBML = 0x1A45DFA3
+_ID_SEGMENT = 0x18538067
+_ID_CRC32 = 0xBF
+_ID_VOID = 0xEC
+_ID_SEEK_HEAD = 0x114D9B74
+_ID_SEEK = 0x4DBB
+_ID_SEEK_ID = 0x53AB
+_ID_SEEK_POSITION = 0x53AC
+_ID_INFO = 0x1549A966
+_ID_TIMESTAMP_SCALE = 0x2AD7B1
+_ID_DURATION = 0x4489
+_ID_TRACKS = 0x1654AE6B
+_ID_TRACK_ENTRY = 0xAE
+_ID_TRACK_NUMBER = 0xD7
+_ID_TRACK_UID = 0x73C5
+_ID_TRACK_TYPE = 0x83
+_ID_FLAG_DEFAULT = 0x88
+_ID_FLAG_FORCED = 0x55AA
+_ID_NAME = 0x536E
+_ID_LANGUAGE = 0x22B59C
+_ID_CODEC_ID = 0x86
+_ID_CODEC_PRIVATE = 0x63A2
+_ID_CODEC_DELAY = 0x56AA
+_ID_DEFAULT_DURATION = 0x23E383
+_ID_VIDEO = 0xE0
+_ID_PIXEL_WIDTH = 0xB0
+_ID_PIXEL_HEIGHT = 0xBA
+_ID_FLAG_INTERLACED = 0x9A
+_ID_FIELD_ORDER = 0x9D
+_ID_COLOUR = 0x55B0
+_ID_MATRIX_COEFFICIENTS = 0x55B1
+_ID_RANGE = 0x55B9
+_ID_TRANSFER_CHARACTERISTICS = 0x55BA
+_ID_PRIMARIES = 0x55BB
+_ID_AUDIO = 0xE1
+_ID_SAMPLING_FREQUENCY = 0xB5
+_ID_OUTPUT_SAMPLING_FREQUENCY = 0x78B5
+_ID_CHANNELS = 0x9F
+_ID_BIT_DEPTH = 0x6264
+_ID_TAGS = 0x1254C367
+_ID_TAG = 0x7373
+_ID_TARGETS = 0x63C0
+_ID_TAG_TRACK_UID = 0x63C5
+_ID_SIMPLE_TAG = 0x67C8
+_ID_TAG_NAME = 0x45A3
+_ID_TAG_LANGUAGE = 0x447A
+_ID_TAG_DEFAULT = 0x4484
+_ID_TAG_STRING = 0x4487
+_ID_CHAPTERS = 0x1043A770
+_ID_EDITION_ENTRY = 0x45B9
+_ID_CHAPTER_ATOM = 0xB6
+_ID_CHAPTER_UID = 0x73C4
+_ID_CHAPTER_TIME_START = 0x91
+_ID_CHAPTER_TIME_END = 0x92
+_ID_CHAPTER_DISPLAY = 0x80
+_ID_CHAP_STRING = 0x85
+_ID_CLUSTER = 0x1F43B675
+_ID_CLUSTER_TIMESTAMP = 0xE7
+_ID_SIMPLE_BLOCK = 0xA3
+_ID_BLOCK_GROUP = 0xA0
+_ID_BLOCK = 0xA1
+
+_TRACK_TYPES = {
+    1: 'video',
+    2: 'audio',
+    17: 'subtitle',
+    33: 'data',
+}
+
+_CODECS = {
+    'V_MJPEG': 'mjpeg',
+    'V_MPEG1': 'mpeg1video',
+    'V_MPEG2': 'mpeg2video',
+    'V_MPEG4/ISO/AP': 'mpeg4',
+    'V_MPEG4/ISO/ASP': 'mpeg4',
+    'V_MPEG4/ISO/AVC': 'h264',
+    'V_MPEG4/ISO/SP': 'mpeg4',
+    'V_MPEG4/MS/V3': 'msmpeg4v3',
+    'V_MPEGH/ISO/HEVC': 'hevc',
+    'V_REAL/RV30': 'rv30',
+    'V_REAL/RV40': 'rv40',
+    'V_VP8': 'vp8',
+    'V_VP9': 'vp9',
+    'A_AAC': 'aac',
+    'A_AC3': 'ac3',
+    'A_DTS': 'dts',
+    'A_EAC3': 'eac3',
+    'A_FLAC': 'flac',
+    'A_MPEG/L2': 'mp2',
+    'A_MPEG/L3': 'mp3',
+    'A_OPUS': 'opus',
+    'A_REAL/COOK': 'cook',
+    'A_TRUEHD': 'truehd',
+    'A_VORBIS': 'vorbis',
+    'S_ASS': 'ass',
+    'S_HDMV/PGS': 'hdmv_pgs_subtitle',
+    'S_SSA': 'ass',
+    'S_TEXT/ASS': 'ass',
+    'S_TEXT/SSA': 'ass',
+    'S_TEXT/UTF8': 'subrip',
+    'S_VOBSUB': 'dvd_subtitle',
+}
+
+_CODEC_PREFIXES = {
+    'A_AAC/': 'aac',
+    'A_AC3/': 'ac3',
+}
+
+_PCM_CODECS = {
+    ('A_PCM/INT/LIT', 16): 'pcm_s16le',
+    ('A_PCM/INT/LIT', 24): 'pcm_s24le',
+    ('A_PCM/INT/LIT', 32): 'pcm_s32le',
+    ('A_PCM/INT/BIG', 16): 'pcm_s16be',
+    ('A_PCM/INT/BIG', 24): 'pcm_s24be',
+    ('A_PCM/INT/BIG', 32): 'pcm_s32be',
+}
+
+_FIELD_ORDERS = {
+    0: 'progressive',
+    1: 'tt',
+    6: 'bb',
+    9: 'tb',
+    14: 'bt',
+}
+
+_MAX_START_SCAN_BYTES = 16 * 1024 * 1024
+_TAGS_TAIL_SCAN_BYTES = 1024 * 1024
+
+class _Reader(object):
+    def __init__(self, data):
+        self._data = data
+        self._size = len(data)
+
+    def size(self):
+        return self._size
+
+    def _read_vint(self, pos, keep_marker):
+        first = ord(self._data[pos])
+        length = 1
+        mask = 0x80
+        while length <= 8 and not first & mask:
+            length += 1
+            mask >>= 1
+        if length > 8:
+            raise ValueError('Invalid EBML variable size integer')
+        value = first if keep_marker else first & (mask - 1)
+        all_ones = value == mask - 1
+        for byte in self._data[pos + 1:pos + length]:
+            value = (value << 8) | ord(byte)
+            all_ones = all_ones and ord(byte) == 0xff
+        if pos + length > self._size:
+            raise ValueError('Unexpected end of file')
+        return value, length, all_ones and not keep_marker
+
+    def element_at(self, pos, end):
+        element_id, id_length, _ = self._read_vint(pos, True)
+        size, size_length, unknown_size = self._read_vint(pos + id_length, False)
+        data_start = pos + id_length + size_length
+        data_end = end if unknown_size else data_start + size
+        if data_end > end:
+            data_end = end
+        return element_id, data_start, data_end
+
+    def elements(self, start, end):
+        pos = start
+        while pos < end:
+            element_id, data_start, data_end = self.element_at(pos, end)
+            yield element_id, data_start, data_end
+            pos = data_end
+
+    def children(self, start, end):
+        result = {}
+        for element_id, data_start, data_end in self.elements(start, end):
+            result.setdefault(element_id, []).append((data_start, data_end))
+        return result
+
+    def uint(self, start, end):
+        value = 0
+        for byte in self._data[start:end]:
+            value = (value << 8) | ord(byte)
+        return value
+
+    def sint(self, start, end):
+        value = self.uint(start, end)
+        bits = (end - start) * 8
+        if bits and value >= 1 << (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def float(self, start, end):
+        if end - start == 4:
+            return struct.unpack('>f', self._data[start:end])[0]
+        if end - start == 8:
+            return struct.unpack('>d', self._data[start:end])[0]
+        return 0.0
+
+    def bytes(self, start, end):
+        return self._data[start:end]
+
+    def string(self, start, end):
+        return self._data[start:end].rstrip('\x00').decode('utf-8', 'replace')
+
+    def rfind(self, sub, start, end):
+        return self._data.rfind(sub, start, end)
+
+def _child(reader, children, element_id, kind, default=None):
+    entries = children.get(element_id)
+    if not entries:
+        return default
+    return getattr(reader, kind)(*entries[0])
+
+def _find_top_level(reader, segment_start, segment_end):
+    positions = {}
+    seek_heads = []
+    first_cluster = None
+    for element_id, data_start, data_end in reader.elements(segment_start, segment_end):
+        if element_id == _ID_SEEK_HEAD:
+            seek_heads.append((data_start, data_end))
+        elif element_id == _ID_CLUSTER:
+            first_cluster = (data_start, data_end)
+            break
+        else:
+            positions.setdefault(element_id, (data_start, data_end))
+
+    has_seek_head = bool(seek_heads)
+    visited = set()
+    while seek_heads:
+        head_start, head_end = seek_heads.pop()
+        for seek_start, seek_end in reader.children(head_start, head_end).get(_ID_SEEK, []):
+            seek = reader.children(seek_start, seek_end)
+            seek_id = reader.uint(*seek[_ID_SEEK_ID][0])
+            position = segment_start + reader.uint(*seek[_ID_SEEK_POSITION][0])
+            if position in visited or position >= segment_end:
+                continue
+            visited.add(position)
+            element_id, data_start, data_end = reader.element_at(position, segment_end)
+            if element_id != seek_id:
+                continue
+            if element_id == _ID_SEEK_HEAD:
+                seek_heads.append((data_start, data_end))
+            elif element_id == _ID_CLUSTER:
+                if first_cluster is None or data_start < first_cluster[0]:
+                    first_cluster = (data_start, data_end)
+            else:
+                positions.setdefault(element_id, (data_start, data_end))
+
+    if not has_seek_head and _ID_TAGS not in positions and first_cluster is not None:
+        tags = _find_tail_tags(reader, max(first_cluster[1], segment_end - _TAGS_TAIL_SCAN_BYTES), segment_end)
+        if tags is not None:
+            positions[_ID_TAGS] = tags
+    return positions, first_cluster
+
+# without a seek head tags can only be found by their id, walking every cluster header of a big file is too slow;
+# muxers write them after the clusters, so only the tail is searched
+def _find_tail_tags(reader, start, end):
+    tags_id = struct.pack('>I', _ID_TAGS)
+    pos = reader.rfind(tags_id, start, end)
+    while pos >= 0:
+        try:
+            element_id, data_start, data_end = reader.element_at(pos, end)
+            children = set(reader.children(data_start, data_end))
+            if element_id == _ID_TAGS and _ID_TAG in children and children <= {_ID_TAG, _ID_CRC32, _ID_VOID}:
+                return data_start, data_end
+        except (ValueError, IndexError):
+            pass
+        pos = reader.rfind(tags_id, start, pos)
+    return None
+
+def _codec_name(codec_id, bit_depth):
+    if codec_id in _CODECS:
+        return _CODECS[codec_id]
+    if (codec_id, bit_depth) in _PCM_CODECS:
+        return _PCM_CODECS[(codec_id, bit_depth)]
+    for prefix, name in _CODEC_PREFIXES.iteritems():
+        if codec_id.startswith(prefix):
+            return name
+    return None
+
+def _parse_video(reader, stream, codec_private, video):
+    stream['width'] = _child(reader, video, _ID_PIXEL_WIDTH, 'uint', 0)
+    stream['height'] = _child(reader, video, _ID_PIXEL_HEIGHT, 'uint', 0)
+
+    if stream['codec_name'] == 'h264' and codec_private:
+        stream.update(bitstream.parse_avc_decoder_config(codec_private))
+
+    colour = reader.children(*video[_ID_COLOUR][0]) if _ID_COLOUR in video else {}
+    colour_range = _child(reader, colour, _ID_RANGE, 'uint', 0)
+    if colour_range in (1, 2):
+        stream.setdefault('color_range', 'tv' if colour_range == 1 else 'pc')
+    for element_id, key, names in ((_ID_MATRIX_COEFFICIENTS, 'color_space', bitstream.COLOR_SPACE_NAMES),
+                                   (_ID_TRANSFER_CHARACTERISTICS, 'color_transfer', bitstream.COLOR_TRANSFER_NAMES),
+                                   (_ID_PRIMARIES, 'color_primaries', bitstream.COLOR_PRIMARIES_NAMES)):
+        value = names.get(_child(reader, colour, element_id, 'uint'))
+        if value is not None:
+            stream.setdefault(key, value)
+
+    interlaced = _child(reader, video, _ID_FLAG_INTERLACED, 'uint', 0)
+    if interlaced == 2:
+        stream['field_order'] = 'progressive'
+    elif interlaced == 1:
+        field_order = _FIELD_ORDERS.get(_child(reader, video, _ID_FIELD_ORDER, 'uint', 2))
+        if field_order is not None:
+            stream['field_order'] = field_order
+        else:
+            stream.pop('field_order', None)
+
+def _parse_audio(reader, stream, codec_private, audio):
+    sample_rate = _child(reader, audio, _ID_SAMPLING_FREQUENCY, 'float', 8000.0)
+    output_sample_rate = _child(reader, audio, _ID_OUTPUT_SAMPLING_FREQUENCY, 'float', sample_rate)
+    stream['sample_rate'] = str(int(output_sample_rate))
+    stream['channels'] = _child(reader, audio, _ID_CHANNELS, 'uint', 1)
+
+    if stream['codec_name'] == 'aac' and codec_private:
+        config = bitstream.parse_aac_config(codec_private)
+        profile = config['profile']
+        if profile == 'LC' and output_sample_rate > sample_rate:
+            profile = 'HE-AAC'
+        if profile is not None and (profile != 'LC' or sample_rate >= 32000):
+            stream['profile'] = profile
+
+def _parse_track(reader, children, index):
+    track_type = _TRACK_TYPES.get(_child(reader, children, _ID_TRACK_TYPE, 'uint'))
+    codec_id = _child(reader, children, _ID_CODEC_ID, 'string')
+    if track_type is None or not codec_id:
+        return None
+
+    audio = reader.children(*children[_ID_AUDIO][0]) if _ID_AUDIO in children else {}
+    codec_private = _child(reader, children, _ID_CODEC_PRIVATE, 'bytes')
+    stream = {
+        'index': index,
+        'codec_type': track_type,
+        'codec_name': _codec_name(codec_id, _child(reader, audio, _ID_BIT_DEPTH, 'uint')),
+        'disposition': {
+            'default': _child(reader, children, _ID_FLAG_DEFAULT, 'uint', 1),
+            'forced': _child(reader, children, _ID_FLAG_FORCED, 'uint', 0),
+        },
+        'tags': {},
+    }
+    if stream['codec_name'] is None:
+        raise ValueError('Unsupported codec {}'.format(codec_id))
+
+    language = _child(reader, children, _ID_LANGUAGE, 'string', u'eng')
+    if language != 'und':
+        stream['tags']['language'] = language
+    name = _child(reader, children, _ID_NAME, 'string')
+    if name:
+        stream['tags']['title'] = name
+
+    default_duration = _child(reader, children, _ID_DEFAULT_DURATION, 'uint')
+    if track_type == 'video':
+        if default_duration:
+            rate = fractions.Fraction(10 ** 9, default_duration).limit_denominator(1001)
+            stream['r_frame_rate'] = '{}/{}'.format(rate.numerator, rate.denominator)
+        _parse_video(reader, stream, codec_private, reader.children(*children[_ID_VIDEO][0]) if _ID_VIDEO in children else {})
+    elif track_type == 'audio':
+        _parse_audio(reader, stream, codec_private, audio)
+    return stream
+
+def _parse_tags(reader, tags_position, streams_by_uid):
+    for tag_start, tag_end in reader.children(*tags_position).get(_ID_TAG, []):
+        tag = reader.children(tag_start, tag_end)
+        targets = reader.children(*tag[_ID_TARGETS][0]) if _ID_TARGETS in tag else {}
+        for uid_start, uid_end in targets.get(_ID_TAG_TRACK_UID, []):
+            stream = streams_by_uid.get(reader.uint(uid_start, uid_end))
+            if stream is None:
+                continue
+            for simple_start, simple_end in tag.get(_ID_SIMPLE_TAG, []):
+                simple_tag = reader.children(simple_start, simple_end)
+                name = _child(reader, simple_tag, _ID_TAG_NAME, 'string')
+                if not name:
+                    continue
+                value = _child(reader, simple_tag, _ID_TAG_STRING, 'string', u'')
+                language = _child(reader, simple_tag, _ID_TAG_LANGUAGE, 'string', u'und')
+                if language == 'und' or _child(reader, simple_tag, _ID_TAG_DEFAULT, 'uint', 1):
+                    stream['tags'][name] = value
+                if language != 'und':
+                    stream['tags'][u'{}-{}'.format(name, language)] = value
+
+def _parse_chapters(reader, chapters_position, timestamp_scale):
+    result = []
+    for edition_start, edition_end in reader.children(*chapters_position).get(_ID_EDITION_ENTRY, []):
+        for atom_start, atom_end in reader.children(edition_start, edition_end).get(_ID_CHAPTER_ATOM, []):
+            atom = reader.children(atom_start, atom_end)
+            start = _child(reader, atom, _ID_CHAPTER_TIME_START, 'uint', 0)
+            end = _child(reader, atom, _ID_CHAPTER_TIME_END, 'uint', start)
+            chapter = {
+                'id': _child(reader, atom, _ID_CHAPTER_UID, 'uint', 0),
+                'time_base': '1/1000000000',
+                'start': start,
+                'start_time': '{:.6f}'.format(start / 1e9),
+                'end': end,
+                'end_time': '{:.6f}'.format(end / 1e9),
+                'tags': {},
+            }
+            for display_start, display_end in atom.get(_ID_CHAPTER_DISPLAY, [])[:1]:
+                title = _child(reader, reader.children(display_start, display_end), _ID_CHAP_STRING, 'string')
+                if title:
+                    chapter['tags']['title'] = title
+            result.append(chapter)
+        break
+    return result
+
+def _block_frame(reader, block_start, block_end):
+    _, length, _ = reader._read_vint(block_start, False)
+    if ord(reader.bytes(block_start + length + 2, block_start + length + 3)) & 0x06:
+        return None
+    return reader.bytes(block_start + length + 3, block_end)
+
+def _parse_first_blocks(reader, first_cluster, segment_end, streams_by_number):
+    pending = {number for number, (stream, _) in streams_by_number.iteritems() if stream['codec_type'] == 'audio'}
+    scan_end = min(segment_end, first_cluster[0] + _MAX_START_SCAN_BYTES)
+    pos = first_cluster[0]
+    cluster_timestamp = 0
+    while pending and pos < scan_end:
+        element_id, data_start, data_end = reader.element_at(pos, segment_end)
+        if element_id == _ID_CLUSTER:
+            pos = data_start
+            cluster_timestamp = 0
+            continue
+        pos = data_end
+        if element_id == _ID_CLUSTER_TIMESTAMP:
+            cluster_timestamp = reader.uint(data_start, data_end)
+            continue
+        if element_id == _ID_BLOCK_GROUP:
+            block = reader.children(data_start, data_end).get(_ID_BLOCK)
+            if not block:
+                continue
+            data_start, data_end = block[0]
+        elif element_id != _ID_SIMPLE_BLOCK:
+            continue
+        track_number, length, _ = reader._read_vint(data_start, False)
+        if track_number not in pending:
+            continue
+        pending.discard(track_number)
+        stream, codec_delay = streams_by_number[track_number]
+        stream['start_pts'] = cluster_timestamp + reader.sint(data_start + length, data_start + length + 2) - codec_delay
+        if stream['codec_name'] == 'dts':
+            frame = _block_frame(reader, data_start, data_end)
+            profile = bitstream.parse_dts_profile(frame) if frame is not None else None
+            if profile is not None:
+                stream['profile'] = profile
+
+def _segment(reader):
+    element_id, header_start, header_end = reader.element_at(0, reader.size())
+    if element_id != _ID_EBML:
+        raise ValueError('Not an EBML file')
+    element_id, segment_start, segment_end = reader.element_at(header_end, reader.size())
+    if element_id != _ID_SEGMENT:
+        raise ValueError('Segment not found')
+    return segment_start, segment_end
+
+def _probe(reader):
+    segment_start, segment_end = _segment(reader)
+    positions, first_cluster = _find_top_level(reader, segment_start, segment_end)
+    if _ID_TRACKS not in positions:
+        raise ValueError('Tracks not found')
+
+    info = reader.children(*positions[_ID_INFO]) if _ID_INFO in positions else {}
+    timestamp_scale = _child(reader, info, _ID_TIMESTAMP_SCALE, 'uint', 1000000)
+    duration = _child(reader, info, _ID_DURATION, 'float')
+
+    streams = []
+    streams_by_uid = {}
+    streams_by_number = {}
+    for entry_start, entry_end in reader.children(*positions[_ID_TRACKS]).get(_ID_TRACK_ENTRY, []):
+        children = reader.children(entry_start, entry_end)
+        stream = _parse_track(reader, children, len(streams))
+        if stream is None:
+            continue
+        codec_delay = _child(reader, children, _ID_CODEC_DELAY, 'uint', 0)
+        streams.append(stream)
+        streams_by_uid[_child(reader, children, _ID_TRACK_UID, 'uint')] = stream
+        streams_by_number[_child(reader, children, _ID_TRACK_NUMBER, 'uint')] = \
+            (stream, int(round(codec_delay / float(timestamp_scale))))
+
+    if _ID_TAGS in positions:
+        _parse_tags(reader, positions[_ID_TAGS], streams_by_uid)
+    if first_cluster is not None:
+        _parse_first_blocks(reader, first_cluster, segment_end, streams_by_number)
+
+    result = {
+        'format': {'format_name': 'matroska,webm', 'nb_streams': len(streams), 'tags': {}},
+        'streams': streams,
+        'chapters': _parse_chapters(reader, positions[_ID_CHAPTERS], timestamp_scale) if _ID_CHAPTERS in positions else [],
+    }
+    if duration is not None:
+        result['format']['duration'] = '{:.6f}'.format(duration * timestamp_scale / 1e9)
+    return result
+
+# attachments and big headers come before the first cluster, frames only start inside it
+def payload_offset(data):
+    try:
+        reader = _Reader(data)
+        _, first_cluster = _find_top_level(reader, *_segment(reader))
+    except (ValueError, KeyError, IndexError, TypeError, struct.error):
+        return None
+    return first_cluster[0] if first_cluster is not None else None
+
+def probe(media_path):
+    with open(media_path, 'rb') as fobj:
+        try:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            return None
+        try:
+            return _probe(_Reader(data))
+        except (ValueError, KeyError, IndexError, TypeError, struct.error):
+            return None
+        finally:
+            data.close()
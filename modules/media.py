@@ -1,28 +1,65 @@
 # coding: utf-8
 
+import collections
 import fnmatch
 import functools
 import os
 import re
+from multiprocessing.pool import ThreadPool
 
+import bitstream
+import cache
+import cli
 import cmd
+import isobmff
 import lang
+import matroska
 import misc
 import platform
 from ffmpeg import Ffmpeg
 from formats import AudioCodec, FileFormat, TrackType
 from tracks import AudioTrack, VideoTrack, SubtitleTrack, ChaptersTrack
 
+_NATIVE_PROBES = {
+    '.3gp': isobmff.probe,
+    '.m4a': isobmff.probe,
+    '.m4v': isobmff.probe,
+    '.mkv': matroska.probe,
+    '.mov': isobmff.probe,
+    '.mp4': isobmff.probe,
+    '.webm': matroska.probe,
+}
+
+def probe(media_path):
+    native_probe = _NATIVE_PROBES.get(platform.file_ext(media_path))
+    if native_probe is not None:
+        result = native_probe(media_path)
+        if result is not None and all(cmd.is_ffprobe_stream_complete(stream) for stream in result['streams']):
+            return result
+    return cmd.ffprobe(media_path)
+
+_PAYLOAD_OFFSETS = {
+    '.3gp': isobmff.payload_offset,
+    '.m4v': isobmff.payload_offset,
+    '.mkv': matroska.payload_offset,
+    '.mov': isobmff.payload_offset,
+    '.mp4': isobmff.payload_offset,
+    '.webm': matroska.payload_offset,
+}
+
+def _read_encoder_settings(media_path):
+    return bitstream.read_encoder_settings(media_path, payload_offset=_PAYLOAD_OFFSETS.get(platform.file_ext(media_path)))
+
 class File(object):
-    _TRACK_PROPS_IDX_CLASS = 0
-    _TRACK_PROPS_IDX_FFMPEG_STREAM = 1
-    _TRACK_PROPS = {
-        TrackType.VID: (VideoTrack, Ffmpeg.STREAM_ARGUMENT_VID),
-        TrackType.AUD: (AudioTrack, Ffmpeg.STREAM_ARGUMENT_AUD),
-        TrackType.SUB: (SubtitleTrack, Ffmpeg.STREAM_ARGUMENT_SUB),
-        TrackType.CHA: (ChaptersTrack, None),
+    _TRACK_CLASSES = {
+        TrackType.VID: VideoTrack,
+        TrackType.AUD: AudioTrack,
+        TrackType.SUB: SubtitleTrack,
+        TrackType.CHA: ChaptersTrack,
     }
 
+    _ffmpeg = Ffmpeg()
+
     _FORMATS_INFO = {
         FileFormat.x3GP: (['*.3gp'], [TrackType.VID, TrackType.AUD], [('MPEG-4', '3GPP Media Release 4'), ('MPEG-4', '3GPP Media Release 5')]),
         FileFormat.AC3: (['*.ac3'], [TrackType.AUD], [('AC-3', None)]),
@@ -51,48 +88,105 @@ class File(object):
         FileFormat.WMV: (['*.asf', '*.wma', '*.wmv'], [TrackType.VID, TrackType.AUD, TrackType.SUB], [('Windows Media', None)]),
     }
     _format_signatures = None
+    _wildcard_classifier = None
+    _possible_track_types = {}
 
     @classmethod
-    def possible_track_types(cls, file_path):
-        for file_format, (wildcards, track_types, signatures) in cls._FORMATS_INFO.iteritems():
-            for wildcard in wildcards:
-                if fnmatch.fnmatch(file_path, wildcard):
-                    return track_types
-        return []
+    def _get_wildcard_classifier(cls):
+        if cls._wildcard_classifier is None:
+            extensions = {}
+            patterns = []
+            groups = {}
+            for wildcards, track_types, _ in cls._FORMATS_INFO.itervalues():
+                for wildcard in wildcards:
+                    wildcard = os.path.normcase(wildcard)
+                    if wildcard.startswith('*.') and not any(c in wildcard[2:] for c in '*?[.'):
+                        extensions[wildcard[1:]] = track_types
+                    else:
+                        group = 'f{}'.format(len(patterns))
+                        regexp = fnmatch.translate(wildcard)
+                        if regexp.endswith('\\Z(?ms)'):
+                            regexp = regexp[:-len('\\Z(?ms)')]
+                        patterns.append('(?P<{}>{})\\Z'.format(group, regexp))
+                        groups[group] = track_types
+            combined = re.compile('(?ms)' + '|'.join(patterns)) if patterns else None
+            cls._wildcard_classifier = extensions, combined, groups
+        return cls._wildcard_classifier
 
-    def __init__(self, file_path, container_format, container_format_profile):
+    @classmethod
+    def possible_track_types(cls, file_path):
+        result = cls._possible_track_types.get(file_path)
+        if result is None:
+            extensions, combined, groups = cls._get_wildcard_classifier()
+            path = os.path.normcase(file_path)
+            match = combined.match(path) if combined is not None else None
+            if match is not None:
+                result = groups[match.lastgroup]
+            else:
+                result = extensions.get(path[path.rfind('.'):], [])
+            cls._possible_track_types[file_path] = result
+        return result
+
+    def __init__(self, file_path, probe_cache):
         self._path = file_path
+        self._probe_cache = probe_cache
+        self._probe_data = None
         self._tracks_by_type = None
-        self._ffmpeg = Ffmpeg()  # TODO singleton
+        self._format = self._detect_format()
 
-        if File._format_signatures is None:
+    @classmethod
+    def _get_format_signatures(cls):
+        if cls._format_signatures is None:
             formats = {}
-            for file_format, (_, _, signatures) in self._FORMATS_INFO.iteritems():
+            for file_format, (_, _, signatures) in cls._FORMATS_INFO.iteritems():
                 for signature in signatures:
                     formats[signature] = file_format
-            File._format_signatures = formats
-        self._format = File._format_signatures[(container_format, container_format_profile)]
+            cls._format_signatures = formats
+        return cls._format_signatures
+
+    def _detect_format(self):
+        if File.possible_track_types(self._path) == [TrackType.CHA]:
+            return FileFormat.CHA
+        format_info = self._get_probe_data()['format']
+        result = self._ffmpeg.parse_file_format(format_info.get('format_name'), format_info.get('tags', {}))
+        if result == FileFormat.MKV and platform.file_ext(self._path) == '.webm':
+            result = FileFormat.WEBM
+        if result is None:
+            if not cmd.has_mediainfo():
+                raise cli.Error(u'Unable to detect format of "{}"'.format(self._path))
+            info = self._probe_cache.get('mediainfo', self._path, cmd.mediainfo)['general']
+            result = self._get_format_signatures()[(info['format'], info['format_profile'])]
+        return result
 
     def path(self):
         return self._path
 
+    def _get_probe_data(self):
+        if self._probe_data is None:
+            self._probe_data = self._probe_cache.get('ffprobe', self._path, probe)
+        return self._probe_data
+
     def _get_tracks(self):
         if self._tracks_by_type is None:
             tracks_data = {}
-            for track_type in File.possible_track_types(self._path):
-                if track_type == TrackType.CHA:
-                    tracks_data.setdefault(TrackType.CHA, {})[-1] = {}
-                else:
-                    stream_id = self._TRACK_PROPS[track_type][self._TRACK_PROPS_IDX_FFMPEG_STREAM]
-                    for track_id, track in cmd.ffprobe(self._path, stream_id).iteritems():
-                        tracks_data.setdefault(self._ffmpeg.parse_track_type(track['codec_type']), {})[track_id] = track
-
-            self._tracks_by_type = {track_type: [] for track_type in self._TRACK_PROPS.iterkeys()}
+            possible_track_types = File.possible_track_types(self._path)
+            if TrackType.CHA in possible_track_types:
+                tracks_data.setdefault(TrackType.CHA, {})[-1] = {}
+            elif possible_track_types:
+                for track in self._get_probe_data()['streams']:
+                    track_type = self._ffmpeg.parse_stream_track_type(track)
+                    if track_type in possible_track_types:
+                        tracks_data.setdefault(track_type, {})[track['index']] = track
+
+            self._tracks_by_type = {track_type: [] for track_type in self._TRACK_CLASSES.iterkeys()}
             for track_type, tracks_of_type in tracks_data.iteritems():
                 for track_id, track_data in tracks_of_type.iteritems():
-                    track_class = self._TRACK_PROPS[track_type][self._TRACK_PROPS_IDX_CLASS]
+                    track_class = self._TRACK_CLASSES[track_type]
                     self._tracks_by_type[track_type].append(track_class(self._path, self._format, track_data))
                 self._tracks_by_type[track_type].sort(key=lambda t: t.qualified_id())
+            # tracks keep what they need, the raw probe result is not held for the life of the movie
+            self._probe_data = None
+            self._probe_cache.release(self._path, 'ffprobe')
         return self._tracks_by_type
 
     def tracks(self, track_type):
@@ -110,28 +204,37 @@ class Movie(object):
             result.append(cluster)
         return u' '.join(result)
 
-    def __init__(self, media_paths, ignore_languages):
+    def __init__(self, media_paths, ignore_languages, probe_cache=None):
         self._ignore_languages = ignore_languages
+        self._probe_cache = probe_cache if probe_cache is not None else cache.ProbeCache()
         self._media_paths = list(media_paths)
         self._media_files = None
+        self._tracks_by_type = None
+        self._track_indexes = None
         self._main_path = self._media_paths[0]
-        self._file_info_cache = {}
 
     def _get_file_info(self, path):
-        if path not in self._file_info_cache:
-            self._file_info_cache[path] = cmd.mediainfo(path)
-        return self._file_info_cache[path]
+        return self._probe_cache.get('mediainfo', path, cmd.mediainfo)
 
     def _parse_media(self):
         sort_prefix = os.path.commonprefix([path for path in self._media_paths])
         self._media_paths.sort(key=functools.partial(self.sort_key, sort_prefix))
         self._media_files = []
         for path in self._media_paths:
-            info = self._get_file_info(path)['general']
-            self._media_files.append(File(path, info['format'], info['format_profile']))
+            self._media_files.append(File(path, self._probe_cache))
+        self._index_tracks()
         assert len(list(self.tracks(TrackType.VID))) >= 1
         assert len(list(self.tracks(TrackType.CHA))) <= 1
 
+    def _index_tracks(self):
+        self._tracks_by_type = {}
+        self._track_indexes = {}
+        for track_type in File._TRACK_CLASSES.iterkeys():
+            tracks = [track for media_file in self._media_files for track in media_file.tracks(track_type)]
+            self._tracks_by_type[track_type] = tracks
+            for index, track in enumerate(tracks, 1):
+                self._track_indexes[track.qualified_id()] = index
+
     def _fill_metadata(self):
         self._set_codecs()
         self._set_languages()
@@ -149,10 +252,17 @@ class Movie(object):
 
     def _set_codecs(self):
         for track in self.tracks(TrackType.AUD):
-            if track.codec() == AudioCodec.DTS:
-                track_info = self._get_file_info(track.source_file())['tracks'][track.id()]
-                if 'ES' in track_info.get('Format_Profile', ''):
-                    track.overwrite_codec(AudioCodec.DTS_ES)
+            if track.is_dts_without_profile():
+                codec = AudioCodec.DTS
+                if cmd.has_mediainfo():
+                    # e.g. "ES Matrix / Core" or "MA / Core", the first part names the extension
+                    track_info = self._get_file_info(track.source_file())['tracks'][track.id()]
+                    profile_words = track_info.get('Format_Profile', '').split(' / ')[0].split()
+                    for word, value in (('MA', AudioCodec.DTS_MA), ('HRA', AudioCodec.DTS_HRA), ('ES', AudioCodec.DTS_ES)):
+                        if word in profile_words:
+                            codec = value
+                            break
+                track.overwrite_codec(codec)
 
     def _set_languages(self):
         if self._ignore_languages:
@@ -169,7 +279,7 @@ class Movie(object):
 
         for track in self._single_file_tracks(TrackType.SUB):
             if not track.is_binary() and (track.language() == 'und' or track.encoding() is None):
-                encoding_data = platform.detect_encoding(track.source_file())
+                encoding_data = self._probe_cache.get('encoding', track.source_file(), platform.detect_encoding)
                 if encoding_data['confidence'] >= 0.8:
                     new_lang = lang.alpha3(encoding_data['language'] or 'und')
                     if new_lang != 'und':
@@ -216,25 +326,33 @@ class Movie(object):
     def _set_crf(self):
         for track in self.tracks(TrackType.VID):
             if track.crf() is None:
-                track.set_crf(cmd.detect_crf(track.source_file()))
+                settings = self._probe_cache.get('encoder_settings', track.source_file(), _read_encoder_settings)
+                track.set_crf(settings['crf'] if settings is not None else None)
 
     def _setup_media(self):
         if self._media_files is None:
             self._parse_media()
             self._fill_metadata()
 
+    def release(self):
+        if self._media_files is not None:
+            for path in self._media_paths:
+                self._probe_cache.release(path)
+        self._media_files = None
+        self._tracks_by_type = None
+        self._track_indexes = None
+
     def media_files(self):
         self._setup_media()
         return self._media_files
 
     def tracks(self, track_type):
         self._setup_media()
-        for media_file in self._media_files:
-            for track in media_file.tracks(track_type):
-                yield track
+        return iter(self._tracks_by_type[track_type])
 
     def track_index_in_type(self, track):
-        return list(self.tracks(track.type())).index(track) + 1
+        self._setup_media()
+        return self._track_indexes[track.qualified_id()]
 
     def main_path(self):
         return self._main_path
@@ -246,3 +364,24 @@ class Movie(object):
     def reference_duration(self):
         durations = [track.duration() for track in self.tracks(TrackType.VID)]
         return durations[0] or None
+
+def _prefetch_movie(movie):
+    movie.media_files()
+    return movie
+
+def prefetch_movies(movies, jobs):
+    if jobs <= 1:
+        for movie in movies:
+            yield movie
+        return
+    pool = ThreadPool(jobs)
+    try:
+        pending = collections.deque()
+        for movie in movies:
+            pending.append(pool.apply_async(_prefetch_movie, (movie,)))
+            if len(pending) > jobs * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
@@ -1,15 +1,27 @@
 from __future__ import print_function
 
 import chardet
+import codecs
+import ctypes
 import locale
 import os
 import subprocess
 import sys
 import tempfile
+import threading
 import uuid
 
 import cli
-import cmd
+
+_ENCODING_BOMS = [
+    (codecs.BOM_UTF32_LE, 'UTF-32'),
+    (codecs.BOM_UTF32_BE, 'UTF-32'),
+    (codecs.BOM_UTF8, 'UTF-8-SIG'),
+    (codecs.BOM_UTF16_LE, 'UTF-16'),
+    (codecs.BOM_UTF16_BE, 'UTF-16'),
+]
+ENCODING_SAMPLE_SIZE = 64 * 1024
+ENCODING_SAMPLE_COUNT = 4
 
 def is_windows():
     return 'win' in sys.platform
@@ -22,34 +34,114 @@ def print_string(s, *args, **kwargs):
         encoding = 'utf-8'
     print(s.encode(encoding, errors='ignore'), *args, **kwargs)
 
-# TODO try to delegate shell escaping to subprocess so we can just provide list of arguments
-def execute(command, capture_output=True):
+# windows children inherit every inheritable pipe handle that exists while they are spawned,
+# so concurrent spawns could keep each other's pipes open and pipelines would never see EOF
+_spawn_lock = threading.Lock()
+
+def _encode_args(args):
     cmd_encoding = locale.getpreferredencoding()
-    if isinstance(command, list):
-        result_command = [cmd.escape(arg).encode(cmd_encoding) for arg in command]
+    return [unicode(arg).encode(cmd_encoding) for arg in args]
+
+# argument lists are executed directly, strings still go through the shell
+def execute(command, capture_output=True):
+    is_shell_command = not isinstance(command, list)
+    if is_shell_command:
+        result_command = command.encode(locale.getpreferredencoding())
     else:
-        result_command = command.encode(cmd_encoding)
+        result_command = _encode_args(command)
     output_buffer = subprocess.PIPE if capture_output else None
-    process = subprocess.Popen(result_command, stdout=output_buffer, stderr=output_buffer, shell=True)
+    with _spawn_lock:
+        process = subprocess.Popen(result_command, stdout=output_buffer, stderr=output_buffer, shell=is_shell_command)
     stdout, stderr = process.communicate()
     if process.returncode != 0 or capture_output and stderr:
         print_string(stderr.decode(locale.getpreferredencoding()), file=sys.stderr)
         raise cli.Error(u'Process execution error!')
     return stdout
 
+def _spawn(args, env, cores, stdin=None, stdout=None):
+    process_env = None
+    if env:
+        process_env = dict(os.environ)
+        process_env.update(zip(_encode_args(env.iterkeys()), _encode_args(env.itervalues())))
+    # is_windows also matches darwin, which has neither taskset nor an affinity api, so commands run unpinned there
+    mask = None
+    if cores:
+        mask = sum(1 << core for core in cores)
+        if sys.platform.startswith('linux'):
+            args = [u'taskset', u'{:#x}'.format(mask)] + list(args)
+    with _spawn_lock:
+        process = subprocess.Popen(_encode_args(args), env=process_env, stdin=stdin, stdout=stdout)
+    if mask is not None and sys.platform == 'win32':
+        ctypes.windll.kernel32.SetProcessAffinityMask(int(process._handle), mask)
+    return process
+
+def call(args, env=None, cores=None):
+    return _spawn(args, env, cores).wait()
+
+# returns the first failed exit code, a broken upstream must not pass for a complete output
+def call_pipeline(commands, cores=None):
+    processes = []
+    for i, (args, env) in enumerate(commands):
+        stdin = processes[-1].stdout if processes else None
+        processes.append(_spawn(args, env, cores, stdin, subprocess.PIPE if i < len(commands) - 1 else None))
+        if stdin is not None:
+            stdin.close()
+    exit_codes = [process.wait() for process in processes]
+    return next((exit_code for exit_code in exit_codes if exit_code != 0), 0)
+
 def make_temporary_file(extension):
     return os.path.join(tempfile.gettempdir(), u'{}.{}'.format(uuid.uuid4(), extension.lstrip('.')))
 
+def get_cache_dir():
+    if is_windows():
+        root = os.environ.get('LOCALAPPDATA') or tempfile.gettempdir()
+    else:
+        root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    if not isinstance(root, unicode):
+        root = root.decode(sys.getfilesystemencoding())
+    return os.path.join(root, u'mvtools')
+
 def file_ext(path):
     return os.path.splitext(path)[1].lower()
 
 def split_path(path):
     return os.path.dirname(path), os.path.basename(path)
 
+def _read_encoding_samples(filepath):
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as fobj:
+        if size <= ENCODING_SAMPLE_SIZE * ENCODING_SAMPLE_COUNT:
+            return [fobj.read()]
+        samples = []
+        for i in xrange(ENCODING_SAMPLE_COUNT):
+            fobj.seek((size - ENCODING_SAMPLE_SIZE) * i // (ENCODING_SAMPLE_COUNT - 1))
+            sample = fobj.read(ENCODING_SAMPLE_SIZE)
+            if i > 0:
+                sample = sample[sample.find(b'\n') + 1:]
+            samples.append(sample)
+        return samples
+
+def _is_utf8(samples):
+    for sample in samples:
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        except UnicodeDecodeError:
+            return False
+    return True
+
 def detect_encoding(filepath):
+    samples = _read_encoding_samples(filepath)
+    for bom, encoding in _ENCODING_BOMS:
+        if samples[0].startswith(bom):
+            return {'encoding': encoding, 'confidence': 1.0, 'language': ''}
+    if _is_utf8(samples):
+        if all(max(sample or b'\0') < b'\x80' for sample in samples):
+            return {'encoding': 'ascii', 'confidence': 1.0, 'language': ''}
+        return {'encoding': 'utf-8', 'confidence': 0.99, 'language': ''}
+
     detector = chardet.UniversalDetector()
-    for line in open(filepath, 'rb'):
-        detector.feed(line)
+    for sample in samples:
+        detector.feed(sample)
         if detector.done:
             break
     detector.close()
@@ -0,0 +1,155 @@
+import collections
+import cPickle as pickle
+import os
+import sqlite3
+import sys
+import time
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+ScanResult = collections.namedtuple('ScanResult', ['files', 'added', 'changed', 'removed'])
+
+def _write_rows(db, rows):
+    for path, exists, mtime, files in rows:
+        db.execute('DELETE FROM files WHERE dir = ?', (path,))
+        if exists:
+            db.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)', (path, os.path.dirname(path), mtime))
+            db.executemany('INSERT INTO files (path, dir, size, mtime) VALUES (?, ?, ?, ?)',
+                           ((file_path, path, size, file_mtime) for file_path, (size, file_mtime) in files.iteritems()))
+        else:
+            db.execute('DELETE FROM dirs WHERE path = ?', (path,))
+    db.commit()
+
+class LibraryScanner(object):
+    # directories modified this close to the scan may still change within the same mtime tick
+    _RACY_INTERVAL = 2.0
+
+    def __init__(self, db_path, file_filter):
+        self._file_filter = file_filter
+        db_dir = os.path.dirname(db_path)
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self._db = sqlite3.connect(db_path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+        self._db.commit()
+
+        self._dir_mtimes = {}
+        self._subdirs = {}
+        self._files = {}
+        for path, parent, mtime in self._db.execute('SELECT path, parent, mtime FROM dirs'):
+            self._dir_mtimes[path] = mtime
+            self._subdirs.setdefault(parent, []).append(path)
+        for path, dir_path, size, mtime in self._db.execute('SELECT path, dir, size, mtime FROM files'):
+            self._files.setdefault(dir_path, {})[path] = (size, mtime)
+        self._dirty = set()
+
+    def _list_dir(self, path):
+        subdirs = []
+        files = {}
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file() and self._file_filter(entry.path):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime)
+        else:
+            for name in os.listdir(path):
+                entry_path = os.path.join(path, name)
+                if os.path.isdir(entry_path):
+                    if not os.path.islink(entry_path):
+                        subdirs.append(entry_path)
+                elif os.path.isfile(entry_path) and self._file_filter(entry_path):
+                    stat = os.stat(entry_path)
+                    files[entry_path] = (stat.st_size, stat.st_mtime)
+        return subdirs, files
+
+    def _set_dir(self, path, mtime, subdirs, files):
+        self._dir_mtimes[path] = mtime
+        self._subdirs[path] = subdirs
+        self._files[path] = files
+        self._dirty.add(path)
+
+    def _drop_dir(self, path):
+        self._dir_mtimes.pop(path, None)
+        self._subdirs.pop(path, None)
+        self._files.pop(path, None)
+        self._dirty.add(path)
+
+    def scan(self, root):
+        root = os.path.abspath(root)
+        root_prefix = os.path.join(root, u'')
+        scan_time = time.time()
+        files, added, changed, removed = [], [], [], []
+        seen_dirs = set()
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            seen_dirs.add(path)
+            known_files = self._files.get(path, {})
+            if self._dir_mtimes.get(path) == mtime:
+                subdirs = self._subdirs.get(path, [])
+                dir_files = known_files
+            else:
+                subdirs, dir_files = self._list_dir(path)
+                for file_path, state in dir_files.iteritems():
+                    if file_path not in known_files:
+                        added.append(file_path)
+                    elif known_files[file_path] != state:
+                        changed.append(file_path)
+                removed.extend(file_path for file_path in known_files if file_path not in dir_files)
+                self._set_dir(path, mtime if mtime < scan_time - self._RACY_INTERVAL else None, subdirs, dir_files)
+            files.extend(dir_files)
+            stack.extend(subdirs)
+
+        for path in [p for p in self._dir_mtimes if p == root or p.startswith(root_prefix)]:
+            if path not in seen_dirs:
+                removed.extend(self._files.get(path, {}))
+                self._drop_dir(path)
+        return ScanResult(sorted(files), sorted(added), sorted(changed), sorted(removed))
+
+    # rows for every changed directory, directories holding excluded files get listed again by the next scan
+    def _pending_rows(self, excluded_files):
+        excluded_files = set(excluded_files)
+        rows = []
+        for path in self._dirty:
+            if path not in self._dir_mtimes:
+                rows.append((path, False, None, {}))
+                continue
+            files = {file_path: state for file_path, state in self._files[path].iteritems() if file_path not in excluded_files}
+            mtime = self._dir_mtimes[path] if len(files) == len(self._files[path]) else None
+            rows.append((path, True, mtime, files))
+        return rows
+
+    def commit(self, excluded_files=()):
+        _write_rows(self._db, self._pending_rows(excluded_files))
+        self._dirty.clear()
+
+    # generated scripts apply the scan only after all their movies succeeded, see apply_pending
+    def save_pending(self, pending_path):
+        with open(pending_path, 'wb') as fobj:
+            pickle.dump(self._pending_rows(()), fobj, pickle.HIGHEST_PROTOCOL)
+        self._dirty.clear()
+
+    def close(self):
+        self._db.close()
+
+def apply_pending(db_path, pending_path):
+    with open(pending_path, 'rb') as fobj:
+        rows = pickle.load(fobj)
+    db = sqlite3.connect(db_path)
+    _write_rows(db, rows)
+    db.close()
+    os.remove(pending_path)
+
+if __name__ == '__main__':
+    apply_pending(sys.argv[1].decode(sys.getfilesystemencoding()), sys.argv[2].decode(sys.getfilesystemencoding()))
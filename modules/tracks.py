@@ -10,7 +10,23 @@ from formats import FieldOrder, PictureFormat, ColorRange, ColorSpace, VideoFpsS
     SubtitleCodec, VideoCodec, TrackType, AudioCodec
 
 
+def _index_codec_props(codec_props):
+    codec_enums = {}
+    codec_ids = {}
+    codec_names = {}
+    codec_file_extensions = {}
+    for codec_enum, (codec_id, codec_name, codec_file_extension) in codec_props.iteritems():
+        codec_enums[codec_id] = codec_enum
+        codec_ids[codec_enum] = codec_id
+        codec_names[codec_enum] = codec_name
+        codec_file_extensions[codec_enum] = codec_file_extension
+    return codec_enums, codec_ids, codec_names, codec_file_extensions
+
+
 class Track(object):
+    __slots__ = ('_parent_path', '_parent_format', '_index', '_codec_type', '_codec_name', '_title', '_language',
+                 '_duration_string', '_duration', '_frames', '_default', '_forced')
+
     # TODO move to mkvmerge class
     TYPE_FLAGS = {
         TrackType.VID: (None, '-D'),
@@ -20,22 +36,25 @@ class Track(object):
 
     _DURATION_REGEXP = re.compile(r'(?P<hh>\d+):(?P<mm>\d+):(?P<ss>[\d.]+)')
 
-    def __init__(self, parent_path, parent_format, ffm_data, codec_props):
+    _CODEC_ENUMS, _CODEC_IDS, _CODEC_NAMES, _CODEC_FILE_EXTENSIONS = _index_codec_props({})
+
+    _ffmpeg = Ffmpeg()
+
+    def __init__(self, parent_path, parent_format, ffm_data):
+        tags = ffm_data.get('tags', {})
+        disposition = ffm_data.get('disposition', {})
         self._parent_path = parent_path
         self._parent_format = parent_format
-        self._ffm_data = ffm_data
-        self._ffmpeg = Ffmpeg()  # TODO pass from outside
+        self._index = ffm_data.get('index')
+        self._codec_type = ffm_data.get('codec_type')
+        self._codec_name = ffm_data.get('codec_name')
+        self._title = tags.get('title', '')
+        self._language = tags.get('language')
+        self._duration_string = tags.get('DURATION-eng')
         self._duration = None
-
-        self._codec_enums = {}
-        self._codec_ids = {}
-        self._codec_names = {}
-        self._codec_file_extensions = {}
-        for codec_enum, (codec_id, codec_name, codec_file_extension) in codec_props.iteritems():
-            self._codec_enums[codec_id] = codec_enum
-            self._codec_ids[codec_enum] = codec_id
-            self._codec_names[codec_enum] = codec_name
-            self._codec_file_extensions[codec_enum] = codec_file_extension
+        self._frames = tags.get('NUMBER_OF_FRAMES-eng') or ffm_data.get('nb_frames')
+        self._default = disposition.get('default')
+        self._forced = disposition.get('forced')
 
     def source_file(self):
         return self._parent_path
@@ -44,69 +63,66 @@ class Track(object):
         return self._parent_format
 
     def get_single_track_file_extension(self):
-        return self._codec_file_extensions[self.codec()]
+        return self._CODEC_FILE_EXTENSIONS[self.codec()]
 
     def is_single(self):
         return platform.file_ext(self.source_file()) == self.get_single_track_file_extension()
 
-    def _tags(self):
-        return self._ffm_data.setdefault('tags', {})
-
     def id(self):
-        return self._ffm_data['index']
+        return self._index
 
     def qualified_id(self):
         return self.source_file(), self.id()
 
     def type(self):
-        return self._ffmpeg.parse_track_type(self._ffm_data['codec_type'])
+        return self._ffmpeg.parse_track_type(self._codec_type)
 
     def codec(self):
-        return self._codec_enums[self._codec_id()]
+        return self._CODEC_ENUMS[self._codec_id()]
 
     def _codec_id(self):
-        return self._ffm_data['codec_name']
+        return self._codec_name
 
     def codec_name(self):
-        return self._codec_names[self.codec()]
+        return self._CODEC_NAMES[self.codec()]
 
     def name(self):
-        return self._tags().get('title', '')
+        return self._title
 
     def language(self):
-        result = self._tags().get('language')
+        result = self._language
         if result in [None, 'non']:
             result = 'und'
         return result
 
     def set_language(self, value):
-        self._tags()['language'] = value
+        self._language = value
 
     def duration(self):
         if self._duration is None:
-            duration_string = self._tags().get('DURATION-eng')
-            if duration_string:
-                match = self._DURATION_REGEXP.match(duration_string)
+            if self._duration_string:
+                match = self._DURATION_REGEXP.match(self._duration_string)
                 value = match.groupdict()
                 self._duration = (int(value['hh']) * 60 + int(value['mm'])) * 60 + float(value['ss'])
         return self._duration
 
     def frames_len(self):
-        n = self._tags().get('NUMBER_OF_FRAMES-eng', None) or self._ffm_data.get('nb_frames', None)
-        return misc.try_int(n)
+        return misc.try_int(self._frames)
 
     def is_forced(self):
-        forced = self._ffm_data['disposition']['forced']
+        forced = self._forced
         return forced if forced is None else bool(forced)
 
     def set_forced(self, value):
-        self._ffm_data['disposition']['forced'] = value
+        self._forced = value
 
     def is_default(self):
-        return bool(self._ffm_data['disposition']['default'])
+        return bool(self._default)
 
 
 class AudioTrack(Track):
+    __slots__ = ('_codec_overwrite', '_profile', '_channels', '_start_pts')
+
     _CODEC_PROPS = {
         AudioCodec.AAC_HE: ['aac_he_aac', 'aac_he', '.aac'],
         AudioCodec.AAC_HE_V2: ['aac_he_aacv2', 'aac_he_aacv2', '.aac'],
@@ -139,16 +155,21 @@ class AudioTrack(Track):
         AudioCodec.WMA_V2: ['wmav2', 'wma', '.wma'],
     }
 
+    _CODEC_ENUMS, _CODEC_IDS, _CODEC_NAMES, _CODEC_FILE_EXTENSIONS = _index_codec_props(_CODEC_PROPS)
+
     def __init__(self, parent_path, parent_format, ffm_data):
-        super(AudioTrack, self).__init__(parent_path, parent_format, ffm_data, self._CODEC_PROPS)
+        super(AudioTrack, self).__init__(parent_path, parent_format, ffm_data)
         self._codec_overwrite = None
+        self._profile = ffm_data.get('profile')
+        self._channels = ffm_data.get('channels')
+        self._start_pts = ffm_data.get('start_pts')
 
     def _codec_id(self):
         if self._codec_overwrite is not None:
-            return self._codec_ids[self._codec_overwrite]
+            return self._CODEC_IDS[self._codec_overwrite]
 
-        profile = self._ffm_data.get('profile')
-        result = self._ffm_data['codec_name']
+        profile = self._profile
+        result = self._codec_name
         if profile:
             result += '_{}'.format(profile.replace('-', '_').replace(' ', '_'))
         return result.lower()
@@ -156,14 +177,21 @@ class AudioTrack(Track):
     def overwrite_codec(self, value):
         self._codec_overwrite = value
 
+    # dts extensions are reported in the profile, without one the exact codec is unknown
+    def is_dts_without_profile(self):
+        return self._codec_overwrite is None and self._codec_name == 'dts' and not self._profile
+
     def channels(self):
-        return int(self._ffm_data['channels'])
+        return int(self._channels)
 
     def delay(self):
-        return int(self._ffm_data['start_pts'])
+        return int(self._start_pts)
 
 
 class VideoTrack(Track):
+    __slots__ = ('_crf', '_field_order', '_field_order_raw', '_colors', '_width', '_height', '_profile', '_level',
+                 '_frame_rate')
+
     _CODECS_WITH_PROFILES_AND_LEVELS = {
         VideoCodec.H264,
         VideoCodec.H265,
@@ -193,6 +221,8 @@ class VideoTrack(Track):
         VideoCodec.WMV3_WMV9: ['wmv3', 'wmv', '.mkv'],
     }
 
+    _CODEC_ENUMS, _CODEC_IDS, _CODEC_NAMES, _CODEC_FILE_EXTENSIONS = _index_codec_props(_CODEC_PROPS)
+
     @staticmethod
     def dimensions_correct(w, h):
         return w % 16 == h % 8 == 0
@@ -204,16 +234,22 @@ class VideoTrack(Track):
         return w - dw, h - dh, x + int(math.ceil(dw * 0.5)), y + int(math.ceil(dh * 0.5))
 
     def __init__(self, parent_path, parent_format, ffm_data):
-        super(VideoTrack, self).__init__(parent_path, parent_format, ffm_data, self._CODEC_PROPS)
+        super(VideoTrack, self).__init__(parent_path, parent_format, ffm_data)
         self._crf = None
         self._field_order = None
-        self._colors = Colors(self.width(), self.height(), self.standard(), self._ffm_data)
+        self._field_order_raw = ffm_data.get('field_order')
+        self._width = ffm_data.get('width')
+        self._height = ffm_data.get('height')
+        self._profile = ffm_data.get('profile')
+        self._level = ffm_data.get('level')
+        self._frame_rate = ffm_data.get('r_frame_rate')
+        self._colors = Colors(self.width(), self.height(), self.standard(), ffm_data)
 
     def width(self):
-        return self._ffm_data['width']
+        return self._width
 
     def height(self):
-        return self._ffm_data['height']
+        return self._height
 
     def is_hd(self):
         return self.width() >= 1200 or self.height() >= 700
@@ -221,12 +257,12 @@ class VideoTrack(Track):
     def profile(self):
         if self.codec() not in self._CODECS_WITH_PROFILES_AND_LEVELS:
             return None
-        return self._ffmpeg.parse_video_codec_profile(self._ffm_data['profile'])
+        return self._ffmpeg.parse_video_codec_profile(self._profile)
 
     def level(self):
         if self.codec() not in self._CODECS_WITH_PROFILES_AND_LEVELS:
             return None
-        return self._ffmpeg.parse_video_codec_level(self.codec(), self._ffm_data['level'])
+        return self._ffmpeg.parse_video_codec_level(self.codec(), self._level)
 
     def pix_fmt(self):
         return self.colors().pix_fmt()
@@ -243,8 +279,7 @@ class VideoTrack(Track):
     def standard(self):
         def equals(x, y, p):
             return abs(x - y) <= p
-        rate_string = self._ffm_data['r_frame_rate']
-        a, b = [float(n) for n in rate_string.split('/')]
+        a, b = [float(n) for n in self._frame_rate.split('/')]
         rate_float = a / b
         if any(equals(rate_float, x, 0.1) for x in [23.976, 29.97]):
             return VideoFpsStandard.NTSC
@@ -261,26 +296,33 @@ class VideoTrack(Track):
 
     def field_order(self):
         if self._field_order is None:
-            raw = self._ffm_data.get('field_order')
+            raw = self._field_order_raw
             self._field_order = self._ffmpeg.parse_field_order(raw) if raw is not None else FieldOrder.PROGRESSIVE
         return self._field_order
 
 
 class Colors(object):
+    __slots__ = ('_width', '_height', '_standard', '_pix_fmt', '_range', '_space', '_trc', '_primaries')
+
+    _ffmpeg = Ffmpeg()
+
     def __init__(self, w, h, standard, ffm_data):
         self._width = w
         self._height = h
         self._standard = standard
-        self._ffm_data = ffm_data
-        self._ffmpeg = Ffmpeg()
+        self._pix_fmt = ffm_data.get('pix_fmt')
+        self._range = ffm_data.get('color_range')
+        self._space = ffm_data.get('color_space')
+        self._trc = ffm_data.get('color_transfer')
+        self._primaries = ffm_data.get('color_primaries')
 
     # TODO move out
     def pix_fmt(self):
-        return self._ffmpeg.parse_picture_format(self._ffm_data['pix_fmt'])
+        return self._ffmpeg.parse_picture_format(self._pix_fmt)
 
     def range(self):
         result = None
-        raw = self._ffm_data.get('color_range')
+        raw = self._range
         if raw is not None:
             result = self._ffmpeg.parse_color_range(raw)
         elif self.pix_fmt() in (PictureFormat.YUV420P, PictureFormat.YUV420P10LE):
@@ -300,24 +342,24 @@ class Colors(object):
         assert not self.is_hd()
         return None
 
-    def _guess_metric(self, metric):
-        raw = self._ffm_data.get(metric)
+    def _guess_metric(self, raw):
         return self._ffmpeg.parse_color_space(raw) if raw is not None else self.correct_space()
 
     def space(self):
-        raw = self._ffm_data.get('color_space')
-        if raw is not None and self._ffmpeg.parse_color_space(raw) == ColorSpace.FCC:
+        if self._space is not None and self._ffmpeg.parse_color_space(self._space) == ColorSpace.FCC:
             return ColorSpace.FCC
-        return self._guess_metric('color_space')
+        return self._guess_metric(self._space)
 
     def trc(self):
-        return self._guess_metric('color_transfer')
+        return self._guess_metric(self._trc)
 
     def primaries(self):
-        return self._guess_metric('color_primaries')
+        return self._guess_metric(self._primaries)
 
 
 class SubtitleTrack(Track):
+    __slots__ = ('_encoding',)
+
     _RE_SUB_CAPTIONS_NUM = re.compile(r', (?P<num>\d+) caption')
 
     _CODEC_PROPS = {
@@ -328,8 +370,10 @@ class SubtitleTrack(Track):
         SubtitleCodec.VOBSUB: ['dvd_subtitle', 'vbs', None],
     }
 
+    _CODEC_ENUMS, _CODEC_IDS, _CODEC_NAMES, _CODEC_FILE_EXTENSIONS = _index_codec_props(_CODEC_PROPS)
+
     def __init__(self, parent_path, parent_format, ffm_data):
-        super(SubtitleTrack, self).__init__(parent_path, parent_format, ffm_data, self._CODEC_PROPS)
+        super(SubtitleTrack, self).__init__(parent_path, parent_format, ffm_data)
         self._encoding = None
 
     def is_binary(self):
@@ -352,8 +396,7 @@ class SubtitleTrack(Track):
 
 
 class ChaptersTrack(Track):
-    def __init__(self, parent_path, parent_format, ffm_data):
-        super(ChaptersTrack, self).__init__(parent_path, parent_format, ffm_data, {})
+    __slots__ = ()
 
     def id(self):
         return id(self)
@@ -24,7 +24,7 @@ def main(args):
                     dst_options.extend(['-profile:v {}'.format(arg_profile), '-level:v {}'.format(arg_level)])
                 elif codec == VideoCodec.H265:
                     dst_options.append('-x265-params "profile={}:level={}"'.format(arg_profile, arg_level))
-                print cmd.gen_ffmpeg_convert(src_file, [], dst_file, dst_options)[0] + ' || exit 1'
+                print cmd.gen_ffmpeg_convert(src_file, [], dst_file, dst_options)[0].render() + ' || exit 1'
 
 if __name__ == '__main__':
     main(sys.argv[1:])